@@ -1,9 +1,12 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from utils.netfree_cache import category_cache, customer_cache
+from utils.netfree_resilience import NetfreeUnavailable
+
 from . import models
+from .manager import get_customer_profile
+from .netfree_sync import clean_customer_id
 
 # Register your models here.
-admin.site.register(models.Categories)
-admin.site.register(models.Emailrequest)
 admin.site.register(models.EmailTemplate)
 admin.site.register(models.SMTPEmail)
 admin.site.register(models.NetfreeCategoriesProfile)
@@ -11,6 +14,61 @@ admin.site.register(models.NetfreeTraffic)
 admin.site.register(models.Hoursvalues)
 
 
+@admin.register(models.Emailrequest)
+class AdminEmailrequest(admin.ModelAdmin):
+    actions = ("refresh_customer_profiles",)
+
+    @admin.action(description="Refresh customer name/email from Netfree")
+    def refresh_customer_profiles(self, request, queryset):
+        refreshed = 0
+        for customer_id in queryset.values_list("customer_id", flat=True).distinct():
+            customer_cache.invalidate(clean_customer_id(customer_id))
+            try:
+                if get_customer_profile(customer_id, refresh=True):
+                    refreshed += 1
+            except NetfreeUnavailable as e:
+                self.message_user(request, f"Netfree is unavailable, try again later : {e}", messages.ERROR)
+                return
+        self.message_user(request, f"Refreshed {refreshed} customer profiles from Netfree")
+
+
 @admin.register(models.Actions)
 class AdminActions(admin.ModelAdmin):
-    list_display = ("id", "label", "template", "is_default",'email_template','category','localized_label')
\ No newline at end of file
+    list_display = ("id", "label", "template", "is_default",'email_template','category','localized_label')
+
+
+@admin.register(models.Categories)
+class AdminCategories(admin.ModelAdmin):
+    list_display = ("id", "categories_id", "description")
+    actions = ("clear_netfree_category_cache",)
+
+    @admin.action(description="Clear cached Netfree host categories")
+    def clear_netfree_category_cache(self, request, queryset):
+        category_cache.invalidate()
+        self.message_user(request, "Netfree host category cache cleared")
+
+
+@admin.register(models.FilterSettingsShadow)
+class AdminFilterSettingsShadow(admin.ModelAdmin):
+    list_display = ("id", "customer_id", "version", "fetched_at", "updated_at")
+    search_fields = ("customer_id",)
+
+
+@admin.register(models.FilterSettingsChange)
+class AdminFilterSettingsChange(admin.ModelAdmin):
+    list_display = ("id", "shadow", "version", "source", "created_at")
+    list_filter = ("source",)
+    search_fields = ("shadow__customer_id",)
+
+
+@admin.register(models.MailboxSyncState)
+class AdminMailboxSyncState(admin.ModelAdmin):
+    list_display = ("id", "account", "folder", "uidvalidity", "last_uid", "highestmodseq", "updated_at")
+    search_fields = ("account", "folder")
+
+
+@admin.register(models.DeadLetter)
+class AdminDeadLetter(admin.ModelAdmin):
+    list_display = ("id", "account", "folder", "uid", "stage", "attempts", "created_at", "resolved_at")
+    list_filter = ("stage", "resolved_at")
+    search_fields = ("account", "message_id", "error")
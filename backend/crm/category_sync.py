@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from utils.helper import NetfreeAPI
+
+from crm.models import Actions, Categories, NetfreeTraffic
+
+cronjob_log = logging.getLogger('cronjob-log')
+
+HASH_KEY = "netfree-category-sync:hash"
+JOB_TTL = 60 * 60 * 24
+
+
+def job_key(job_id):
+    return f"netfree-category-sync:job:{job_id}"
+
+
+def set_job_status(job_id, status, **extra):
+    if job_id:
+        cache.set(job_key(job_id), {"job_id": job_id, "status": status, **extra}, timeout=JOB_TTL)
+
+
+def get_job_status(job_id):
+    return cache.get(job_key(job_id))
+
+
+def tags_hash(tags):
+    items = sorted((int(tag["id"]), tag["description"]) for tag in tags)
+    return hashlib.sha256(json.dumps(items, ensure_ascii=False).encode()).hexdigest()
+
+
+def apply_categories(tags):
+    """Bring the Categories table in line with the Netfree tag list in one transaction.
+
+    Rows are diffed in memory and written with bulk_create/bulk_update. Tags
+    Netfree no longer lists are deleted unless an action or traffic rule still
+    points at them (deleting would silently detach those); duplicate rows for
+    the same tag id are removed after their actions and traffic rules are
+    moved to the row that is kept.
+    """
+    wanted = {int(tag["id"]): tag["description"] for tag in tags}
+    existing = {}
+    duplicates = {}
+    for category in Categories.objects.order_by("id"):
+        if category.categories_id in existing:
+            duplicates.setdefault(existing[category.categories_id].id, []).append(category.id)
+        else:
+            existing[category.categories_id] = category
+
+    to_create = [
+        Categories(categories_id=categories_id, description=description)
+        for categories_id, description in wanted.items() if categories_id not in existing
+    ]
+    to_update = []
+    for categories_id, category in existing.items():
+        description = wanted.get(categories_id)
+        if description is not None and category.description != description:
+            category.description = description
+            to_update.append(category)
+    gone = [category.id for categories_id, category in existing.items() if categories_id not in wanted]
+
+    with transaction.atomic():
+        Categories.objects.bulk_create(to_create, batch_size=500)
+        Categories.objects.bulk_update(to_update, ["description"], batch_size=500)
+        for kept_id, duplicate_ids in duplicates.items():
+            Actions.objects.filter(category_id__in=duplicate_ids).update(category_id=kept_id)
+            NetfreeTraffic.objects.filter(category_id__in=duplicate_ids).update(category_id=kept_id)
+            Categories.objects.filter(id__in=duplicate_ids).delete()
+        referenced = Categories.objects.filter(id__in=gone).filter(
+            Q(action_category__isnull=False) | Q(netfree_traffic__isnull=False)
+        ).values_list("id", flat=True).distinct()
+        kept = set(referenced)
+        deleted = [category_id for category_id in gone if category_id not in kept]
+        Categories.objects.filter(id__in=deleted).delete()
+    return {
+        "created": len(to_create), "updated": len(to_update), "deleted": len(deleted),
+        "kept_referenced": len(kept), "duplicates_removed": sum(len(duplicate_ids) for duplicate_ids in duplicates.values()),
+    }
+
+
+def sync_categories(job_id=None, force=False, netfree_api=None):
+    """Fetch the Netfree tag list and apply it unless it is unchanged since the last sync."""
+    set_job_status(job_id, "running")
+    response = (netfree_api or NetfreeAPI()).get_tags_list()
+    if response.status_code != 200:
+        result = {"error": f"tags list returned {response.status_code}"}
+        set_job_status(job_id, "failed", result=result)
+        return None
+    tags = response.json().get("list") or []
+    digest = tags_hash(tags)
+    if not force and cache.get(HASH_KEY) == digest:
+        result = {"skipped": True, "tags": len(tags)}
+    else:
+        result = apply_categories(tags)
+        result["tags"] = len(tags)
+        cache.set(HASH_KEY, digest, timeout=None)
+    cronjob_log.info(f"netfree category sync : {result}")
+    set_job_status(job_id, "done", result=result)
+    return result
@@ -0,0 +1,237 @@
+import imaplib
+import logging
+import random
+import select
+import ssl
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, close_old_connections
+from redis.exceptions import RedisError
+
+from crm.mail_ingest import IngestBusy, IngestLease, MailboxReader
+from crm.models import SMTPEmail
+
+cronjob_log = logging.getLogger('cronjob-log')
+cronjob_error_log = logging.getLogger('cronjob-error')
+
+HEARTBEAT_INTERVAL = 30
+
+
+def heartbeat_key(account_email):
+    return f"imap-idle:heartbeat:{account_email}"
+
+
+def idle_covers_all_accounts():
+    """Whether imap_idle is connected on every folder of every SMTPEmail account."""
+    keys = [heartbeat_key(email) for email in SMTPEmail.objects.values_list("email", flat=True).distinct()]
+    return bool(keys) and len(cache.get_many(keys)) == len(keys)
+
+
+class ImapIdleListener:
+    """Keep one IMAP connection in IDLE on a folder and ingest new mail as soon as it arrives.
+
+    After connecting, the folder is synced once to catch up, then the
+    connection idles. An untagged ``EXISTS`` ends the IDLE and the folder is
+    synced through MailboxReader, the same path the polling task uses, under
+    the same IngestLease so the two never ingest at the same time. IDLE is
+    re-issued every EMAIL_IDLE_TIMEOUT seconds, well inside the 29 minutes
+    servers allow. Dropped connections, and Redis or database errors while
+    syncing, are retried on a new connection with capped, jittered
+    exponential backoff.
+    """
+
+    def __init__(self, account, folder):
+        self.account = account
+        self.folder = folder
+        self.connected = False
+        self.idle_timeout = settings.EMAIL_IDLE_TIMEOUT
+        self.backoff_max = settings.EMAIL_IDLE_BACKOFF_MAX
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run_forever(self):
+        failures = 0
+        while not self.stopped:
+            started = time.monotonic()
+            try:
+                self.listen()
+            except (imaplib.IMAP4.error, OSError, RedisError, DatabaseError) as e:
+                if time.monotonic() - started > self.idle_timeout:
+                    # The connection worked for a while; start the backoff over.
+                    failures = 0
+                delay = random.uniform(0, min(self.backoff_max, 2 ** failures))
+                failures += 1
+                cronjob_error_log.error(f"imap idle connection lost : {e}. reconnecting in {delay:.1f}s")
+                time.sleep(delay)
+
+    def listen(self):
+        reader = MailboxReader(self.account)
+        imap_server = reader.connect()
+        folder = self.folder
+        try:
+            behind = not self.sync(reader, imap_server, folder)
+            self.connected = True
+            supports_idle = "IDLE" in imap_server.capabilities
+            if not supports_idle:
+                cronjob_log.info("imap server has no IDLE, polling with NOOP instead")
+            while not self.stopped:
+                if supports_idle:
+                    has_new = self.idle(imap_server)
+                else:
+                    time.sleep(settings.EMAIL_IDLE_POLL_INTERVAL)
+                    has_new = self.noop(imap_server)
+                if has_new or behind:
+                    behind = not self.sync(reader, imap_server, folder)
+        finally:
+            self.connected = False
+            try:
+                imap_server.logout()
+            except Exception:
+                pass
+
+    def sync(self, reader, imap_server, folder):
+        """Sync the folder under the ingestion lease; False if a read_emails run kept it."""
+        close_old_connections()
+        try:
+            with IngestLease(blocking_timeout=settings.EMAIL_INGEST_LEASE_WAIT):
+                reader.sync_folder(imap_server, folder)
+        except IngestBusy:
+            cronjob_log.info("read_emails still running, imap idle sync retried after the next IDLE")
+            return False
+        # Anything announced while syncing is already handled.
+        imap_server.untagged_responses.pop("EXISTS", None)
+        return True
+
+    def idle(self, imap_server):
+        """Run one IDLE cycle; True when the server announced new messages."""
+        tag = imap_server._new_tag()
+        imap_server.send(tag + b" IDLE\r\n")
+        line = imap_server.readline()
+        if not line.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"IDLE refused : {line!r}")
+
+        sock = imap_server.socket()
+        deadline = time.monotonic() + self.idle_timeout
+        has_new = False
+        while not has_new and not self.stopped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.buffered(imap_server) and not select.select([sock], [], [], min(remaining, 1.0))[0]:
+                continue
+            line = imap_server.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            has_new = line.startswith(b"*") and line.rstrip().endswith(b"EXISTS")
+
+        imap_server.send(b"DONE\r\n")
+        while True:
+            line = imap_server.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed while ending IDLE")
+            if line.startswith(tag):
+                imap_server.tagged_commands.pop(tag, None)
+                if not line[len(tag):].strip().startswith(b"OK"):
+                    raise imaplib.IMAP4.error(f"IDLE ended with : {line!r}")
+                return has_new
+            if line.startswith(b"*") and line.rstrip().endswith(b"EXISTS"):
+                has_new = True
+
+    def buffered(self, imap_server):
+        """Whether a response can be read without waiting on the socket.
+
+        readline() goes through a BufferedReader, so a line that came in the
+        same segment as the one before it is never seen by select(). peek()
+        on the non-blocking socket returns what is buffered there or already
+        decrypted by ssl, and nothing otherwise.
+        """
+        sock = imap_server.socket()
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            return bool(imap_server.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def noop(self, imap_server):
+        imap_server.noop()
+        exists = imap_server.untagged_responses.pop("EXISTS", None)
+        return bool(exists)
+
+
+class ImapIdleSupervisor:
+    """Run an ImapIdleListener thread for every folder of every account.
+
+    Folders come from MailboxReader.find_folders, as for read_emails; an
+    account whose folders cannot be listed yet is retried with the listeners'
+    backoff. Every HEARTBEAT_INTERVAL seconds each account whose listeners are
+    all connected is marked in the cache, and read_emails stays a safety net
+    only while every account is marked.
+    """
+
+    def __init__(self, accounts=None):
+        if accounts is None:
+            accounts = {account.email: account for account in SMTPEmail.objects.all()}.values()
+        self.accounts = list(accounts)
+        self.listeners = {account.email: None for account in self.accounts}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            for listeners in self.listeners.values():
+                for listener in listeners or []:
+                    listener.stop()
+
+    def run_forever(self):
+        for account in self.accounts:
+            threading.Thread(target=self.watch_account, args=(account,), name=f"imap-idle-{account.email}", daemon=True).start()
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            self.heartbeat()
+
+    def watch_account(self, account):
+        failures = 0
+        while not self.stopped.is_set():
+            reader = MailboxReader(account)
+            try:
+                imap_server = reader.connect()
+                try:
+                    folders = reader.find_folders(imap_server)
+                finally:
+                    imap_server.logout()
+                break
+            except (imaplib.IMAP4.error, OSError) as e:
+                delay = random.uniform(0, min(settings.EMAIL_IDLE_BACKOFF_MAX, 2 ** failures))
+                failures += 1
+                cronjob_error_log.error(f"imap idle could not list folders of {account.email} : {e}. retrying in {delay:.1f}s")
+                self.stopped.wait(delay)
+        else:
+            return
+        listeners = [ImapIdleListener(account, folder) for folder in folders]
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            self.listeners[account.email] = listeners
+        for listener in listeners:
+            threading.Thread(target=listener.run_forever, name=f"imap-idle-{account.email}-{listener.folder}", daemon=True).start()
+        cronjob_log.info(f"imap idle listening on {account.email} {folders}")
+
+    def heartbeat(self):
+        with self.lock:
+            ready = [
+                email for email, listeners in self.listeners.items()
+                if listeners and all(listener.connected for listener in listeners)
+            ]
+        try:
+            cache.set_many({heartbeat_key(email): 1 for email in ready}, timeout=HEARTBEAT_INTERVAL * 3)
+        except Exception as e:
+            cronjob_error_log.error(f"imap idle heartbeat failed : {e}")
+
@@ -0,0 +1,744 @@
+import email
+import imaplib
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+from utils.helper import capture_error, get_netfree_traffic_data
+from utils.imap_fetch import (decode_part, parse_fetch_response,
+                              text_part_section, uid_set)
+from utils.netfree_async import netfree_fan_out
+from utils.netfree_metrics import metrics
+
+from crm.mail_parse import (TRAFFIC_VIEW_PREFIX, RawMessage, decode_words,
+                            is_request_subject, parse_raw_message, timed_parse)
+from crm.models import (DeadLetter, Emailrequest, MailboxSyncState,
+                        NetfreeCategoriesProfile, NetfreeTraffic, SMTPEmail)
+
+cronjob_log = logging.getLogger('cronjob-log')
+cronjob_error_log = logging.getLogger('cronjob-error')
+
+ALL_MAIL = '"[Gmail]/All Mail"'
+REQUESTS_LABEL = '"[Gmail]/&BdsF3A- &BdQF0wXVBdAF6A-"'
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE MESSAGE-ID)]"
+
+# Emitted by MailboxReader.folder_items after each batch: every request read
+# before it is written once the writer reaches it, so last_uid may advance.
+Checkpoint = namedtuple("Checkpoint", ["account", "folder", "state_id", "last_uid", "pending", "fetch_seconds"])
+
+
+def dead_letter(message, stage, error):
+    """Keep a failed RawMessage or parsed record as a DeadLetter for replay_dead_letters."""
+    fields = message._asdict() if isinstance(message, RawMessage) else message
+    cronjob_error_log.error(f"uid {fields['uid']} in {fields['account']} {fields['folder']} failed at {stage} : {error}")
+    DeadLetter.record(
+        fields["account"], fields["folder"], fields["uid"], fields.get("uidvalidity"), stage, error,
+        message_id=fields.get("message_id"),
+    )
+
+
+class IngestBusy(Exception):
+    """Another ingestion run holds the lease."""
+
+
+class IngestLeaseLost(Exception):
+    """The lease expired under a running ingestion; another run may have started."""
+
+
+class IngestLease:
+    """Redis lease that keeps mail ingestion runs from overlapping.
+
+    The lease is a redis lock with a random token and an EMAIL_INGEST_LEASE_TIMEOUT
+    expiry, so a crashed holder frees it by itself. While it is held, a
+    heartbeat thread renews it every third of the timeout; renewal only
+    succeeds while the token still matches. If a renewal fails the lease is
+    ``lost`` and another run may already be ingesting the same folders;
+    ``check`` then raises IngestLeaseLost so the holder stops before it
+    writes more.
+    """
+
+    KEY = "mail-ingest:lease"
+
+    def __init__(self, blocking_timeout=None):
+        self.timeout = settings.EMAIL_INGEST_LEASE_TIMEOUT
+        self.lock = get_redis_connection("default").lock(
+            self.KEY, timeout=self.timeout, blocking_timeout=blocking_timeout,
+            # The heartbeat thread renews with the token acquire() stored.
+            thread_local=False,
+        )
+        self.blocking = blocking_timeout is not None
+        self.lost = False
+        self.stopped = threading.Event()
+        self.heartbeat = None
+
+    def __enter__(self):
+        if not self.lock.acquire(blocking=self.blocking):
+            raise IngestBusy("mail ingestion is already running")
+        self.heartbeat = threading.Thread(target=self.renew, name="mail-ingest-lease", daemon=True)
+        self.heartbeat.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_renewing()
+        try:
+            self.lock.release()
+        except Exception as e:
+            cronjob_error_log.error(f"mail ingest lease release failed : {e}")
+        return False
+
+    def check(self):
+        if self.lost:
+            raise IngestLeaseLost("mail ingest lease lost, another run may overlap")
+
+    def stop_renewing(self):
+        """Stop the heartbeat; the lease then expires unless released first."""
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+
+    def renew(self):
+        while not self.stopped.wait(self.timeout / 3):
+            try:
+                self.lock.reacquire()
+            except Exception as e:
+                self.lost = True
+                cronjob_error_log.error(f"mail ingest lease lost, another run may overlap : {e}")
+                return
+
+
+class MailboxReader:
+    """Reads Netfree requests from one mail account.
+
+    ``folder_items`` only talks IMAP: it yields the raw candidate messages
+    and checkpoints, so several readers can feed the parse and write stages
+    of MailIngestCoordinator. The IMAP IDLE listener calls ``sync_folder``,
+    which runs all three stages inline on a single connection.
+    """
+
+    def __init__(self, account=None):
+        self.account = account or SMTPEmail.objects.last()
+        self.account_name = self.account.email if self.account else ""
+
+    def connect(self):
+        imap_server = imaplib.IMAP4_SSL(settings.SMTP_SERVER)
+        email_address = self.account.email if self.account else ""
+        password = self.account.password if self.account else ""
+        login_result = imap_server.login(email_address, password)
+        if login_result[0] != 'OK':
+            raise imaplib.IMAP4.error(f"login failed for {email_address}")
+        return imap_server
+
+    def find_folders(self, imap_server):
+        if settings.EMAIL_INGEST_FOLDERS:
+            return list(settings.EMAIL_INGEST_FOLDERS)
+        status, mailbox_list = imap_server.list()
+        mail_box = ALL_MAIL
+        if status == "OK":
+            for i in mailbox_list:
+                if REQUESTS_LABEL in str(i):
+                    mail_box = REQUESTS_LABEL
+        return [mail_box]
+
+    def sync_folder(self, imap_server, folder):
+        writer = RequestWriter()
+        for item in self.folder_items(imap_server, folder):
+            if isinstance(item, RawMessage):
+                try:
+                    item = parse_raw_message(item)
+                except Exception as e:
+                    dead_letter(item, "parse", e)
+                    continue
+            writer.handle(item)
+
+    def folder_items(self, imap_server, folder):
+        """Yield the candidate messages with a UID above the folder's MailboxSyncState.last_uid
+        as RawMessage, with a Checkpoint after every batch of EMAIL_FETCH_BATCH_SIZE UIDs.
+
+        When the folder's UIDVALIDITY changes (or on the first sync) the stored
+        UIDs mean nothing any more, so the folder starts over from today's mail.
+        """
+        imap_server.select(folder)
+        uidvalidity = self.response_number(imap_server, "UIDVALIDITY")
+        highestmodseq = self.response_number(imap_server, "HIGHESTMODSEQ")
+        state, _ = MailboxSyncState.objects.get_or_create(account=self.account_name, folder=folder)
+
+        if state.uidvalidity != uidvalidity:
+            if state.uidvalidity is not None:
+                cronjob_log.info(f"{self.account_name} {folder} UIDVALIDITY changed {state.uidvalidity} -> {uidvalidity}, syncing again from today")
+            state.uidvalidity = uidvalidity
+            state.last_uid = 0
+            today = datetime.now().strftime('%d-%b-%Y')
+            status, data = imap_server.uid('SEARCH', None, f'(SINCE "{today}")')
+        else:
+            status, data = imap_server.uid('SEARCH', None, f'UID {state.last_uid + 1}:*')
+        state.highestmodseq = highestmodseq
+        state.save()
+
+        # "n:*" always matches the newest message, even when its UID is below n.
+        uids = sorted(uid for uid in map(int, data[0].split()) if uid > state.last_uid) if status == 'OK' else []
+        if not uids:
+            cronjob_log.info(f"no new emails in {self.account_name} {folder}")
+            yield Checkpoint(self.account_name, folder, state.pk, state.last_uid, 0, 0.0)
+            return
+        cronjob_log.info(f"{len(uids)} mail recived in {self.account_name} {folder}, uids {uids[0]}..{uids[-1]}")
+        batch_size = settings.EMAIL_FETCH_BATCH_SIZE
+        for start in range(0, len(uids), batch_size):
+            batch = uids[start:start + batch_size]
+            fetch_started = time.perf_counter()
+            raw_messages = self.fetch_requests(imap_server, folder, batch, uidvalidity)
+            fetch_seconds = time.perf_counter() - fetch_started
+            yield from raw_messages
+            yield Checkpoint(self.account_name, folder, state.pk, batch[-1], len(uids) - start - len(batch), fetch_seconds)
+
+    def response_number(self, imap_server, name):
+        _, values = imap_server.response(name)
+        try:
+            return int(values[-1])
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def fetch_requests(self, imap_server, folder, uids, uidvalidity=None):
+        """RawMessage for each message in ``uids`` that looks like a request.
+
+        One FETCH brings the headers and BODYSTRUCTURE of the whole batch, then
+        only the text part of each message is downloaded. A message is a
+        candidate when its subject matches or its text part holds a traffic
+        recording link. The link is looked for here rather than with IMAP
+        SEARCH BODY, which Gmail matches on words and not on substrings.
+        Everything is read with BODY.PEEK, so the messages stay unread in the
+        mailbox.
+        """
+        status, data = imap_server.uid('FETCH', uid_set(uids), f'(UID BODYSTRUCTURE {HEADER_FIELDS})')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"header fetch failed for uids {uids[0]}..{uids[-1]}")
+
+        candidates = {}
+        for uid, fetched in parse_fetch_response(data).items():
+            header = email.message_from_bytes(fetched["header"] or b"")
+            subject_match = is_request_subject(decode_words(header.get('Subject')))
+            part = text_part_section(fetched["bodystructure"])
+            if part is None:
+                if subject_match:
+                    cronjob_log.info(f"uid {uid} has no text part, skipped")
+                continue
+            candidates[uid] = (fetched["header"], part, subject_match)
+
+        sections = {}
+        for uid, (_, part, _) in candidates.items():
+            sections.setdefault(part["section"], []).append(uid)
+        bodies = {}
+        for section, section_uids in sections.items():
+            status, data = imap_server.uid('FETCH', uid_set(section_uids), f'(UID BODY.PEEK[{section}])')
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"body fetch failed for uids {section_uids[0]}..{section_uids[-1]}")
+            for uid, fetched in parse_fetch_response(data).items():
+                bodies[uid] = fetched["sections"].get(section)
+
+        raw_messages = []
+        for uid in sorted(candidates):
+            header, part, subject_match = candidates[uid]
+            raw_message = RawMessage(self.account_name, folder, uid, uidvalidity, header, bodies.get(uid), part["encoding"], part["charset"])
+            if raw_message.body is None:
+                dead_letter(raw_message, "fetch", f"BODY[{part['section']}] missing from fetch response")
+                continue
+            if not subject_match and TRAFFIC_VIEW_PREFIX not in decode_part(raw_message.body, part["encoding"], part["charset"]):
+                continue
+            raw_messages.append(raw_message)
+        return raw_messages
+
+
+def warm_category_cache(urls):
+    """Look the categories of ``urls`` up concurrently so each request's task hits category_cache."""
+    try:
+        results = netfree_fan_out("search_category", urls)
+    except Exception as e:
+        cronjob_error_log.error(f"category lookup for {len(urls)} traffic urls failed : {e}")
+        return
+    failed = sum(isinstance(result, Exception) for result in results)
+    if failed:
+        cronjob_error_log.error(f"category lookup failed for {failed} of {len(urls)} traffic urls")
+
+
+def legacy_requests(rows):
+    """``(email_id, created_at)`` of the mails among ``rows`` that are already stored
+    without an ingest_key, i.e. were ingested before the key existed."""
+    if not rows:
+        return set()
+    stored = Emailrequest.objects.filter(
+        ingest_key__isnull=True,
+        email_id__in={row.email_id for row in rows},
+        created_at__in={row.created_at for row in rows},
+    ).values_list("email_id", "created_at")
+    return set(stored)
+
+
+def insert_new_requests(rows):
+    """Insert Emailrequest rows with ON CONFLICT (ingest_key) DO NOTHING; returns the new ones.
+
+    Rows skip save() and post_save, so they must be filled in beforehand (see
+    RequestWriter.build_requests). Mails that already have rows without an
+    ingest_key are skipped the way update_or_create used to match them, on
+    ``(email_id, created_at)``. netfree_traffic_record is enqueued here, once
+    the transaction commits and only for the rows actually inserted.
+    """
+    from crm.netfree_sync import customer_queue
+    from crm.tasks import netfree_traffic_record
+
+    rows = list({row.ingest_key: row for row in rows}.values())
+    legacy = legacy_requests(rows)
+    rows = [row for row in rows if (row.email_id, row.created_at) not in legacy]
+    meta = Emailrequest._meta
+    fields = [field for field in meta.concrete_fields if not field.primary_key]
+    quote = connection.ops.quote_name
+    columns = ", ".join(quote(field.column) for field in fields)
+    row_sql = "(" + ", ".join(["%s"] * len(fields)) + ")"
+    inserted = []
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), settings.EMAIL_INSERT_BATCH_SIZE):
+                chunk = rows[start:start + settings.EMAIL_INSERT_BATCH_SIZE]
+                params = [field.get_db_prep_save(field.pre_save(row, True), connection) for row in chunk for field in fields]
+                cursor.execute(
+                    f"INSERT INTO {quote(meta.db_table)} ({columns}) VALUES {', '.join([row_sql] * len(chunk))} "
+                    f"ON CONFLICT ({quote(meta.get_field('ingest_key').column)}) DO NOTHING "
+                    f"RETURNING {quote(meta.pk.column)}, {quote(meta.get_field('ingest_key').column)}",
+                    params,
+                )
+                ids = {ingest_key: pk for pk, ingest_key in cursor.fetchall()}
+                for row in chunk:
+                    if row.ingest_key in ids:
+                        row.pk = ids[row.ingest_key]
+                        row._state.adding = False
+                        row._state.db = connection.alias
+                        inserted.append(row)
+
+        def enqueue(row):
+            try:
+                netfree_traffic_record.apply_async(args=[row.id], queue=customer_queue(row.customer_id))
+            except Exception as e:
+                cronjob_error_log.error(f"requested id: {row.id} An error occurred during email processing: {str(e)}")
+
+        for row in inserted:
+            cronjob_log.debug(f"Cronjob email request created {row.id} at {datetime.now()}")
+            transaction.on_commit(lambda row=row: enqueue(row))
+    return inserted
+
+
+class RequestWriter:
+    """Single consumer of MailboxReader.folder_items output.
+
+    Requests are deduplicated by Message-ID within the run and collected until
+    the next Checkpoint, then inserted in one go with insert_new_requests.
+    The unique ingest_key (Message-ID + url) makes re-ingesting a mail, from
+    another folder, account or run, a no-op. After the insert the folder's
+    last_uid moves forward and its lag is reported to the metrics.
+    """
+
+    def __init__(self):
+        self.seen = set()
+        self.pending = []
+        self.pending_records = []
+        self.oldest = {}
+        self.lag = {}
+        self.stats = {"written": 0, "duplicates": 0, "errors": 0}
+
+    def handle(self, item):
+        if item is None:
+            return
+        if isinstance(item, Checkpoint):
+            self.checkpoint(item)
+            return
+        if item["message_id"] in self.seen:
+            self.stats["duplicates"] += 1
+            return
+        self.seen.add(item["message_id"])
+        try:
+            self.pending.extend(self.build_requests(item))
+        except Exception as e:
+            self.stats["errors"] += 1
+            dead_letter(item, "persist", e)
+            return
+        self.pending_records.append(item)
+        folder_key = (item["account"], item["folder"])
+        self.oldest[folder_key] = min(self.oldest.get(folder_key, item["created_at"]), item["created_at"])
+
+    def checkpoint(self, item):
+        self.flush()
+        MailboxSyncState.objects.filter(pk=item.state_id).update(last_uid=item.last_uid)
+        lag = self.lag.pop((item.account, item.folder), 0)
+        metrics.observe_mailbox(item.account, item.folder, item.pending, lag)
+
+    def flush(self):
+        rows, self.pending = self.pending, []
+        records, self.pending_records = self.pending_records, []
+        oldest, self.oldest = self.oldest, {}
+        if not rows:
+            return
+        try:
+            inserted = insert_new_requests(rows)
+        except Exception as e:
+            self.stats["errors"] += len(records)
+            for record in records:
+                dead_letter(record, "persist", e)
+            return
+        self.stats["written"] += len(inserted)
+        self.stats["duplicates"] += len(rows) - len(inserted)
+        now = timezone.now()
+        for folder_key, created_at in oldest.items():
+            self.lag[folder_key] = max(self.lag.get(folder_key, 0), (now - created_at).total_seconds())
+
+    def build_requests(self, record):
+        """Unsaved Emailrequest rows for one parsed mail: one per url of a traffic
+        recording, otherwise one for the requested website."""
+        message_id = record["message_id"]
+        if record["website_url"].startswith(TRAFFIC_VIEW_PREFIX):
+            rows = self.traffic_requests(record)
+        else:
+            rows = [Emailrequest(
+                email_id=record["uid"], sender_email=record["sender_email"], username=record["username"],
+                customer_id=record["customer_id"], requested_website=record["website_url"],
+                text=record["body"], created_at=record["created_at"], ticket_id=15665,
+            )]
+        if rows:
+            # All rows of a mail belong to one customer; look their profile up once.
+            rows[0].fill_customer_profile()
+        for row in rows:
+            row.username, row.sender_email = rows[0].username, rows[0].sender_email
+            row.message_id = message_id[:255]
+            row.normalize_website()
+            row.ingest_key = Emailrequest.make_ingest_key(message_id, row.requested_website)
+        return rows
+
+    def traffic_requests(self, record):
+        from clients.models import NetfreeUser
+        traffic_data = get_netfree_traffic_data(record["website_url"])
+        if not traffic_data:
+            raise ValueError(f"traffic record {record['website_url']} could not be fetched")
+        data, custumer_id = traffic_data
+        client = NetfreeUser.objects.filter(user_id=custumer_id).first()
+        if client:
+            netfree_traffic = NetfreeTraffic.objects.get(is_default=True, netfree_profile=client.netfree_profile)
+        else:
+            default_netfree_categories, _ = NetfreeCategoriesProfile.objects.get_or_create(is_default=True)
+            netfree_traffic, created = NetfreeTraffic.objects.get_or_create(is_default=True, netfree_profile=default_netfree_categories)
+        if not netfree_traffic.is_active:
+            return []
+        blocked_urls = dict.fromkeys(data["sector_block"] + data["netfree_url"])
+        # Every url becomes its own request whose task looks its categories up;
+        # resolve them all at once here instead of one task at a time.
+        warm_category_cache([url.replace("https://", "http://", 1) for url in blocked_urls])
+        return [
+            Emailrequest(email_id=record["uid"], requested_website=url, created_at=record["created_at"], sender_email=record["sender_email"],
+                         username=record["username"], customer_id=str(custumer_id), request_type="טיפול בהקלטות תעבורה",
+                         text=record["body"], ticket_id=15665)
+            for url in blocked_urls
+        ]
+
+
+class MailIngestCoordinator:
+    """Ingest every SMTPEmail account and folder in one run.
+
+    The run is a three stage pipeline:
+
+    * fetch: each (account, folder) gets its own IMAP connection in a pool of
+      EMAIL_INGEST_WORKERS threads, which put RawMessage and Checkpoint items
+      on a queue of EMAIL_INGEST_QUEUE_SIZE. A full queue blocks the readers.
+    * parse: MIME and header decoding runs in EMAIL_PARSE_PROCESSES worker
+      processes, at most EMAIL_PARSE_IN_FLIGHT at a time. It runs inline when
+      that is 0 or the run is in a daemon process, which may not start
+      children: a prefork Celery worker. EMAIL_INGEST_QUEUE moves read_emails
+      to a solo worker, where the pool runs.
+    * persist: a single RequestWriter in the calling thread takes the results
+      in queue order, so a folder's Checkpoint is only applied after the
+      requests fetched before it are written.
+
+    A slow database therefore fills the queue instead of stalling IMAP
+    connections mid-command. Each stage's message count and busy time are
+    logged and added to the mail ingest metrics. If the persist stage fails,
+    ``stopping`` is set: readers give up instead of waiting on the full
+    queue, and the lease stops being renewed while they wind down.
+    """
+
+    DONE = object()
+    PUT_TIMEOUT = 0.5
+
+    def __init__(self, accounts=None, workers=None, processes=None):
+        if accounts is None:
+            accounts = {account.email: account for account in SMTPEmail.objects.all()}.values()
+        self.accounts = list(accounts)
+        self.workers = workers or settings.EMAIL_INGEST_WORKERS
+        self.processes = settings.EMAIL_PARSE_PROCESSES if processes is None else processes
+        self.max_in_flight = settings.EMAIL_PARSE_IN_FLIGHT
+        self.writer = RequestWriter()
+        self.stopping = threading.Event()
+        self.stages = {stage: {"messages": 0, "bytes": 0, "seconds": 0.0} for stage in ("fetch", "parse", "persist")}
+
+    def run(self):
+        """Ingest all folders under the IngestLease; None when another run holds it."""
+        started = time.monotonic()
+        try:
+            with IngestLease() as lease:
+                stats = self.ingest(lease)
+                lease.check()
+        except IngestBusy:
+            metrics.observe_ingest_run("skipped")
+            cronjob_log.info(f"Cronjob skipped at {datetime.now()} : previous run still going")
+            return None
+        except IngestLeaseLost:
+            metrics.observe_ingest_run("lease_lost", time.monotonic() - started)
+            cronjob_error_log.error(f"Cronjob stopped at {datetime.now()} : ingest lease lost, checkpoints after it were not saved")
+            return None
+        metrics.observe_ingest_run("completed", time.monotonic() - started)
+        return stats
+
+    def ingest(self, lease=None):
+        started = time.monotonic()
+        cronjob_log.info(f"Cronjob start at {datetime.now()} for {len(self.accounts)} accounts")
+        items = queue.Queue(maxsize=settings.EMAIL_INGEST_QUEUE_SIZE)
+        parsers = None
+        if self.processes and multiprocessing.current_process().daemon:
+            # Celery prefork children are daemonic and may not start processes.
+            cronjob_log.info("Cronjob running in a daemon process, parsing inline (see EMAIL_INGEST_QUEUE)")
+        elif self.processes:
+            # spawn: the readers are threads, and crm.mail_parse needs no Django setup.
+            parsers = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                folders = [
+                    (account, folder)
+                    for account, account_folders in zip(self.accounts, pool.map(self.list_folders, self.accounts))
+                    for folder in account_folders
+                ]
+                for account, folder in folders:
+                    pool.submit(self.read_folder, account, folder, items)
+                try:
+                    self.drain(items, parsers, len(folders), lease)
+                except BaseException:
+                    self.stopping.set()
+                    if lease is not None:
+                        lease.stop_renewing()
+                    raise
+        finally:
+            if parsers is not None:
+                parsers.shutdown()
+        elapsed = time.monotonic() - started
+        for stage, counters in self.stages.items():
+            metrics.observe_ingest_stage(stage, counters["messages"], counters["seconds"], counters["bytes"])
+            counters["per_second"] = round(counters["messages"] / elapsed, 2) if elapsed else 0.0
+        cronjob_log.info(f"Cronjob done at {datetime.now()} : {len(folders)} folders in {elapsed:.1f}s, {self.writer.stats}, stages {self.stages}")
+        return {**self.writer.stats, "stages": self.stages}
+
+    def drain(self, items, parsers, readers, lease=None):
+        in_flight = deque()
+        while readers or in_flight:
+            head = in_flight[0] if in_flight else None
+            if head is not None and (
+                not readers or len(in_flight) >= self.max_in_flight
+                or isinstance(head, Checkpoint) or head.done()
+            ):
+                if lease is not None and isinstance(head, Checkpoint):
+                    # Another run may own the folder now; don't move last_uid under it.
+                    lease.check()
+                self.persist(in_flight.popleft())
+                continue
+            try:
+                item = items.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is self.DONE:
+                readers -= 1
+            elif isinstance(item, RawMessage):
+                self.stages["fetch"]["messages"] += 1
+                self.stages["fetch"]["bytes"] += len(item.header or b"") + len(item.body or b"")
+                in_flight.append(self.submit_parse(parsers, item))
+            else:
+                self.stages["fetch"]["seconds"] += item.fetch_seconds
+                in_flight.append(item)
+
+    def submit_parse(self, parsers, raw):
+        if parsers is not None:
+            future = parsers.submit(timed_parse, raw)
+        else:
+            future = Future()
+            try:
+                future.set_result(timed_parse(raw))
+            except Exception as e:
+                future.set_exception(e)
+        future.raw = raw
+        return future
+
+    def persist(self, item):
+        if not isinstance(item, Checkpoint):
+            try:
+                record, seconds = item.result()
+            except Exception as e:
+                dead_letter(item.raw, "parse", e)
+                return
+            self.stages["parse"]["messages"] += 1
+            self.stages["parse"]["seconds"] += seconds
+            if record is None:
+                return
+            item = record
+        started = time.perf_counter()
+        self.writer.handle(item)
+        if not isinstance(item, Checkpoint):
+            self.stages["persist"]["messages"] += 1
+            self.stages["persist"]["seconds"] += time.perf_counter() - started
+
+    def list_folders(self, account):
+        reader = MailboxReader(account)
+        try:
+            imap_server = reader.connect()
+            try:
+                return reader.find_folders(imap_server)
+            finally:
+                imap_server.logout()
+        except Exception as e:
+            cronjob_log.info(f"Cronjob Login failed for {reader.account_name} at {datetime.now()} : {e}")
+            return []
+        finally:
+            connection.close()
+
+    def put(self, items, item):
+        """Queue ``item`` unless the run is stopping; False when it was dropped."""
+        while not self.stopping.is_set():
+            try:
+                items.put(item, timeout=self.PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_folder(self, account, folder, items):
+        if self.stopping.is_set():
+            return
+        reader = MailboxReader(account)
+        try:
+            imap_server = reader.connect()
+            try:
+                for item in reader.folder_items(imap_server, folder):
+                    if not self.put(items, item):
+                        break
+            finally:
+                imap_server.logout()
+        except Exception as e:
+            cronjob_error_log.error(f"Cronjob error : {reader.account_name} {folder} : {str(e)}")
+            cronjob_error_log.error(f"Cronjob error exception: {capture_error(sys.exc_info())}")
+        finally:
+            connection.close()
+            self.put(items, self.DONE)
+
+
+class DeadLetterReplay:
+    """Fetch the mails behind open DeadLetter rows again and push them through ingestion.
+
+    Letters are grouped by account, folder and UIDVALIDITY. Each group gets
+    its own IMAP connection in a pool of ``workers`` threads and is fetched
+    in batches of ``batch_size`` UIDs; parsing and writing happen in the
+    calling thread through a RequestWriter, under the IngestLease. A letter
+    is resolved once its mail came back as a request and was written without
+    failing again (a new failure bumps ``attempts`` instead). Letters whose
+    mail is gone or no longer looks like a request, and letters whose folder
+    has a new UIDVALIDITY, are counted as skipped and left open.
+    """
+
+    DONE = object()
+
+    def __init__(self, batch_size=None, workers=None, stage=None, limit=None):
+        self.batch_size = batch_size or settings.EMAIL_FETCH_BATCH_SIZE
+        self.workers = workers or settings.EMAIL_INGEST_WORKERS
+        self.stage = stage
+        self.limit = limit
+        self.writer = RequestWriter()
+        self.stats = {"letters": 0, "resolved": 0, "failed": 0, "skipped": 0}
+
+    def letters(self):
+        letters = DeadLetter.objects.filter(resolved_at__isnull=True).order_by("id")
+        if self.stage:
+            letters = letters.filter(stage=self.stage)
+        if self.limit:
+            letters = letters[:self.limit]
+        return list(letters)
+
+    def run(self):
+        groups = {}
+        for letter in self.letters():
+            groups.setdefault((letter.account, letter.folder, letter.uidvalidity), []).append(letter)
+            self.stats["letters"] += 1
+        accounts = {account.email: account for account in SMTPEmail.objects.all()}
+        items = queue.Queue(maxsize=settings.EMAIL_INGEST_QUEUE_SIZE)
+        with IngestLease(blocking_timeout=settings.EMAIL_INGEST_LEASE_WAIT):
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for (account, folder, uidvalidity), letters in groups.items():
+                    pool.submit(self.fetch_group, accounts.get(account), folder, uidvalidity, letters, items)
+                remaining = len(groups)
+                returned = set()
+                while remaining:
+                    item = items.get()
+                    if item is self.DONE:
+                        remaining -= 1
+                    elif isinstance(item, RawMessage):
+                        try:
+                            record = parse_raw_message(item)
+                        except Exception as e:
+                            dead_letter(item, "parse", e)
+                            continue
+                        if record is not None:
+                            self.writer.handle(record)
+                            returned.add((item.account, item.folder, item.uid))
+                    else:
+                        self.finish_batch(*item, returned)
+        cronjob_log.info(f"dead letter replay : {self.stats}, writer {self.writer.stats}")
+        return self.stats
+
+    def fetch_group(self, account, folder, uidvalidity, letters, items):
+        try:
+            if account is None:
+                cronjob_error_log.error(f"dead letters of {letters[0].account} skipped : no SMTPEmail for it")
+                self.stats["skipped"] += len(letters)
+                return
+            reader = MailboxReader(account)
+            imap_server = reader.connect()
+            try:
+                imap_server.select(folder)
+                current = reader.response_number(imap_server, "UIDVALIDITY")
+                if uidvalidity is not None and current != uidvalidity:
+                    cronjob_error_log.error(f"dead letters of {account.email} {folder} skipped : UIDVALIDITY is {current}, not {uidvalidity}")
+                    self.stats["skipped"] += len(letters)
+                    return
+                for start in range(0, len(letters), self.batch_size):
+                    batch = letters[start:start + self.batch_size]
+                    started = timezone.now()
+                    uids = sorted({letter.uid for letter in batch})
+                    for raw_message in reader.fetch_requests(imap_server, folder, uids, uidvalidity):
+                        items.put(raw_message)
+                    items.put((batch, started))
+            finally:
+                imap_server.logout()
+        except Exception as e:
+            cronjob_error_log.error(f"dead letter replay of {letters[0].account} {folder} failed : {e}")
+            cronjob_error_log.error(f"Cronjob error exception: {capture_error(sys.exc_info())}")
+        finally:
+            connection.close()
+            items.put(self.DONE)
+
+    def finish_batch(self, letters, started, returned):
+        self.writer.flush()
+        ids = [letter.pk for letter in letters]
+        came_back = [letter.pk for letter in letters if (letter.account, letter.folder, letter.uid) in returned]
+        # Letters that failed again were updated by DeadLetter.record after ``started``.
+        resolved = DeadLetter.objects.filter(pk__in=came_back, updated_at__lt=started).update(resolved_at=timezone.now())
+        failed = DeadLetter.objects.filter(pk__in=ids, updated_at__gte=started).count()
+        self.stats["resolved"] += resolved
+        self.stats["failed"] += failed
+        self.stats["skipped"] += len(ids) - resolved - failed
@@ -0,0 +1,104 @@
+"""Turning fetched request mail into Emailrequest fields.
+
+Nothing here touches Django or the database: ``parse_raw_message`` runs in
+the worker processes of MailIngestCoordinator, which are started with
+``spawn`` and only import this module.
+"""
+import email
+import email.header
+import email.utils
+import hashlib
+import re
+import time
+from collections import namedtuple
+from datetime import timezone
+
+from utils.imap_fetch import decode_part
+
+TRAFFIC_VIEW_PREFIX = "https://netfree.link/app/#/tools/traffic/view"
+# Request subjects are "<prefix>#<customer id>"; the prefix is matched reversed
+REQUEST_SUBJECT = " שמתשמ תאמ הינפ"
+URL_PATTERN = re.compile(r'(https?://\S+)')
+
+# One candidate message as it comes off the IMAP connection: the raw header
+# block and the raw (still transfer-encoded) text part.
+RawMessage = namedtuple("RawMessage", ["account", "folder", "uid", "uidvalidity", "header", "body", "encoding", "charset"])
+
+
+def decode_words(value):
+    """Join the parts of an RFC 2047 encoded header into a single string."""
+    text = ""
+    for part, encoding in email.header.decode_header(value or ""):
+        if isinstance(part, bytes):
+            text += part.decode(encoding or 'utf-8', errors='ignore')
+        else:
+            text += part
+    return text
+
+
+def is_request_subject(subject):
+    target_sub = subject.split("#")[0][::-1]
+    return len(target_sub) > 0 and target_sub in REQUEST_SUBJECT
+
+
+def split_sender(value):
+    try:
+        username = value.split("<")[0]
+        sender_email = value.split("<")[-1].replace(">", "")
+    except Exception:
+        username = ""
+        sender_email = value
+    return decode_words(username), sender_email
+
+
+def parse_date(value):
+    """An aware datetime for a Date header, with or without weekday or comment."""
+    created_at = email.utils.parsedate_to_datetime(value)
+    if created_at.tzinfo is None:
+        # "-0000" means the zone is unknown; the time itself is UTC.
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at
+
+
+def fallback_message_id(header, body):
+    """A Message-ID for mail sent without one, derived from the mail itself
+    and not its folder or UID, so the copy under a Gmail label still matches
+    the one in INBOX."""
+    digest = hashlib.sha256()
+    for value in (header['From'], header['Date'], header['Subject'], body):
+        digest.update(f"{value or ''}\n".encode())
+    return f"<{digest.hexdigest()}@no-message-id>"
+
+
+def parse_raw_message(raw):
+    """The Emailrequest fields of a RawMessage, or None if it is not a request."""
+    header = email.message_from_bytes(raw.header or b"")
+    subject = decode_words(header.get('Subject'))
+    body = decode_part(raw.body, raw.encoding, raw.charset)
+    match = URL_PATTERN.search(body)
+    website_url = ""
+    if match:
+        website_url = match.group(1)
+    if not is_request_subject(subject) and not website_url.startswith(TRAFFIC_VIEW_PREFIX):
+        return None
+    username, sender_email = split_sender(header['From'])
+    return {
+        "account": raw.account,
+        "folder": raw.folder,
+        "uid": raw.uid,
+        "uidvalidity": raw.uidvalidity,
+        "message_id": (header['Message-ID'] or "").strip() or fallback_message_id(header, body),
+        "customer_id": subject.split("#")[-1],
+        "sender_email": sender_email,
+        "username": username,
+        "created_at": parse_date(header['Date']),
+        "website_url": website_url,
+        "body": body,
+    }
+
+
+def timed_parse(raw):
+    """``(parse_raw_message(raw), seconds spent)``, for the parse stage counters."""
+    started = time.perf_counter()
+    record = parse_raw_message(raw)
+    return record, time.perf_counter() - started
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from utils.netfree_fake_server import make_server
+
+
+class Command(BaseCommand):
+    help = "Run a local fake netfree.link server. Point NETFREE_BASE_URL at it."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--customers", type=int, default=200)
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+        parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- seconds on top of --latency")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 500")
+        parser.add_argument("--rate-limit", type=int, default=0, help="Requests per second before answering 429")
+        parser.add_argument("--traffic-size", type=int, default=40, help="Entries per traffic record")
+
+    def handle(self, *args, **options):
+        server = make_server(
+            options["host"], options["port"],
+            seed=options["seed"], customers=options["customers"],
+            latency=options["latency"], jitter=options["jitter"],
+            error_rate=options["error_rate"], rate_limit=options["rate_limit"],
+            traffic_size=options["traffic_size"],
+        )
+        self.stdout.write(f"Fake netfree running on http://{options['host']}:{options['port']} (stats at /__stats)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,24 @@
+from crm.imap_idle import ImapIdleSupervisor
+from crm.models import SMTPEmail
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Listen for new request emails with IMAP IDLE on every folder and ingest them as they arrive."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--account", help="SMTPEmail address to listen on (default: all of them)")
+
+    def handle(self, *args, **options):
+        accounts = None
+        if options["account"]:
+            account = SMTPEmail.objects.filter(email=options["account"]).last()
+            if account is None:
+                raise CommandError(f"No SMTPEmail {options['account']}.")
+            accounts = [account]
+        supervisor = ImapIdleSupervisor(accounts)
+        self.stdout.write("Listening for new mail, Ctrl+C to stop.")
+        try:
+            supervisor.run_forever()
+        except KeyboardInterrupt:
+            supervisor.stop()
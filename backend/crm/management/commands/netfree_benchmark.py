@@ -0,0 +1,77 @@
+import time
+from unittest import mock
+
+from crm.manager import EmailRequestProcessor
+from crm.models import Emailrequest
+from crm.netfree_sync import InlineWriteBuffer
+from crm.tasks import flush_filter_settings, netfree_traffic_record
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from utils.netfree_cassette import use_cassette
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a recorded NetfreeAPI cassette through EmailRequestProcessor and report "
+        "CPU time, DB queries and Netfree calls per request. Nothing is written or emailed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("cassette", help="Cassette recorded with NETFREE_CASSETTE_MODE=record")
+        parser.add_argument("--ids", nargs="*", type=int, help="Emailrequest ids to process")
+        parser.add_argument("--limit", type=int, default=50, help="Latest N requests when --ids is not given")
+        parser.add_argument("--repeat", type=int, default=1)
+
+    def handle(self, *args, **options):
+        queryset = Emailrequest.objects.order_by("-id")
+        if options["ids"]:
+            queryset = queryset.filter(id__in=options["ids"])
+        else:
+            queryset = queryset[:options["limit"]]
+        email_requests = list(queryset)
+        if not email_requests:
+            raise CommandError("No email requests to benchmark.")
+
+        cassette = use_cassette(options["cassette"], "replay")
+        totals = {"cpu": 0.0, "wall": 0.0, "queries": 0, "netfree": 0, "errors": 0}
+        # Filter-settings writes are applied inline through the cassette; a Celery
+        # task scheduled from here would write to the real Netfree.
+        with mock.patch.object(flush_filter_settings, "apply_async") as flush_scheduled, \
+                mock.patch.object(netfree_traffic_record, "apply_async") as processing_scheduled:
+            try:
+                with override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
+                    for _ in range(options["repeat"]):
+                        for email_request in email_requests:
+                            self.run_one(email_request, cassette, totals)
+            finally:
+                use_cassette(None, None)
+        if flush_scheduled.called or processing_scheduled.called:
+            raise CommandError(
+                f"benchmark tried to schedule {flush_scheduled.call_count} flush and "
+                f"{processing_scheduled.call_count} processing tasks; nothing was sent"
+            )
+
+        runs = len(email_requests) * options["repeat"]
+        self.stdout.write(
+            f"runs={runs} cpu={totals['cpu']:.3f}s wall={totals['wall']:.3f}s "
+            f"queries={totals['queries']} netfree_calls={totals['netfree']} errors={totals['errors']} "
+            f"cpu/run={totals['cpu'] / runs * 1000:.1f}ms queries/run={totals['queries'] / runs:.1f}"
+        )
+
+    def run_one(self, email_request, cassette, totals):
+        calls_before = cassette.calls
+        cpu_started = time.process_time()
+        wall_started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            try:
+                with transaction.atomic():
+                    EmailRequestProcessor(email_request, buffer=InlineWriteBuffer()).process()
+                    transaction.set_rollback(True)
+            except Exception as e:
+                totals["errors"] += 1
+                self.stderr.write(f"request {email_request.id}: {e}")
+        totals["cpu"] += time.process_time() - cpu_started
+        totals["wall"] += time.perf_counter() - wall_started
+        totals["queries"] += len(queries)
+        totals["netfree"] += cassette.calls - calls_before
@@ -0,0 +1,41 @@
+from crm.mail_ingest import DeadLetterReplay, IngestBusy
+from crm.models import DeadLetter
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch the mails of open dead letters again by UID and push them through ingestion. "
+        "Letters that go through are marked resolved; failing ones stay open with attempts + 1."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stage", choices=[stage for stage, _ in DeadLetter.STAGE_CHOICES])
+        parser.add_argument("--limit", type=int, help="Replay at most this many letters, oldest first")
+        parser.add_argument("--batch-size", type=int, help="UIDs fetched per IMAP command")
+        parser.add_argument("--workers", type=int, help="IMAP connections open at once")
+        parser.add_argument("--list", action="store_true", help="Show open dead letters per account/folder/stage and exit")
+
+    def handle(self, *args, **options):
+        if options["list"]:
+            groups = (
+                DeadLetter.objects.filter(resolved_at__isnull=True)
+                .values("account", "folder", "stage").annotate(count=Count("id"))
+                .order_by("account", "folder", "stage")
+            )
+            for group in groups:
+                self.stdout.write(f"{group['account']} {group['folder']} {group['stage']}: {group['count']}")
+            return
+        replay = DeadLetterReplay(
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            stage=options["stage"],
+            limit=options["limit"],
+        )
+        try:
+            stats = replay.run()
+        except IngestBusy:
+            self.stderr.write("Mail ingestion is running; try again when it is done.")
+            return
+        self.stdout.write(" ".join(f"{key}={value}" for key, value in stats.items()))
@@ -0,0 +1,35 @@
+from crm.netfree_sweep import FilterSettingsSweeper
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Prune expired and duplicate rules from every NetfreeUser's filter settings. "
+        "Resumes from the last customer handled unless --reset is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only count what would be pruned")
+        parser.add_argument("--reset", action="store_true", help="Start again from the first customer")
+        parser.add_argument("--batch-size", type=int)
+        parser.add_argument("--concurrency", type=int)
+        parser.add_argument("--max-seconds", type=int)
+        parser.add_argument("--stats", action="store_true", help="Show the last run's stats and exit")
+
+    def handle(self, *args, **options):
+        sweeper = FilterSettingsSweeper(
+            batch_size=options["batch_size"],
+            concurrency=options["concurrency"],
+            max_seconds=options["max_seconds"],
+            dry_run=options["dry_run"],
+        )
+        if options["stats"]:
+            self.stdout.write(f"cursor={sweeper.cursor()} last run={sweeper.last_stats()}")
+            return
+        if options["reset"]:
+            sweeper.reset()
+        stats = sweeper.run()
+        if stats is None:
+            self.stderr.write("A sweep is already running.")
+            return
+        self.stdout.write(" ".join(f"{key}={value}" for key, value in stats.items()))
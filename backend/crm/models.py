@@ -1,9 +1,11 @@
 import datetime
+import hashlib
 import json
 import logging
+import sys
+import traceback
 
-import requests
-from crm.manager import EmailRequestProcessor
+from crm.manager import EmailRequestProcessor, get_customer_profile
 from django.conf import settings
 from django.db import models, transaction
 from django.db.models.signals import post_save
@@ -11,6 +13,7 @@ from django.db.utils import IntegrityError
 from django.dispatch import receiver
 from utils.helper import (NetfreeAPI, replace_placeholders,
                           send_email_with_template)
+from utils.netfree_resilience import NetfreeUnavailable
 
 cronjob_email_log = logging.getLogger('cronjob-email')
 cronjob_error_log = logging.getLogger('cronjob-error')
@@ -49,82 +52,6 @@ class Categories(models.Model):
     def __str__(self):
         return f"{self.description} - {str(self.categories_id)}"
 
-    def search_category(self, params):
-        url = "https://netfree.link/api/tags/value/edit/get"
-        login_url = "https://netfree.link/api/user/login-by-password"
-
-        USER_PASSWORD = settings.USER_PASSWORD
-        USERNAME = settings.USERNAME
-
-        login_data = {"password": USER_PASSWORD, "phone": USERNAME}
-
-        valid_domain = self.find_domain(params)
-        domain = (
-            valid_domain.json()["foundHost"] if valid_domain.status_code == 200 else ""
-        )
-        payload = json.dumps({"host": str(domain)})
-        headers = {
-            "authority": "netfree.link",
-            "accept": "application/json, text/plain, */*",
-            "accept-language": "en-GB,en-US;q=0.9,en;q=0.8",
-            "content-type": "application/json",
-            "origin": "https://netfree.link",
-            "referer": "https://netfree.link/app/",
-            "save-data": "on",
-            "sec-ch-ua": '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
-            "sec-ch-ua-mobile": "?0",
-            "sec-ch-ua-platform": '"Windows"',
-            "sec-fetch-dest": "empty",
-            "sec-fetch-mode": "cors",
-            "sec-fetch-site": "same-origin",
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
-        }
-
-        session = requests.Session()
-        login_response = session.post(login_url, headers=headers, json=login_data)
-        cookie = login_response.cookies.get_dict()
-        headers["cookie"] = "; ".join(
-            [f"{name}={value}" for name, value in cookie.items()]
-        )
-        tags_response = session.post(url, headers=headers, data=payload)
-        return tags_response
-
-    def find_domain(self, params):
-        url = "https://netfree.link/api/tags/search-url"
-        login_url = "https://netfree.link/api/user/login-by-password"
-
-        USER_PASSWORD = settings.USER_PASSWORD
-        USERNAME = settings.USERNAME
-
-        login_data = {"password": USER_PASSWORD, "phone": USERNAME}
-
-        payload = json.dumps({"search": params})
-        headers = {
-            "authority": "netfree.link",
-            "accept": "application/json, text/plain, */*",
-            "accept-language": "en-GB,en-US;q=0.9,en;q=0.8",
-            "content-type": "application/json",
-            "origin": "https://netfree.link",
-            "referer": "https://netfree.link/app/",
-            "save-data": "on",
-            "sec-ch-ua": '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
-            "sec-ch-ua-mobile": "?0",
-            "sec-ch-ua-platform": '"Windows"',
-            "sec-fetch-dest": "empty",
-            "sec-fetch-mode": "cors",
-            "sec-fetch-site": "same-origin",
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
-        }
-
-        session = requests.Session()
-        login_response = session.post(login_url, headers=headers, json=login_data)
-        cookie = login_response.cookies.get_dict()
-        headers["cookie"] = "; ".join(
-            [f"{name}={value}" for name, value in cookie.items()]
-        )
-        response = session.post(url, headers=headers, data=payload)
-        return response
-
 class NetfreeTraffic(models.Model):
     is_default = models.BooleanField(default=False)
     is_active = models.BooleanField(default=False)
@@ -271,27 +198,50 @@ class Emailrequest(models.Model):
     ticket_id = models.CharField(max_length=100, null=True, default=None)
     requested_website = models.CharField(max_length=2000)
     created_at = models.DateTimeField()
-    def save(self,*args,**kwargs):
-        from clients.models import Client
+    # RFC 5322 Message-ID of the mail the request came from
+    message_id = models.CharField(max_length=255, null=True, blank=True, default=None)
+    # sha256 of message_id + requested_website; one row per url of a mail however often it is ingested
+    ingest_key = models.CharField(max_length=64, unique=True, null=True, blank=True, default=None)
+    SYNC_STATUS_CHOICES = (
+        ('pending', 'pending'),
+        ('done', 'done'),
+        ('failed', 'failed')
+    )
+    netfree_sync_status = models.CharField(max_length=20, choices=SYNC_STATUS_CHOICES, null=True, blank=True, default=None)
+    @staticmethod
+    def make_ingest_key(message_id, requested_website):
+        return hashlib.sha256(f"{message_id}\n{requested_website}".encode()).hexdigest()
+
+    def normalize_website(self):
         url_without_www = self.requested_website
         if self.requested_website.startswith("https://"):
             url_without_www = url_without_www.replace("https://", "http://", 1)
             self.requested_website = url_without_www
-        user_detail = netfree_obj.get_user(self.customer_id)
-        if user_detail.status_code == 200:
-            data = user_detail.json()
-            data = data.get('users',[])
-            if len(data)>0:
-                client_name = data[0].get('full_name',"")
-                client_email = data[0].get("email","")
-                client = Client.objects.filter(eav__email=client_email).first()
-                if client:
-                    self.username = client.eav.first_name
-                    self.sender_email = client.eav.email
-                else:
-                    self.username = client_name
-                    self.sender_email = client_email
-                
+
+    def fill_customer_profile(self):
+        """Take the customer's name/email from Netfree (or the matching Client) when known."""
+        from clients.models import Client
+        profile = None
+        try:
+            profile = get_customer_profile(self.customer_id, netfree_obj)
+        except NetfreeUnavailable as e:
+            cronjob_error_log.error(f"customer id : {self.customer_id}. user lookup skipped : {e}")
+        if profile:
+            client_name = profile["full_name"]
+            client_email = profile["email"]
+            client = Client.objects.filter(eav__email=client_email).first()
+            if client:
+                self.username = client.eav.first_name
+                self.sender_email = client.eav.email
+            else:
+                self.username = client_name
+                self.sender_email = client_email
+
+    def save(self,*args,**kwargs):
+        self.normalize_website()
+        # Only new requests need the customer's name/email; later saves (e.g. action_done) keep them.
+        if self._state.adding:
+            self.fill_customer_profile()
         super(Emailrequest,self).save(*args,**kwargs)
 
     def send_mail(self, template_name):
@@ -371,13 +321,14 @@ class Emailrequest(models.Model):
 @receiver(post_save, sender=Emailrequest)
 def email_request_created_or_updated(sender, instance, created, **kwargs):
     if created:
+        from crm.netfree_sync import customer_queue
         from crm.tasks import netfree_traffic_record
         if hasattr(instance, '_processing'):
             return
         instance._processing = True
         
         try:
-            result = netfree_traffic_record.delay(instance.id)
+            result = netfree_traffic_record.apply_async(args=[instance.id], queue=customer_queue(instance.customer_id))
         except IntegrityError as e:
             # Handle the specific database integrity error, if necessary
             cronjob_error_log.error(f"requested id: {instance.id} IntegrityError occurred: {str(e)}")
@@ -403,3 +354,103 @@ class EmailTemplate(models.Model):
 class SMTPEmail(models.Model):
     email = models.EmailField()
     password = models.CharField(max_length=200)
+
+
+class FilterSettingsShadow(models.Model):
+    """Last known Netfree filterSettings/inspectorSettings of a customer."""
+    customer_id = models.CharField(max_length=100, unique=True)
+    filter_settings = models.JSONField(default=dict)
+    inspector_settings = models.JSONField(default=dict)
+    version = models.PositiveIntegerField(default=0)
+    fetched_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.customer_id} v{self.version}"
+
+    def as_netfree_data(self):
+        return {"filterSettings": self.filter_settings, "inspectorSettings": self.inspector_settings}
+
+
+class FilterSettingsChange(models.Model):
+    """Audit trail of the url rules we added to or removed from a customer's settings."""
+    shadow = models.ForeignKey(FilterSettingsShadow, on_delete=models.CASCADE, related_name="changes")
+    version = models.PositiveIntegerField()
+    source = models.CharField(max_length=50)
+    added = models.JSONField(default=list)
+    removed = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.shadow.customer_id} v{self.version} +{len(self.added)} -{len(self.removed)}"
+
+
+class MailboxSyncState(models.Model):
+    """How far ingestion got in one IMAP folder of one account."""
+    account = models.CharField(max_length=320)
+    folder = models.CharField(max_length=255)
+    uidvalidity = models.BigIntegerField(null=True, blank=True, default=None)
+    last_uid = models.BigIntegerField(default=0)
+    highestmodseq = models.BigIntegerField(null=True, blank=True, default=None)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["account", "folder"], name="unique_mailbox_sync_state"),
+        ]
+
+    def __str__(self):
+        return f"{self.account} {self.folder} uid {self.last_uid}"
+
+
+class DeadLetter(models.Model):
+    """A mail that failed ingestion, kept by UID so replay_dead_letters can fetch it again."""
+    STAGE_CHOICES = (
+        ('fetch', 'fetch'),
+        ('parse', 'parse'),
+        ('persist', 'persist'),
+    )
+    account = models.CharField(max_length=320)
+    folder = models.CharField(max_length=255)
+    uid = models.BigIntegerField()
+    uidvalidity = models.BigIntegerField(null=True, blank=True, default=None)
+    message_id = models.CharField(max_length=255, null=True, blank=True, default=None)
+    stage = models.CharField(max_length=20, choices=STAGE_CHOICES)
+    error = models.TextField(default="")
+    traceback = models.TextField(default="")
+    attempts = models.IntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    resolved_at = models.DateTimeField(null=True, blank=True, default=None)
+
+    def __str__(self):
+        return f"{self.account} {self.folder} uid {self.uid} ({self.stage})"
+
+    @classmethod
+    def record(cls, account, folder, uid, uidvalidity, stage, error, message_id=None):
+        """Store a failure, or count another attempt on the open dead letter of that mail.
+
+        Call from inside the ``except`` block so the traceback is kept. Never
+        raises: losing a dead letter must not stop the rest of the batch.
+        """
+        trace = traceback.format_exc() if sys.exc_info()[0] else ""
+        message_id = (message_id or "")[:255] or None
+        try:
+            letter = cls.objects.filter(
+                account=account, folder=folder, uid=uid, uidvalidity=uidvalidity, resolved_at__isnull=True,
+            ).first()
+            if letter is None:
+                return cls.objects.create(
+                    account=account, folder=folder, uid=uid, uidvalidity=uidvalidity, stage=stage,
+                    error=str(error), traceback=trace, message_id=message_id,
+                )
+            letter.stage = stage
+            letter.error = str(error)
+            letter.traceback = trace
+            letter.message_id = message_id or letter.message_id
+            letter.attempts += 1
+            letter.save()
+            return letter
+        except Exception as e:
+            cronjob_error_log.error(f"dead letter for uid {uid} in {account} {folder} not stored : {e}")
+            return None
@@ -0,0 +1,150 @@
+import json
+import logging
+import time
+
+from clients.models import NetfreeUser
+from django.conf import settings
+from django.core.cache import cache
+from utils.helper import NetfreeAPI, remove_duplicate_combinations
+from utils.netfree_async import netfree_fan_out
+from utils.netfree_resilience import NetfreeUnavailable
+
+from crm.netfree_sync import (CustomerBusy, clean_customer_id, customer_lock,
+                              load_filter_settings, store_filter_settings)
+
+cronjob_log = logging.getLogger('cronjob-log')
+cronjob_error_log = logging.getLogger('cronjob-error')
+
+
+def payload_size(urls):
+    return len(json.dumps(urls, separators=(",", ":")))
+
+
+def compact_customer(netfree_api, customer_id):
+    """Re-read a customer's settings under their lock and post them back if pruning changes them.
+
+    Returns the number of bytes saved, 0 if nothing changed, or None when the
+    read or write failed.
+    """
+    with customer_lock(customer_id):
+        data, _ = load_filter_settings(netfree_api, customer_id, refresh=True)
+        if data is None:
+            return None
+        urls = data.get("inspectorSettings", {}).get("urls", [])
+        compacted = remove_duplicate_combinations(urls)
+        saved = payload_size(urls) - payload_size(compacted)
+        if not saved:
+            return 0
+        res = netfree_api.post_user_data(customer_id, compacted, data)
+        if res.status_code != 200:
+            cronjob_error_log.error(f"customer id : {customer_id}. sweep update {str(res.status_code)}")
+            return None
+        store_filter_settings(customer_id, data, "sweep")
+        return saved
+
+
+class FilterSettingsSweeper:
+    """Walk every NetfreeUser and strip expired/duplicate rules from their Netfree url lists.
+
+    Settings are read in batches of NETFREE_SWEEP_BATCH_SIZE with at most
+    NETFREE_SWEEP_CONCURRENCY requests in flight. Only customers whose list
+    actually shrinks are re-read under their lock and written back. The last
+    NetfreeUser pk handled is kept in the cache, so a run that hits
+    NETFREE_SWEEP_MAX_SECONDS (or crashes) resumes there next time.
+    """
+
+    CURSOR_KEY = "netfree-sweep:cursor"
+    STATS_KEY = "netfree-sweep:stats"
+    RUNNING_KEY = "netfree-sweep:running"
+
+    def __init__(self, batch_size=None, concurrency=None, max_seconds=None, dry_run=False):
+        self.batch_size = batch_size or settings.NETFREE_SWEEP_BATCH_SIZE
+        self.concurrency = concurrency or settings.NETFREE_SWEEP_CONCURRENCY
+        self.max_seconds = max_seconds or settings.NETFREE_SWEEP_MAX_SECONDS
+        self.dry_run = dry_run
+        self.stats = {
+            "dry_run": dry_run, "customers": 0, "stale": 0, "written": 0, "errors": 0,
+            "bytes_saved": 0, "batches": 0, "fetch_seconds": 0.0, "max_batch_seconds": 0.0,
+            "elapsed": 0.0, "customers_per_second": 0.0, "completed": False,
+        }
+
+    def cursor(self):
+        return cache.get(self.CURSOR_KEY, 0)
+
+    def reset(self):
+        cache.delete(self.CURSOR_KEY)
+
+    def last_stats(self):
+        return cache.get(self.STATS_KEY)
+
+    def run(self):
+        if not cache.add(self.RUNNING_KEY, 1, timeout=self.max_seconds * 2):
+            cronjob_log.info("netfree sweep already running, skipped")
+            return None
+        started = time.monotonic()
+        try:
+            netfree_api = NetfreeAPI()
+            cursor = self.cursor()
+            while time.monotonic() - started < self.max_seconds:
+                batch = list(
+                    NetfreeUser.objects.filter(pk__gt=cursor).order_by("pk").values_list("pk", "user_id")[:self.batch_size]
+                )
+                if not batch:
+                    self.stats["completed"] = True
+                    break
+                self.sweep_batch(netfree_api, [clean_customer_id(user_id) for _, user_id in batch])
+                cursor = batch[-1][0]
+                if not self.dry_run:
+                    cache.set(self.CURSOR_KEY, cursor, timeout=None)
+            if self.stats["completed"] and not self.dry_run:
+                self.reset()
+        finally:
+            cache.delete(self.RUNNING_KEY)
+            self.stats["elapsed"] = round(time.monotonic() - started, 3)
+            if self.stats["elapsed"]:
+                self.stats["customers_per_second"] = round(self.stats["customers"] / self.stats["elapsed"], 2)
+            cache.set(self.STATS_KEY, self.stats, timeout=None)
+            cronjob_log.info(f"netfree sweep : {self.stats}")
+        return self.stats
+
+    def sweep_batch(self, netfree_api, customer_ids):
+        customer_ids = [customer_id for customer_id in customer_ids if customer_id]
+        fetch_started = time.monotonic()
+        responses = netfree_fan_out("get_user_deatils", customer_ids, self.concurrency)
+        batch_seconds = time.monotonic() - fetch_started
+        self.stats["batches"] += 1
+        self.stats["fetch_seconds"] = round(self.stats["fetch_seconds"] + batch_seconds, 3)
+        self.stats["max_batch_seconds"] = round(max(self.stats["max_batch_seconds"], batch_seconds), 3)
+        for response in responses:
+            # Netfree is down: stop before the cursor moves so this batch is swept again next run.
+            if isinstance(response, NetfreeUnavailable):
+                raise response
+
+        for customer_id, response in zip(customer_ids, responses):
+            self.stats["customers"] += 1
+            if isinstance(response, Exception) or response.status_code != 200:
+                self.stats["errors"] += 1
+                continue
+            urls = response.json().get("inspectorSettings", {}).get("urls", [])
+            saved = payload_size(urls) - payload_size(remove_duplicate_combinations(urls))
+            if not saved:
+                continue
+            self.stats["stale"] += 1
+            if self.dry_run:
+                self.stats["bytes_saved"] += saved
+                continue
+            try:
+                saved = compact_customer(netfree_api, customer_id)
+            except CustomerBusy:
+                # A live sync holds the lock; it prunes the list on its own write anyway.
+                continue
+            except NetfreeUnavailable:
+                raise
+            except Exception as e:
+                cronjob_error_log.error(f"customer id : {customer_id}. sweep failed : {e}")
+                saved = None
+            if saved is None:
+                self.stats["errors"] += 1
+            elif saved:
+                self.stats["written"] += 1
+                self.stats["bytes_saved"] += saved
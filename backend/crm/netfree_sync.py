@@ -0,0 +1,291 @@
+import json
+import logging
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django_redis import get_redis_connection
+from utils.helper import NetfreeAPI, remove_duplicate_combinations
+from utils.netfree_resilience import NetfreeUnavailable
+
+cronjob_email_log = logging.getLogger('cronjob-email')
+cronjob_error_log = logging.getLogger('cronjob-error')
+
+
+def clean_customer_id(customer_id):
+    return ''.join(filter(str.isdigit, str(customer_id)))
+
+
+class CustomerBusy(Exception):
+    """Another worker holds the customer's filter-settings lock."""
+
+
+def customer_queue(customer_id):
+    """Celery queue for a customer's Netfree writes, or None for the default queue.
+
+    With NETFREE_SYNC_ROUTE_QUEUES a customer always maps to the same of
+    NETFREE_SYNC_PARTITIONS queues, so with one worker process per queue their
+    writes run in order while different customers are spread over all
+    partitions. Those queues need their own workers, so routing is off unless
+    they are deployed; customer_lock keeps writes safe either way.
+    """
+    if not settings.NETFREE_SYNC_ROUTE_QUEUES:
+        return None
+    partition = zlib.crc32(clean_customer_id(customer_id).encode()) % settings.NETFREE_SYNC_PARTITIONS
+    return f"netfree-sync-{partition}"
+
+
+@contextmanager
+def customer_lock(customer_id):
+    """Serialize read-modify-write of one customer's filter settings across all workers.
+
+    Retries and rate limiting can keep a write going longer than
+    NETFREE_SYNC_LOCK_TIMEOUT, so a heartbeat thread renews the lock every
+    third of the timeout while it is held. The timeout only frees the lock
+    of a worker that died.
+    """
+    timeout = settings.NETFREE_SYNC_LOCK_TIMEOUT
+    lock = get_redis_connection("default").lock(
+        f"netfree-sync:lock:{clean_customer_id(customer_id)}",
+        timeout=timeout,
+        blocking_timeout=settings.NETFREE_SYNC_LOCK_WAIT,
+        # The heartbeat thread renews with the token acquire() stored.
+        thread_local=False,
+    )
+    if not lock.acquire():
+        raise CustomerBusy(f"customer {customer_id} filter settings are being written")
+    released = threading.Event()
+
+    def renew():
+        while not released.wait(timeout / 3):
+            try:
+                lock.reacquire()
+            except Exception as e:
+                cronjob_error_log.error(f"customer id : {customer_id}. lock renewal failed : {e}")
+                return
+
+    heartbeat = threading.Thread(target=renew, name=f"netfree-sync-lock-{customer_id}", daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        released.set()
+        heartbeat.join()
+        try:
+            lock.release()
+        except Exception as e:
+            cronjob_error_log.error(f"customer id : {customer_id}. lock release failed : {e}")
+
+
+def rule_key(entry):
+    return json.dumps(entry, sort_keys=True, separators=(",", ":"))
+
+
+def diff_rules(old_urls, new_urls):
+    old_keys = {rule_key(entry) for entry in old_urls}
+    new_keys = {rule_key(entry) for entry in new_urls}
+    added = [entry for entry in new_urls if rule_key(entry) not in old_keys]
+    removed = [entry for entry in old_urls if rule_key(entry) not in new_keys]
+    return added, removed
+
+
+def store_filter_settings(customer_id, data, source="netfree"):
+    """Save ``data`` as the customer's shadow copy.
+
+    When the url rules differ from the previous copy the version is bumped
+    and the difference is recorded as a FilterSettingsChange from ``source``
+    ("netfree" for changes noticed on a refresh, otherwise who wrote it).
+    """
+    from crm.models import FilterSettingsChange, FilterSettingsShadow
+    shadow = FilterSettingsShadow.objects.filter(customer_id=customer_id).first()
+    if shadow is None:
+        shadow = FilterSettingsShadow(customer_id=customer_id)
+    old_urls = shadow.inspector_settings.get("urls", []) if shadow.pk else []
+    shadow.filter_settings = data.get("filterSettings") or {}
+    shadow.inspector_settings = data.get("inspectorSettings") or {}
+    shadow.fetched_at = timezone.now()
+    added, removed = diff_rules(old_urls, shadow.inspector_settings.get("urls", []))
+    if added or removed:
+        shadow.version += 1
+    shadow.save()
+    if added or removed:
+        FilterSettingsChange.objects.create(
+            shadow=shadow, version=shadow.version, source=source, added=added, removed=removed
+        )
+    return shadow
+
+
+def load_filter_settings(netfree_api, customer_id, refresh=False):
+    """Return ``(data, from_shadow)`` for a customer.
+
+    The shadow copy is used while it is younger than NETFREE_SHADOW_TTL;
+    otherwise (or with ``refresh``) the settings are fetched from Netfree and
+    the shadow is updated. ``data`` is None when Netfree does not answer 200.
+    """
+    from crm.models import FilterSettingsShadow
+    customer_id = clean_customer_id(customer_id)
+    if not refresh:
+        fresh_after = timezone.now() - timedelta(seconds=settings.NETFREE_SHADOW_TTL)
+        shadow = FilterSettingsShadow.objects.filter(customer_id=customer_id, fetched_at__gt=fresh_after).first()
+        if shadow:
+            return shadow.as_netfree_data(), True
+    user_detail = netfree_api.get_user_deatils(customer_id)
+    if user_detail.status_code != 200:
+        cronjob_error_log.error(f"customer id : {customer_id}. user_deatils {str(user_detail.status_code)}")
+        return None, False
+    data = user_detail.json()
+    cronjob_email_log.info(f"customer id : {customer_id}. customer data : {str(data)}")
+    store_filter_settings(customer_id, data)
+    return data, False
+
+
+def apply_filter_urls(netfree_api, customer_id, urls, source="email-request", refresh=False):
+    """Add ``urls`` to a customer's inspector settings.
+
+    Reads the settings from the shadow when it is fresh and only posts when
+    the pruned, merged url list differs from what Netfree already has. A
+    rejected write based on the shadow is retried once against fresh data.
+    Callers hold ``customer_lock``.
+    """
+    customer_id = clean_customer_id(customer_id)
+    data, from_shadow = load_filter_settings(netfree_api, customer_id, refresh=refresh)
+    if data is None:
+        return False
+    user_urls = data.get("inspectorSettings", {}).get("urls", [])
+    new_urls = remove_duplicate_combinations(list(urls) + user_urls)
+    added, removed = diff_rules(user_urls, new_urls)
+    if not added and not removed:
+        cronjob_email_log.info(f"customer id : {customer_id}. filter settings unchanged, write skipped")
+        return True
+    res = netfree_api.post_user_data(customer_id, new_urls, data)
+    if res.status_code != 200:
+        if from_shadow:
+            cronjob_email_log.info(f"customer id : {customer_id}. write from shadow rejected, refreshing")
+            return apply_filter_urls(netfree_api, customer_id, urls, source=source, refresh=True)
+        cronjob_error_log.error(f"customer id : {customer_id}. user_deatils update {str(res.status_code)}")
+        return False
+    store_filter_settings(customer_id, data, source)
+    return True
+
+
+class FilterSettingsWriteBuffer:
+    """Coalesce filter-settings writes per customer.
+
+    Each processed Emailrequest pushes its ``{"url","rule","exp"}`` entries to
+    a Redis list for its customer. The first push schedules a flush
+    NETFREE_SYNC_WINDOW seconds later; the flush drains everything queued by
+    then and applies it with a single apply_filter_urls call. When the flush
+    task runs out of retries its entries are marked failed instead of being
+    left in Redis.
+    """
+
+    def __init__(self):
+        self.window = settings.NETFREE_SYNC_WINDOW
+
+    def redis(self):
+        return get_redis_connection("default")
+
+    def pending_key(self, customer_id):
+        return f"netfree-sync:pending:{customer_id}"
+
+    def scheduled_key(self, customer_id):
+        return f"netfree-sync:scheduled:{customer_id}"
+
+    def enqueue(self, email_request, urls, action_done):
+        from crm.tasks import flush_filter_settings
+        customer_id = clean_customer_id(email_request.customer_id)
+        item = {"request_id": email_request.id, "urls": urls, "action_done": action_done}
+        self.redis().rpush(self.pending_key(customer_id), json.dumps(item))
+        if cache.add(self.scheduled_key(customer_id), 1, timeout=self.window * 6):
+            flush_filter_settings.apply_async(
+                args=[customer_id], countdown=self.window, queue=customer_queue(customer_id)
+            )
+        cronjob_email_log.info(f"customer id : {customer_id}. queued {len(urls)} urls for request {email_request.id}")
+
+    def drain(self, customer_id):
+        # Clear the flag first so anything queued from now on schedules a new flush.
+        cache.delete(self.scheduled_key(customer_id))
+        pipe = self.redis().pipeline()
+        pipe.lrange(self.pending_key(customer_id), 0, -1)
+        pipe.delete(self.pending_key(customer_id))
+        raw_items, _ = pipe.execute()
+        return [json.loads(raw) for raw in raw_items]
+
+    def requeue(self, customer_id, items):
+        if items:
+            self.redis().lpush(self.pending_key(customer_id), *[json.dumps(item) for item in reversed(items)])
+
+    def fail(self, customer_id, error, items=None):
+        """Give up on ``items`` (by default everything queued) and mark their requests failed."""
+        from crm.models import Emailrequest
+        if items is None:
+            items = self.drain(customer_id)
+        if not items:
+            return
+        Emailrequest.objects.filter(id__in=[item["request_id"] for item in items]).update(netfree_sync_status="failed")
+        cronjob_error_log.error(
+            f"customer id : {customer_id}. gave up on {len(items)} queued requests "
+            f"{[item['request_id'] for item in items]} : {error}"
+        )
+
+    def flush(self, customer_id, netfree_api=None, last_attempt=False):
+        """Apply every queued entry for a customer and report back to each Emailrequest.
+
+        If applying them raises, the entries are queued again for the retry, or
+        marked failed when this is the ``last_attempt``.
+        """
+        from crm.models import Emailrequest
+        with customer_lock(customer_id):
+            items = self.drain(customer_id)
+            if not items:
+                return None
+            urls = [url for item in items for url in item["urls"]]
+            try:
+                done = apply_filter_urls(netfree_api or NetfreeAPI(), customer_id, urls)
+            except Exception as e:
+                # Drained entries are only in memory now; put them back (or
+                # give up on them) whatever went wrong, then let the task retry.
+                if last_attempt:
+                    self.fail(customer_id, e, items)
+                else:
+                    self.requeue(customer_id, items)
+                raise
+        status = "done" if done else "failed"
+        for item in items:
+            updates = {"netfree_sync_status": status}
+            if done and item["action_done"]:
+                updates["action_done"] = item["action_done"]
+            Emailrequest.objects.filter(id=item["request_id"]).update(**updates)
+        cronjob_email_log.info(
+            f"customer id : {customer_id}. flushed {len(urls)} urls from {len(items)} requests : {status}"
+        )
+        return done
+
+
+write_buffer = FilterSettingsWriteBuffer()
+
+
+class InlineWriteBuffer:
+    """Stand-in for write_buffer that applies the urls right away with ``netfree_api``.
+
+    Used by the netfree_benchmark command: nothing is pushed to Redis and no
+    flush task is scheduled, so a replay only ever talks to the cassette.
+    """
+
+    def __init__(self, netfree_api=None):
+        self.netfree_api = netfree_api
+        self.flushed = 0
+
+    def enqueue(self, email_request, urls, action_done):
+        from crm.models import Emailrequest
+        customer_id = clean_customer_id(email_request.customer_id)
+        done = apply_filter_urls(self.netfree_api or NetfreeAPI(), customer_id, urls, source="benchmark")
+        updates = {"netfree_sync_status": "done" if done else "failed"}
+        if done and action_done:
+            updates["action_done"] = action_done
+        Emailrequest.objects.filter(id=email_request.id).update(**updates)
+        self.flushed += 1
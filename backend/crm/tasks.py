@@ -1,21 +1,74 @@
 from celery import shared_task
 from crm.manager import EmailRequestProcessor
+from crm.category_sync import set_job_status, sync_categories
+from crm.imap_idle import idle_covers_all_accounts
 from crm.models import Emailrequest
+from crm.netfree_sweep import FilterSettingsSweeper
+from crm.netfree_sync import CustomerBusy, write_buffer
 from crm.views import ReadEmail
+from django.conf import settings
+from django.core.cache import cache
+from utils.netfree_resilience import NetfreeUnavailable
+
+SAFETY_RUN_KEY = "read-emails:safety-run"
 
 
 @shared_task
 def read_emails():
     print(" task one called and worker is running good")
+    # While imap_idle listens on every folder this run is only a safety net.
+    if idle_covers_all_accounts() and not cache.add(SAFETY_RUN_KEY, 1, timeout=settings.EMAIL_IDLE_SAFETY_INTERVAL):
+        return "skipped, imap idle is listening"
     obj = ReadEmail()
     obj.read_email_from_gmail()
     return "success"
 
 
-@shared_task
-def netfree_traffic_record(email_request_id):
+@shared_task(bind=True)
+def netfree_traffic_record(self, email_request_id):
     email_request = Emailrequest.objects.get(id=email_request_id)
     obj = EmailRequestProcessor(email_request)
-    if obj.process():
+    try:
+        done = obj.process()
+    except NetfreeUnavailable as e:
+        # Netfree is down or the breaker is open: put the request back on the queue.
+        raise self.retry(exc=e, countdown=e.retry_after, max_retries=settings.NETFREE_TASK_MAX_RETRIES)
+    if done:
         return f"email request {str(email_request.id)} success"
-    return f"False email request {str(email_request.id)}"
\ No newline at end of file
+    return f"False email request {str(email_request.id)}"
+
+
+@shared_task(bind=True)
+def flush_filter_settings(self, customer_id):
+    last_attempt = self.request.retries >= settings.NETFREE_TASK_MAX_RETRIES
+    try:
+        done = write_buffer.flush(customer_id, last_attempt=last_attempt)
+    except NetfreeUnavailable as e:
+        raise self.retry(exc=e, countdown=e.retry_after, max_retries=settings.NETFREE_TASK_MAX_RETRIES)
+    except CustomerBusy as e:
+        if last_attempt:
+            write_buffer.fail(customer_id, e)
+        raise self.retry(exc=e, countdown=settings.NETFREE_SYNC_WINDOW, max_retries=settings.NETFREE_TASK_MAX_RETRIES)
+    except Exception as e:
+        # flush() put the entries back (or failed them on the last attempt).
+        raise self.retry(exc=e, countdown=settings.NETFREE_SYNC_WINDOW, max_retries=settings.NETFREE_TASK_MAX_RETRIES)
+    return f"customer {customer_id} filter settings flush: {done}"
+
+
+@shared_task
+def sweep_filter_settings(dry_run=False):
+    stats = FilterSettingsSweeper(dry_run=dry_run).run()
+    return f"netfree sweep : {stats}"
+
+
+@shared_task(bind=True)
+def sync_netfree_categories(self, force=False):
+    try:
+        result = sync_categories(job_id=self.request.id, force=force)
+    except NetfreeUnavailable as e:
+        set_job_status(self.request.id, "retrying", result={"error": str(e)})
+        raise self.retry(exc=e, countdown=e.retry_after, max_retries=settings.NETFREE_TASK_MAX_RETRIES)
+    except Exception as e:
+        set_job_status(self.request.id, "failed", result={"error": str(e)})
+        raise
+    return f"netfree category sync : {result}"
@@ -1,4 +1,50 @@
+import asyncio
+import base64
+import gzip
 import imaplib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from email.header import Header
+from unittest import mock
+
+import requests
+from clients.models import NetfreeUser
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from redis.exceptions import RedisError
+
+from crm import category_sync
+from crm.imap_idle import (ImapIdleListener, ImapIdleSupervisor,
+                           heartbeat_key, idle_covers_all_accounts)
+from crm.mail_ingest import (Checkpoint, MailboxReader, MailIngestCoordinator,
+                             RequestWriter, insert_new_requests)
+from crm.mail_parse import (TRAFFIC_VIEW_PREFIX, RawMessage, parse_date,
+                            parse_raw_message)
+from crm.models import (Categories, Emailrequest, FilterSettingsShadow,
+                        NetfreeCategoriesProfile, NetfreeTraffic, SMTPEmail)
+from crm.netfree_sweep import FilterSettingsSweeper, compact_customer
+from crm.netfree_sync import (FilterSettingsWriteBuffer, apply_filter_urls,
+                              store_filter_settings)
+from crm.tasks import SAFETY_RUN_KEY, read_emails
+from utils.helper import (NetfreeAPI, NetfreeResponse,
+                          get_netfree_traffic_data,
+                          remove_duplicate_combinations)
+from utils.imap_fetch import (decode_part, parse_fetch_response,
+                              text_part_section)
+from utils.netfree_cache import CategoryCache, LocalLRU, shared_cache
+from utils.netfree_cassette import (REPLAY_COOKIE, Cassette, CassetteMiss,
+                                    process_path, use_cassette)
+from utils.netfree_fake_server import FakeNetfreeState, make_server
+from utils.netfree_limiter import AdaptiveLimiter
+from utils.netfree_resilience import CircuitBreaker, NetfreeUnavailable
+from utils.netfree_session import NetfreeSession
+from utils.netfree_traffic import (_iter_entries_raw_decode,
+                                   parse_traffic_record)
 
 # Replace these with your actual email credentials and server settings
 FROM_EMAIL = "ועד שמרם"
@@ -45,25 +91,951 @@ def fetch_emails_from_mailbox(imap_server, mailbox):
     except imaplib.IMAP4.error as e:
         print(f"Error while fetching emails from {mailbox}: {e}")
 
-# Establish a secure SSL connection to the IMAP server
-imap_server = imaplib.IMAP4_SSL(SMTP_SERVER)
+if __name__ == "__main__":
+    # Establish a secure SSL connection to the IMAP server
+    imap_server = imaplib.IMAP4_SSL(SMTP_SERVER)
+
+    # Log in to the server using the provided email credentials
+    imap_server.login(FROM_EMAIL, FROM_PWD)
+
+
+    # _, mailbox_list = imap_server.list()
+
+    # print("JJJJ", mailbox_list)
+
+    # List of mailbox names you want to fetch emails from
+    mailbox_list = ['Sent', "INBOX",  "SENT", "SPAM", "TRASH", "JUNK"]
+    mailbox_list = ["INBOX", "Sent", "Drafts", "Deleted Messages"]
+    mailbox_list = ["INBOX", "Sent",]
+
+    # Iterate through each mailbox and fetch emails
+    for mailbox in mailbox_list:
+        fetch_emails_from_mailbox(imap_server, mailbox)
+
+    # Close the IMAP connection
+    imap_server.logout()
+
+
+def email_request(uid, url, message_id="<1@example.com>", created_at=datetime(2024, 5, 1, 9, 30, tzinfo=timezone.utc)):
+    row = Emailrequest(
+        email_id=uid, sender_email="user@example.com", customer_id="1234",
+        requested_website=url, text="", created_at=created_at, ticket_id=15665,
+    )
+    row.message_id = message_id
+    row.ingest_key = Emailrequest.make_ingest_key(message_id, url)
+    return row
+
+
+@mock.patch("crm.tasks.netfree_traffic_record.apply_async")
+class InsertNewRequestsTests(TestCase):
+
+    def test_inserts_and_enqueues_only_new_rows(self, apply_async):
+        Emailrequest.objects.bulk_create([email_request(1, "http://a.example")])
+        rows = [email_request(1, "http://a.example"), email_request(1, "http://b.example")]
+        with self.captureOnCommitCallbacks(execute=True):
+            inserted = insert_new_requests(rows)
+        self.assertEqual([row.requested_website for row in inserted], ["http://b.example"])
+        self.assertIsNotNone(inserted[0].pk)
+        self.assertEqual(Emailrequest.objects.count(), 2)
+        apply_async.assert_called_once()
+        self.assertEqual(apply_async.call_args.kwargs["args"], [inserted[0].pk])
+
+    def test_same_key_twice_in_one_batch_is_inserted_once(self, apply_async):
+        rows = [email_request(1, "http://a.example"), email_request(2, "http://a.example")]
+        with self.captureOnCommitCallbacks(execute=True):
+            inserted = insert_new_requests(rows)
+        self.assertEqual(len(inserted), 1)
+        self.assertEqual(apply_async.call_count, 1)
+
+    @mock.patch.object(Emailrequest, "fill_customer_profile")
+    def test_mail_without_message_id_in_two_folders_is_inserted_once(self, fill_customer_profile, apply_async):
+        inbox = raw_request(7, "http://a.example")
+        label = inbox._replace(folder="[Gmail]/All Mail", uid=93)
+        records = [parse_raw_message(inbox), parse_raw_message(label)]
+        self.assertEqual(records[0]["message_id"], records[1]["message_id"])
+        rows = [row for record in records for row in RequestWriter().build_requests(record)]
+        with self.captureOnCommitCallbacks(execute=True):
+            inserted = insert_new_requests(rows)
+        self.assertEqual(len(inserted), 1)
+        self.assertEqual(Emailrequest.objects.count(), 1)
+
+    def test_nothing_is_enqueued_before_commit(self, apply_async):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            insert_new_requests([email_request(1, "http://a.example")])
+        apply_async.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+
+    def test_mail_stored_without_ingest_key_is_not_inserted_again(self, apply_async):
+        legacy = email_request(7, "http://a.example")
+        legacy.message_id = legacy.ingest_key = None
+        Emailrequest.objects.bulk_create([legacy])
+        with self.captureOnCommitCallbacks(execute=True):
+            inserted = insert_new_requests([email_request(7, "http://a.example"), email_request(8, "http://a.example", "<2@example.com>")])
+        self.assertEqual([row.email_id for row in inserted], [8])
+        self.assertEqual(Emailrequest.objects.filter(email_id=7).count(), 1)
+        apply_async.assert_called_once()
+
+
+class ParseDateTests(SimpleTestCase):
+
+    def test_date_header_variants(self):
+        expected = datetime(2024, 5, 1, 9, 30, tzinfo=timezone.utc)
+        for value in (
+            "Wed, 01 May 2024 09:30:00 +0000",
+            "Wed, 01 May 2024 09:30:00 +0000 (UTC)",
+            "1 May 2024 12:30:00 +0300",
+            "Wed, 01 May 2024 09:30:00 -0000",
+        ):
+            with self.subTest(value=value):
+                self.assertEqual(parse_date(value), expected)
+
+
+HEADER = b"BODY[HEADER.FIELDS (SUBJECT FROM DATE MESSAGE-ID)]"
+ALTERNATIVE = (
+    b'(("text" "plain" ("charset" "utf-8") NIL NIL "base64" 8 1 NIL NIL NIL)'
+    b'("text" "html" ("charset" "utf-8") NIL NIL "quoted-printable" 20 1 NIL NIL NIL) "alternative" ("boundary" "a") NIL NIL)'
+)
+
+
+class ParseFetchResponseTests(SimpleTestCase):
+
+    def test_multipart_headers_and_structure(self):
+        data = [(b"1 (UID 42 BODYSTRUCTURE " + ALTERNATIVE + b" " + HEADER + b" {12}", b"Subject: x\r\n"), b")"]
+        message = parse_fetch_response(data)[42]
+        self.assertEqual(message["header"], b"Subject: x\r\n")
+        self.assertEqual(message["sections"], {})
+        self.assertEqual(
+            text_part_section(message["bodystructure"]),
+            {"section": "1", "type": "text/plain", "charset": "utf-8", "encoding": "base64"},
+        )
+
+    def test_single_part_message(self):
+        data = [
+            (b'7 (UID 43 BODYSTRUCTURE ("text" "plain" ("charset" "windows-1255") NIL NIL "7bit" 5 1 NIL NIL NIL) '
+             + HEADER + b" {12}", b"Subject: y\r\n"),
+            b")",
+        ]
+        structure = parse_fetch_response(data)[43]["bodystructure"]
+        self.assertEqual(
+            text_part_section(structure),
+            {"section": "1", "type": "text/plain", "charset": "windows-1255", "encoding": "7bit"},
+        )
+
+    def test_nested_multipart_finds_inner_text_part(self):
+        data = [
+            b"3 (UID 44 BODYSTRUCTURE (" + ALTERNATIVE
+            + b'("application" "pdf" ("name" "x.pdf") NIL NIL "base64" 100 NIL NIL NIL) "mixed" ("boundary" "b") NIL NIL))'
+        ]
+        structure = parse_fetch_response(data)[44]["bodystructure"]
+        self.assertEqual(text_part_section(structure)["section"], "1.1")
+        self.assertEqual(text_part_section(structure)["encoding"], "base64")
+
+    def test_uid_and_flags_after_literal(self):
+        data = [
+            (b"1 (UID 42 BODY[1] {8}", b"aGVsbG8="), b")",
+            (b"2 (BODY[1.1] {5}", b"hello"), b" UID 44 FLAGS (\\Seen))",
+        ]
+        messages = parse_fetch_response(data)
+        self.assertEqual(messages[42]["sections"], {"1": b"aGVsbG8="})
+        self.assertEqual(messages[44]["sections"], {"1.1": b"hello"})
+        self.assertEqual(messages[44]["flags"], ["\\Seen"])
+        self.assertEqual(decode_part(messages[42]["sections"]["1"], "base64"), "hello")
+
+    def test_response_without_uid_is_ignored(self):
+        self.assertEqual(parse_fetch_response([b"1 (FLAGS (\\Seen))"]), {})
+
+    def test_decode_part_charsets(self):
+        self.assertEqual(decode_part(b"caf=C3=A9", "quoted-printable"), "caf\u00e9")
+        self.assertEqual(decode_part("\u05e9\u05dc\u05d5\u05dd".encode("windows-1255"), "7bit", "windows-1255"), "\u05e9\u05dc\u05d5\u05dd")
+        self.assertEqual(decode_part(b"plain", "7bit", "no-such-charset"), "plain")
+
+
+class TrafficCategoryFanOutTests(TestCase):
+
+    def setUp(self):
+        profile = NetfreeCategoriesProfile.objects.create(is_default=True)
+        NetfreeTraffic.objects.create(is_default=True, is_active=True, netfree_profile=profile)
+
+    def test_traffic_urls_are_looked_up_concurrently(self):
+        urls = [f"https://site{index}.example/" for index in range(5)]
+        calls = []
+        in_flight = {"now": 0, "max": 0}
+
+        async def search_category(api, url):
+            calls.append(url)
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+            await asyncio.sleep(0.05)
+            in_flight["now"] -= 1
+
+        record = {
+            "uid": 5, "website_url": "https://netfree.link/app/#/tools/traffic/view/abc",
+            "created_at": datetime(2024, 5, 1, 9, 30, tzinfo=timezone.utc),
+            "sender_email": "user@example.com", "username": "", "body": "",
+        }
+        traffic = ({"sector_block": urls[:3], "netfree_url": urls[2:], "counts": {}}, "1234")
+        with mock.patch("crm.mail_ingest.get_netfree_traffic_data", return_value=traffic), \
+                mock.patch("utils.netfree_async.AsyncNetfreeAPI.search_category", search_category):
+            rows = RequestWriter().traffic_requests(record)
+        self.assertEqual([row.requested_website for row in rows], urls)
+        self.assertEqual(sorted(calls), sorted(url.replace("https://", "http://") for url in urls))
+        self.assertGreater(in_flight["max"], 1)
+
+
+class FilterSettingsWriteBufferTests(TestCase):
+    CUSTOMER = "1234"
+
+    def setUp(self):
+        self.buffer = FilterSettingsWriteBuffer()
+        self.buffer.drain(self.CUSTOMER)
+        self.addCleanup(self.buffer.drain, self.CUSTOMER)
+        Emailrequest.objects.bulk_create([
+            email_request(1, "http://a.example", "<1@example.com>"),
+            email_request(2, "http://b.example", "<2@example.com>"),
+        ])
+        self.requests = list(Emailrequest.objects.order_by("email_id"))
+        Emailrequest.objects.update(netfree_sync_status="pending")
+
+    def enqueue_both(self):
+        with mock.patch("crm.tasks.flush_filter_settings.apply_async") as apply_async:
+            self.buffer.enqueue(self.requests[0], [{"url": "http://a.example", "rule": "open"}], "Open URL")
+            self.buffer.enqueue(self.requests[1], [{"url": "http://b.example", "rule": "open"}], "Open URL")
+        return apply_async
+
+    def statuses(self):
+        return list(Emailrequest.objects.order_by("email_id").values_list("netfree_sync_status", flat=True))
+
+    def test_requests_of_one_customer_share_one_flush(self):
+        apply_async = self.enqueue_both()
+        apply_async.assert_called_once()
+        with mock.patch("crm.netfree_sync.apply_filter_urls", return_value=True) as apply_filter_urls:
+            self.assertTrue(self.buffer.flush(self.CUSTOMER))
+        apply_filter_urls.assert_called_once()
+        self.assertEqual(
+            apply_filter_urls.call_args.args[2],
+            [{"url": "http://a.example", "rule": "open"}, {"url": "http://b.example", "rule": "open"}],
+        )
+        self.assertEqual(self.statuses(), ["done", "done"])
+        self.assertEqual(set(Emailrequest.objects.values_list("action_done", flat=True)), {"Open URL"})
+
+    def test_other_errors_put_the_entries_back(self):
+        self.enqueue_both()
+        with mock.patch("crm.netfree_sync.apply_filter_urls", side_effect=ValueError("not json")):
+            with self.assertRaises(ValueError):
+                self.buffer.flush(self.CUSTOMER)
+        self.assertEqual([item["request_id"] for item in self.buffer.drain(self.CUSTOMER)], [row.id for row in self.requests])
+        self.assertEqual(self.statuses(), ["pending", "pending"])
+
+    def test_last_attempt_marks_the_requests_failed(self):
+        self.enqueue_both()
+        with mock.patch("crm.netfree_sync.apply_filter_urls", side_effect=ValueError("not json")):
+            with self.assertRaises(ValueError):
+                self.buffer.flush(self.CUSTOMER, last_attempt=True)
+        self.assertEqual(self.buffer.drain(self.CUSTOMER), [])
+        self.assertEqual(self.statuses(), ["failed", "failed"])
+
+
+BASE64_TEXT_PART = b'("text" "plain" ("charset" "utf-8") NIL NIL "base64" 100 1 NIL NIL NIL)'
+
+
+def fetched_header(uid, subject):
+    header = f"Subject: {subject}\r\n\r\n".encode()
+    return (b"%d (UID %d BODYSTRUCTURE " % (uid, uid) + BASE64_TEXT_PART + b" " + HEADER + b" {%d}" % len(header), header), b")"
+
+
+def fetched_body(uid, text):
+    body = base64.b64encode(text.encode())
+    return (b"%d (UID %d BODY[1] {%d}" % (uid, uid, len(body)), body), b")"
+
+
+class FetchRequestsTests(SimpleTestCase):
+
+    def test_traffic_links_are_found_in_the_text_part(self):
+        request_subject = Header("\u05e4\u05e0\u05d9\u05d4 \u05de\u05d0\u05ea \u05de\u05e9\u05ea\u05de\u05e9 #1234", "utf-8").encode()
+        headers = [*fetched_header(1, request_subject), *fetched_header(2, "Fwd: recording"), *fetched_header(3, "Newsletter")]
+        bodies = [
+            *fetched_body(1, "please open http://a.example"),
+            *fetched_body(2, f"see {TRAFFIC_VIEW_PREFIX}/abc"),
+            *fetched_body(3, "https://news.example/traffic view"),
+        ]
+        imap_server = mock.Mock()
+        imap_server.uid.side_effect = [("OK", headers), ("OK", bodies)]
+        reader = MailboxReader(account=mock.Mock(email="requests@example.com"))
+        messages = reader.fetch_requests(imap_server, "INBOX", [1, 2, 3])
+        self.assertEqual([message.uid for message in messages], [1, 2])
+        # Gmail's word-based SEARCH BODY is not trusted to find the link.
+        self.assertEqual([call.args[0] for call in imap_server.uid.call_args_list], ["FETCH", "FETCH"])
+        self.assertEqual(imap_server.uid.call_args.args[1], "1,2,3")
+
+
+
+def raw_request(uid, url):
+    subject = Header("\u05e4\u05e0\u05d9\u05d4 \u05de\u05d0\u05ea \u05de\u05e9\u05ea\u05de\u05e9 #1234", "utf-8").encode()
+    header = f"Subject: {subject}\r\nFrom: User <user@example.com>\r\nDate: Wed, 01 May 2024 09:30:00 +0000\r\n\r\n".encode()
+    return RawMessage("requests@example.com", "INBOX", uid, 1, header, f"please open {url}".encode(), "7bit", "utf-8")
+
+
+class MailIngestCoordinatorTests(SimpleTestCase):
+
+    def ingest(self, processes):
+        raws = [raw_request(uid, f"http://site{uid}.example") for uid in range(1, 6)]
+
+        def read_folder(coordinator, account, folder, items):
+            for raw in raws:
+                items.put(raw)
+            items.put(Checkpoint(account.email, folder, 1, 5, 0, 0.0))
+            items.put(MailIngestCoordinator.DONE)
+
+        coordinator = MailIngestCoordinator(accounts=[mock.Mock(email="requests@example.com")], workers=1, processes=processes)
+        coordinator.writer = mock.Mock(stats={})
+        with mock.patch.object(MailIngestCoordinator, "list_folders", return_value=["INBOX"]), \
+                mock.patch.object(MailIngestCoordinator, "read_folder", autospec=True, side_effect=read_folder):
+            coordinator.ingest()
+        return [call.args[0] for call in coordinator.writer.handle.call_args_list]
+
+    @mock.patch("crm.mail_ingest.ProcessPoolExecutor", wraps=ProcessPoolExecutor)
+    def test_parse_pool_keeps_queue_order(self, pool):
+        handled = self.ingest(processes=2)
+        pool.assert_called_once()
+        self.assertEqual([item["uid"] for item in handled[:-1]], [1, 2, 3, 4, 5])
+        self.assertEqual(handled[0]["website_url"], "http://site1.example")
+        self.assertIsInstance(handled[-1], Checkpoint)
+
+    @mock.patch("crm.mail_ingest.ProcessPoolExecutor")
+    def test_daemon_process_parses_inline(self, pool):
+        with mock.patch("crm.mail_ingest.multiprocessing.current_process", return_value=mock.Mock(daemon=True)):
+            handled = self.ingest(processes=2)
+        pool.assert_not_called()
+        self.assertEqual(len(handled), 6)
+
+
+TRAFFIC = {
+    "user": {"id": 1},
+    "traffic": [
+        [{"url": "https://a.example/x"}, {"block": "sector"}, {"action": "open user::1234:: \u05d0\u05ea\u05e8"}],
+        [{"url": "http://b.example"}, {"block": "deny"}],
+        [{"url": "https://a.example/x"}, {"block": "sector"}],
+        [{"url": "ftp://c.example"}, {"block": "deny"}],
+        [{"url": "http://d.example/\u05e9"}, {"block": "deny"}, {"block": "sector"}],
+    ],
+    "total": 5,
+}
+
+
+def traffic_chunks(size):
+    raw = json.dumps(TRAFFIC, ensure_ascii=False).encode()
+    return [raw[start:start + size] for start in range(0, len(raw), size)]
+
+
+class ParseTrafficRecordTests(SimpleTestCase):
+
+    def test_entries_split_across_chunks(self):
+        # 7-byte chunks split tokens, the '"traffic": [' marker and multi-byte characters.
+        for size in (7, 64, 100000):
+            with self.subTest(size=size):
+                self.assertEqual(list(_iter_entries_raw_decode(traffic_chunks(size))), TRAFFIC["traffic"])
+
+    def test_blocked_urls_and_customer_id(self):
+        data, customer_id = parse_traffic_record(traffic_chunks(7))
+        self.assertEqual(customer_id, "1234")
+        self.assertEqual(data["sector_block"], ["https://a.example/x", "http://d.example/\u05e9"])
+        self.assertEqual(data["netfree_url"], ["http://b.example", "http://d.example/\u05e9"])
+        self.assertEqual(data["counts"], {"entries": 5, "netfree_url": 2, "sector_block": 2})
+
+    def test_empty_recording(self):
+        data, customer_id = parse_traffic_record([b'{"traffic": []}'])
+        self.assertIsNone(customer_id)
+        self.assertEqual(data["counts"]["entries"], 0)
+
+
+class GetNetfreeTrafficDataTests(SimpleTestCase):
+
+    def response(self, status_code):
+        response = mock.Mock(status_code=status_code)
+        response.iter_content.return_value = iter(traffic_chunks(64))
+        return response
+
+    def test_recording_is_streamed_and_closed(self):
+        response = self.response(200)
+        with mock.patch("utils.helper.NetfreeAPI.send_req", return_value=response) as send_req:
+            data, customer_id = get_netfree_traffic_data("https://netfree.link/app/#/tools/traffic/view/abc")
+        send_req.assert_called_once_with("abc", stream=True)
+        self.assertEqual(customer_id, "1234")
+        self.assertEqual(data["counts"]["entries"], 5)
+        response.close.assert_called_once()
+
+    def test_failed_request_is_closed(self):
+        response = self.response(404)
+        with mock.patch("utils.helper.NetfreeAPI.send_req", return_value=response):
+            self.assertFalse(get_netfree_traffic_data("https://netfree.link/app/#/tools/traffic/view/abc"))
+        response.iter_content.assert_not_called()
+        response.close.assert_called_once()
+
+
+class RemoveDuplicateCombinationsTests(SimpleTestCase):
+    NOW = 1_000_000
+
+    def test_drops_expired_rules(self):
+        data = [{"url": "http://b.example", "rule": "open", "exp": self.NOW - 1}]
+        self.assertEqual(remove_duplicate_combinations(data, now_ms=self.NOW), [])
+
+    def test_merges_normalized_duplicates_keeping_longest_expiry(self):
+        data = [
+            {"url": "HTTP://A.example/x/", "rule": "open", "exp": self.NOW + 10},
+            {"url": "http://a.example/x", "rule": "open", "exp": self.NOW + 50},
+            {"url": "http://a.example/x", "rule": "block"},
+        ]
+        self.assertEqual(remove_duplicate_combinations(data, now_ms=self.NOW), [
+            {"url": "HTTP://A.example/x/", "rule": "open", "exp": self.NOW + 50},
+            {"url": "http://a.example/x", "rule": "block"},
+        ])
+        # The input entries are left alone.
+        self.assertEqual(data[0]["exp"], self.NOW + 10)
+
+    def test_permanent_rule_wins(self):
+        data = [
+            {"url": "http://c.example", "rule": "open", "exp": self.NOW + 5},
+            {"url": "http://c.example/", "rule": "open"},
+            {"url": "http://c.example", "rule": "open", "exp": self.NOW + 99},
+        ]
+        self.assertEqual(remove_duplicate_combinations(data, now_ms=self.NOW), [{"url": "http://c.example", "rule": "open"}])
+
+    def test_post_user_data_sends_compacted_urls(self):
+        urls = [
+            {"url": "http://a.example", "rule": "open", "exp": 1},
+            {"url": "http://b.example/", "rule": "open"},
+            {"url": "http://b.example", "rule": "open"},
+        ]
+        data = {"filterSettings": {"mode": 1}, "inspectorSettings": {"urls": []}}
+        with mock.patch("utils.helper.NetfreeAPI.request") as request:
+            NetfreeAPI().post_user_data("1234", urls, data)
+        payload = request.call_args.kwargs["json"]
+        self.assertEqual(payload["id"], 1234)
+        self.assertEqual(payload["inspectorSettings"]["urls"], [{"url": "http://b.example/", "rule": "open"}])
+
+
+class NetfreeSessionTests(SimpleTestCase):
+    USERNAME = "0500000000"
+
+    def setUp(self):
+        self.addCleanup(cache.delete_many, [f"netfree-session:{self.USERNAME}", f"netfree-session:{self.USERNAME}:lock"])
+        cache.delete(f"netfree-session:{self.USERNAME}")
+        patcher = mock.patch("utils.netfree_session.NetfreeSession._login", autospec=True, side_effect=self.login)
+        self.login_calls = 0
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def login(self, session, http, headers):
+        self.login_calls += 1
+        time.sleep(0.05)
+        return f"sid={self.login_calls}", 60
+
+    def session(self):
+        return NetfreeSession(self.USERNAME, "secret")
+
+    def test_cookie_is_shared_between_workers(self):
+        self.assertEqual(self.session().get_cookie(None, {}), "sid=1")
+        # A second instance stands in for another worker process.
+        self.assertEqual(self.session().get_cookie(None, {}), "sid=1")
+        self.assertEqual(self.login_calls, 1)
+
+    def test_concurrent_callers_log_in_once(self):
+        cookies = []
+        threads = [threading.Thread(target=lambda: cookies.append(self.session().get_cookie(None, {}))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cookies, ["sid=1"] * 5)
+        self.assertEqual(self.login_calls, 1)
+
+    def test_rejected_cookie_triggers_one_new_login(self):
+        session, other = self.session(), self.session()
+        cookie = session.get_cookie(None, {})
+        other.get_cookie(None, {})
+        session.invalidate(cookie)
+        self.assertEqual(session.get_cookie(None, {}), "sid=2")
+        # The other worker drops its copy on its own 401 and picks up the new login.
+        other.invalidate(cookie)
+        self.assertEqual(other.get_cookie(None, {}), "sid=2")
+        self.assertEqual(self.login_calls, 2)
+
+
+@override_settings(NETFREE_BREAKER_THRESHOLD=3, NETFREE_BREAKER_FAILURE_RATE=0.5)
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(name="test-netfree")
+        keys = [self.breaker.failures_key, self.breaker.successes_key, self.breaker.open_key,
+                self.breaker.tripped_key, self.breaker.probe_key]
+        cache.delete_many(keys)
+        self.addCleanup(cache.delete_many, keys)
+
+    def record(self, outcomes):
+        for outcome in outcomes:
+            if outcome:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def test_opens_after_threshold_failures(self):
+        self.record([False, False])
+        self.assertTrue(self.breaker.allow())
+        self.record([False])
+        self.assertTrue(self.breaker.is_open())
+        with self.assertRaises(NetfreeUnavailable):
+            self.breaker.check()
+
+    def test_interleaved_successes_do_not_hide_failures(self):
+        self.record([False, True] * 3)
+        self.assertTrue(self.breaker.is_open())
+
+    def test_occasional_failures_keep_it_closed(self):
+        self.record(([True] * 5 + [False]) * 3)
+        self.assertFalse(self.breaker.is_open())
+
+    def test_half_open_lets_one_probe_through(self):
+        self.breaker.open()
+        self.assertFalse(self.breaker.allow())
+        # The reset period is over.
+        cache.delete(self.breaker.open_key)
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_it_again(self):
+        self.breaker.open()
+        cache.delete(self.breaker.open_key)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open())
+
+
+@override_settings(NETFREE_LIMITER_MAX_RATE=2, NETFREE_LIMITER_MAX_CONCURRENCY=2, NETFREE_LIMITER_MAX_WAIT=0.2)
+class AdaptiveLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.limiter = AdaptiveLimiter()
+        keys = [self.limiter.BUCKET_KEY, self.limiter.RATE_KEY, self.limiter.DECREASE_KEY]
+        self.limiter.redis().delete(*keys)
+        self.addCleanup(self.limiter.redis().delete, *keys)
+
+    def test_token_bucket_caps_the_burst(self):
+        for _ in range(2):
+            self.limiter.release(self.limiter.acquire())
+        with self.assertRaises(NetfreeUnavailable):
+            self.limiter.acquire()
+        self.assertEqual(self.limiter.in_flight, 0)
+
+    def test_local_cap_on_requests_in_flight(self):
+        self.limiter.redis().set(self.limiter.RATE_KEY, 100)
+        self.limiter.acquire()
+        self.limiter.acquire()
+        with self.assertRaises(NetfreeUnavailable):
+            self.limiter.acquire()
+
+    def test_throttling_halves_the_limit_and_rate_once(self):
+        self.limiter.release(self.limiter.acquire(), throttled=True)
+        self.limiter.release(self.limiter.acquire(), throttled=True)
+        self.assertEqual(self.limiter.limit, 1.0)
+        self.assertEqual(float(self.limiter.redis().get(self.limiter.RATE_KEY)), 1.0)
+
+    def test_redis_errors_fail_open(self):
+        self.limiter._script = mock.Mock(side_effect=RedisError("down"))
+        for _ in range(3):
+            self.limiter.release(self.limiter.acquire())
+        # Redis is skipped for a while after the first error.
+        self.limiter._script.assert_called_once()
+        self.assertIsNone(self.limiter.redis())
+
+    def test_release_survives_redis_errors(self):
+        started = self.limiter.acquire()
+        with mock.patch.object(self.limiter.redis(), "get", side_effect=RedisError("down")):
+            self.limiter.release(started, throttled=True)
+        self.assertEqual(self.limiter.in_flight, 0)
+
+
+class LocalLRUTests(SimpleTestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = LocalLRU(2, 60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEqual((lru.get("a"), lru.get("b"), lru.get("c")), (1, None, 3))
+
+    def test_expired_entries_are_dropped(self):
+        lru = LocalLRU(2, 60)
+        lru.set("a", 1, ttl=-1)
+        self.assertIsNone(lru.get("a"))
+
+
+class CategoryCacheTests(SimpleTestCase):
+    TAGS = json.dumps({"tagValue": {"tags": [{"id": 7}]}}).encode()
+
+    def setUp(self):
+        CategoryCache().invalidate()
+
+    def test_search_strings_are_normalized(self):
+        categories = CategoryCache()
+        categories.set_host("https://Example.com/", "example.com")
+        self.assertEqual(categories.get_host("example.com"), "example.com")
+        self.assertEqual(categories.get_host("http://EXAMPLE.com"), "example.com")
+        self.assertIsNone(categories.get_host("example.com/path"))
+
+    def test_hosts_without_tags_are_cached_briefly(self):
+        categories = CategoryCache()
+        categories.set_host("nothing.example", "")
+        self.assertEqual(categories.get_host("nothing.example"), "")
+        key = f"netfree-category-cache:{categories.version()}:search:nothing.example"
+        self.assertLessEqual(cache.ttl(key), categories.negative_ttl)
+
+    def test_local_hits_skip_redis(self):
+        categories = CategoryCache()
+        categories.set_tags("example.com", self.TAGS, True)
+        with mock.patch("utils.netfree_cache.cache.get") as shared_get:
+            self.assertEqual(categories.get_tags("example.com"), self.TAGS)
+        shared_get.assert_not_called()
+        self.assertEqual(categories.stats["local_hits"], 1)
+
+    @override_settings(NETFREE_CATEGORY_VERSION_TTL=0)
+    def test_full_invalidation_reaches_other_workers(self):
+        worker, other = CategoryCache(), CategoryCache()
+        worker.set_tags("example.com", self.TAGS, True)
+        self.assertEqual(other.get_tags("example.com"), self.TAGS)
+        worker.invalidate()
+        self.assertIsNone(other.get_tags("example.com"))
+
+    def test_search_category_looks_a_url_up_once(self):
+        api = NetfreeAPI()
+        found = NetfreeResponse(200, json.dumps({"foundHost": "example.com"}).encode())
+        tags = NetfreeResponse(200, self.TAGS)
+        with mock.patch("utils.helper.category_cache", CategoryCache()), \
+                mock.patch.object(NetfreeAPI, "find_domain", return_value=found) as find_domain, \
+                mock.patch.object(NetfreeAPI, "request", return_value=tags) as request:
+            first = api.search_category("http://example.com/page")
+            second = api.search_category("http://example.com/page")
+        self.assertEqual(first.content, self.TAGS)
+        self.assertEqual(second.json(), json.loads(self.TAGS))
+        find_domain.assert_called_once()
+        request.assert_called_once()
+
+
+class FilterSettingsShadowTests(TestCase):
+    CUSTOMER = "1234"
+    OPEN_A = {"url": "http://a.example", "rule": "open"}
+    OPEN_B = {"url": "http://b.example", "rule": "open"}
+
+    def setUp(self):
+        self.netfree_api = mock.Mock()
+        self.netfree_api.get_user_deatils.return_value = NetfreeResponse(
+            200, json.dumps({"filterSettings": {}, "inspectorSettings": {"urls": [self.OPEN_A]}}).encode()
+        )
+        self.netfree_api.post_user_data.side_effect = self.post_user_data
+        self.post_status = [200]
+
+    def post_user_data(self, user_id, urls, data):
+        data["inspectorSettings"]["urls"] = urls
+        return NetfreeResponse(self.post_status.pop(0), b"{}")
+
+    def shadow(self):
+        return FilterSettingsShadow.objects.get(customer_id=self.CUSTOMER)
+
+    def test_only_rule_changes_bump_the_version(self):
+        store_filter_settings(self.CUSTOMER, {"inspectorSettings": {"urls": [self.OPEN_A]}})
+        store_filter_settings(self.CUSTOMER, {"inspectorSettings": {"urls": [self.OPEN_A]}})
+        store_filter_settings(self.CUSTOMER, {"inspectorSettings": {"urls": [self.OPEN_B]}}, source="sweep")
+        self.assertEqual(self.shadow().version, 2)
+        change = self.shadow().changes.get(version=2)
+        self.assertEqual((change.source, change.added, change.removed), ("sweep", [self.OPEN_B], [self.OPEN_A]))
+
+    def test_fresh_shadow_saves_the_read(self):
+        store_filter_settings(self.CUSTOMER, {"inspectorSettings": {"urls": [self.OPEN_A]}})
+        self.assertTrue(apply_filter_urls(self.netfree_api, self.CUSTOMER, [self.OPEN_B]))
+        self.netfree_api.get_user_deatils.assert_not_called()
+        self.assertEqual(self.netfree_api.post_user_data.call_args.args[1], [self.OPEN_B, self.OPEN_A])
+        change = self.shadow().changes.latest("version")
+        self.assertEqual((change.source, change.added, change.removed), ("email-request", [self.OPEN_B], []))
+
+    def test_unchanged_rules_are_not_written(self):
+        self.assertTrue(apply_filter_urls(self.netfree_api, self.CUSTOMER, [self.OPEN_A]))
+        self.netfree_api.get_user_deatils.assert_called_once()
+        self.netfree_api.post_user_data.assert_not_called()
+
+    def test_rejected_write_from_shadow_is_retried_on_fresh_data(self):
+        store_filter_settings(self.CUSTOMER, {"inspectorSettings": {"urls": []}})
+        self.post_status = [409, 200]
+        self.assertTrue(apply_filter_urls(self.netfree_api, self.CUSTOMER, [self.OPEN_B]))
+        self.netfree_api.get_user_deatils.assert_called_once()
+        self.assertEqual(self.netfree_api.post_user_data.call_count, 2)
+        self.assertEqual(self.shadow().inspector_settings["urls"], [self.OPEN_B, self.OPEN_A])
+
+
+def user_details(urls, status_code=200):
+    return NetfreeResponse(status_code, json.dumps({"filterSettings": {}, "inspectorSettings": {"urls": urls}}).encode())
+
+
+STALE_URLS = [{"url": "http://a.example", "rule": "open", "exp": 1}, {"url": "http://b.example", "rule": "open"}]
+
+
+class FilterSettingsSweeperTests(TestCase):
+
+    def setUp(self):
+        keys = [FilterSettingsSweeper.CURSOR_KEY, FilterSettingsSweeper.STATS_KEY, FilterSettingsSweeper.RUNNING_KEY]
+        cache.delete_many(keys)
+        self.addCleanup(cache.delete_many, keys)
+        NetfreeUser.objects.bulk_create([
+            NetfreeUser(user_id=user_id, email=f"{user_id}@example.com", netfree_profile=None)
+            for user_id in ("1001", "1002", "1003")
+        ])
+        self.details = {
+            "1001": user_details(STALE_URLS),
+            "1002": user_details(STALE_URLS[1:]),
+            "1003": user_details([], status_code=500),
+        }
+
+    def fan_out(self, method, customer_ids, concurrency=None):
+        return [self.details[customer_id] for customer_id in customer_ids]
+
+    @mock.patch("crm.netfree_sweep.compact_customer", return_value=17)
+    def test_only_stale_customers_are_written(self, compact_customer):
+        with mock.patch("crm.netfree_sweep.netfree_fan_out", side_effect=self.fan_out):
+            stats = FilterSettingsSweeper().run()
+        compact_customer.assert_called_once_with(mock.ANY, "1001")
+        self.assertEqual(
+            {key: stats[key] for key in ("customers", "stale", "written", "errors", "bytes_saved", "completed")},
+            {"customers": 3, "stale": 1, "written": 1, "errors": 1, "bytes_saved": 17, "completed": True},
+        )
+        self.assertEqual(FilterSettingsSweeper().cursor(), 0)
+        self.assertEqual(FilterSettingsSweeper().last_stats(), stats)
+
+    @mock.patch("crm.netfree_sweep.compact_customer")
+    def test_dry_run_writes_nothing(self, compact_customer):
+        with mock.patch("crm.netfree_sweep.netfree_fan_out", side_effect=self.fan_out):
+            stats = FilterSettingsSweeper(dry_run=True).run()
+        compact_customer.assert_not_called()
+        self.assertEqual(stats["stale"], 1)
+        self.assertGreater(stats["bytes_saved"], 0)
+
+    @mock.patch("crm.netfree_sweep.compact_customer", return_value=0)
+    def test_outage_resumes_at_the_failed_batch(self, compact_customer):
+        outage = [self.details["1001"]], [NetfreeUnavailable("down")]
+        with mock.patch("crm.netfree_sweep.netfree_fan_out", side_effect=outage):
+            with self.assertRaises(NetfreeUnavailable):
+                FilterSettingsSweeper(batch_size=1).run()
+        with mock.patch("crm.netfree_sweep.netfree_fan_out", side_effect=self.fan_out) as fan_out:
+            FilterSettingsSweeper(batch_size=2).run()
+        self.assertEqual(fan_out.call_args_list[0].args[1], ["1002", "1003"])
+
+    def test_overlapping_run_is_skipped(self):
+        cache.add(FilterSettingsSweeper.RUNNING_KEY, 1)
+        with mock.patch("crm.netfree_sweep.netfree_fan_out") as fan_out:
+            self.assertIsNone(FilterSettingsSweeper().run())
+        fan_out.assert_not_called()
+
+    def test_compact_customer_posts_the_pruned_list(self):
+        netfree_api = mock.Mock()
+        netfree_api.get_user_deatils.return_value = user_details(STALE_URLS)
+        netfree_api.post_user_data.return_value = NetfreeResponse(200, b"{}")
+        saved = compact_customer(netfree_api, "1001")
+        self.assertGreater(saved, 0)
+        self.assertEqual(netfree_api.post_user_data.call_args.args[1], STALE_URLS[1:])
+
+
+class CategorySyncTests(TestCase):
+    TAGS = [{"id": 1, "description": "new"}, {"id": 2, "description": "two"}, {"id": 5, "description": "five"}]
+
+    def setUp(self):
+        cache.delete(category_sync.HASH_KEY)
+        self.addCleanup(cache.delete, category_sync.HASH_KEY)
+        self.netfree_api = mock.Mock()
+        self.netfree_api.get_tags_list.return_value = NetfreeResponse(200, json.dumps({"list": self.TAGS}).encode())
+
+    def test_bulk_diff(self):
+        Categories.objects.bulk_create([
+            Categories(categories_id=1, description="old"),
+            Categories(categories_id=2, description="two"),
+            Categories(categories_id=2, description="two"),
+            Categories(categories_id=3, description="gone"),
+            Categories(categories_id=4, description="still used"),
+        ])
+        duplicate = Categories.objects.filter(categories_id=2).order_by("id").last()
+        used = Categories.objects.get(categories_id=4)
+        NetfreeTraffic.objects.bulk_create([
+            NetfreeTraffic(category=duplicate, netfree_profile=None),
+            NetfreeTraffic(category=used, netfree_profile=None),
+        ])
+        result = category_sync.apply_categories(self.TAGS)
+        self.assertEqual(result, {"created": 1, "updated": 1, "deleted": 1, "kept_referenced": 1, "duplicates_removed": 1})
+        self.assertEqual(
+            sorted(Categories.objects.values_list("categories_id", "description")),
+            [(1, "new"), (2, "two"), (4, "still used"), (5, "five")],
+        )
+        kept = Categories.objects.get(categories_id=2)
+        self.assertEqual(NetfreeTraffic.objects.filter(category=kept).count(), 1)
+
+    def test_unchanged_tag_list_is_skipped(self):
+        first = category_sync.sync_categories("job-1", netfree_api=self.netfree_api)
+        second = category_sync.sync_categories("job-2", netfree_api=self.netfree_api)
+        self.assertEqual(first["created"], 3)
+        self.assertEqual(second, {"skipped": True, "tags": 3})
+        self.assertEqual(category_sync.get_job_status("job-2")["status"], "done")
+        forced = category_sync.sync_categories(netfree_api=self.netfree_api, force=True)
+        self.assertEqual(forced["created"], 0)
+
+    def test_failed_fetch_marks_the_job_failed(self):
+        self.netfree_api.get_tags_list.return_value = NetfreeResponse(503, b"")
+        self.assertIsNone(category_sync.sync_categories("job-3", netfree_api=self.netfree_api))
+        self.assertEqual(category_sync.get_job_status("job-3")["status"], "failed")
+        self.assertFalse(Categories.objects.exists())
+
+
+class CassetteTests(SimpleTestCase):
+    BASE = "https://netfree.link"
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "netfree.cassette.gz")
+
+    def record(self, calls):
+        cassette = Cassette(self.path, "record")
+        with mock.patch.object(cassette.session, "request", side_effect=[
+            mock.Mock(status_code=status_code, text=text) for _, _, status_code, text in calls
+        ]):
+            for path, kwargs, _, _ in calls:
+                cassette.request("POST", self.BASE + path, **kwargs)
+        cassette.close()
+
+    def test_replay_returns_recorded_answers_in_order(self):
+        self.record([
+            ("/api/tags/search-url", {"json": {"search": "a.example"}}, 200, '{"n":1}'),
+            ("/api/tags/search-url", {"data": '{"search": "a.example"}'}, 200, '{"n":2}'),
+        ])
+        self.assertTrue(os.path.exists(process_path(self.path)))
+        cassette = Cassette(self.path, "replay")
+        answers = [cassette.post(self.BASE + "/api/tags/search-url", json={"search": "a.example"}).json() for _ in range(3)]
+        self.assertEqual(answers, [{"n": 1}, {"n": 2}, {"n": 2}])
+        with self.assertRaises(CassetteMiss):
+            cassette.post(self.BASE + "/api/tags/search-url", json={"search": "b.example"})
+
+    def test_credentials_stay_out_of_the_file(self):
+        self.record([("/api/user/login-by-password", {"json": {"phone": "0500000000", "password": "secret"}}, 200, "{}")])
+        with gzip.open(process_path(self.path), "rt", encoding="utf-8") as fp:
+            recorded = fp.read()
+        self.assertNotIn("secret", recorded)
+        self.assertNotIn("0500000000", recorded)
+        response = Cassette(self.path, "replay").post(self.BASE + "/api/user/login-by-password", json={"phone": "1", "password": "2"})
+        self.assertEqual(response.cookies.get("connect.sid"), REPLAY_COOKIE)
+
+    def test_caches_are_isolated_while_a_cassette_is_active(self):
+        self.record([("/api/tags/search-url", {"json": {}}, 200, "{}")])
+        self.addCleanup(use_cassette, None, None)
+        cassette = use_cassette(self.path, "replay")
+        self.assertIs(shared_cache(), cassette.cache)
+        use_cassette(None, None)
+        self.assertIs(shared_cache(), cache)
+
+
+class FakeNetfreeServerTests(SimpleTestCase):
+
+    def start(self, **options):
+        server = make_server("127.0.0.1", 0, customers=3, **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def test_filter_settings_round_trip(self):
+        base = self.start()
+        http = requests.Session()
+        self.assertEqual(http.get(base + "/api/user/get-filter-settings?id=1000").status_code, 401)
+        http.post(base + "/api/user/login-by-password", json={"phone": "1", "password": "2"})
+        urls = [{"url": "http://a.example", "rule": "open"}]
+        http.post(base + "/user/ajax/set-filter-settings", json={"id": 1000, "filterSettings": {}, "inspectorSettings": {"urls": urls}})
+        self.assertEqual(http.get(base + "/api/user/get-filter-settings?id=1000").json()["inspectorSettings"]["urls"], urls)
+        self.assertEqual(http.get(base + "/api/user/get-filter-settings?id=5").status_code, 404)
+        self.assertEqual(http.get(base + "/__stats").json()["/api/user/get-filter-settings"], 3)
+
+    def test_same_seed_same_data(self):
+        def seeded(seed):
+            state = FakeNetfreeState(seed=seed, customers=20)
+            # Expiry times are relative to now, so compare the urls only.
+            return state.host_tags, {
+                customer_id: [entry["url"] for entry in customer["inspectorSettings"]["urls"]]
+                for customer_id, customer in state.customers.items()
+            }
+        self.assertEqual(seeded(4), seeded(4))
+        self.assertNotEqual(seeded(4), seeded(5))
+
+    def test_rate_limit_answers_429(self):
+        base = self.start(rate_limit=2)
+        statuses = [requests.post(base + "/api/tags/list").status_code for _ in range(3)]
+        self.assertEqual(statuses, [401, 401, 429])
+
+    def test_netfree_api_against_the_fake_server(self):
+        base = self.start()
+        with override_settings(NETFREE_BASE_URL=base):
+            response = NetfreeAPI().get_user_deatils("1001")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("urls", response.json()["inspectorSettings"])
+
+
+class ImapIdleSupervisorTests(TestCase):
+    EMAILS = ("requests@example.com", "office@example.com")
+
+    def setUp(self):
+        SMTPEmail.objects.bulk_create([SMTPEmail(email=email, password="x") for email in self.EMAILS])
+        keys = [heartbeat_key(email) for email in self.EMAILS] + [SAFETY_RUN_KEY]
+        cache.delete_many(keys)
+        self.addCleanup(cache.delete_many, keys)
 
-# Log in to the server using the provided email credentials
-imap_server.login(FROM_EMAIL, FROM_PWD)
+    def start_listeners(self, supervisor):
+        started = threading.Semaphore(0)
 
+        def run_forever(listener):
+            listener.connected = True
+            started.release()
 
-# _, mailbox_list = imap_server.list()
+        with mock.patch.object(MailboxReader, "connect"), \
+                mock.patch.object(MailboxReader, "find_folders", return_value=["INBOX", "Label"]), \
+                mock.patch.object(ImapIdleListener, "run_forever", autospec=True, side_effect=run_forever):
+            for account in supervisor.accounts:
+                supervisor.watch_account(account)
+            for _ in range(2 * len(supervisor.accounts)):
+                self.assertTrue(started.acquire(timeout=5))
 
-# print("JJJJ", mailbox_list)
+    def test_one_listener_per_account_and_folder(self):
+        supervisor = ImapIdleSupervisor()
+        self.start_listeners(supervisor)
+        self.assertEqual(
+            sorted((listener.account.email, listener.folder) for listeners in supervisor.listeners.values() for listener in listeners),
+            sorted((email, folder) for email in self.EMAILS for folder in ("INBOX", "Label")),
+        )
+        supervisor.heartbeat()
+        self.assertTrue(idle_covers_all_accounts())
 
-# List of mailbox names you want to fetch emails from
-mailbox_list = ['Sent', "INBOX",  "SENT", "SPAM", "TRASH", "JUNK"]
-mailbox_list = ["INBOX", "Sent", "Drafts", "Deleted Messages"]
-mailbox_list = ["INBOX", "Sent",]
+    def test_a_dropped_folder_takes_its_account_off_the_heartbeat(self):
+        supervisor = ImapIdleSupervisor()
+        self.start_listeners(supervisor)
+        supervisor.listeners["office@example.com"][1].connected = False
+        supervisor.heartbeat()
+        self.assertEqual(cache.get(heartbeat_key("requests@example.com")), 1)
+        self.assertIsNone(cache.get(heartbeat_key("office@example.com")))
+        self.assertFalse(idle_covers_all_accounts())
 
-# Iterate through each mailbox and fetch emails
-for mailbox in mailbox_list:
-    fetch_emails_from_mailbox(imap_server, mailbox)
+    @mock.patch("crm.tasks.ReadEmail")
+    def test_read_emails_polls_until_every_account_is_covered(self, read_email):
+        read_emails()
+        read_emails()
+        self.assertEqual(read_email.call_count, 2)
+        cache.set_many({heartbeat_key(email): 1 for email in self.EMAILS})
+        read_emails()
+        read_emails()
+        # Only the safety run within EMAIL_IDLE_SAFETY_INTERVAL.
+        self.assertEqual(read_email.call_count, 3)
 
-# Close the IMAP connection
-imap_server.logout()
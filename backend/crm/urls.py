@@ -6,6 +6,7 @@ urlpatterns = [
      path("category/", views.CategoriesView.as_view()),
      path("netfree-traffic/", views.NetfreeTrafficView.as_view()),
      path("settings/", views.FetchUserSettingsView.as_view()),
+     path("netfree-metrics/", views.NetfreeMetricsView.as_view()),
      path("requests/", views.EmailRequestView.as_view()),
      path("actions/", views.ActionsView.as_view()),
      path("template/", views.EmailTemplatesView.as_view()),
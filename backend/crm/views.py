@@ -1,5 +1,4 @@
 import time
-from crm.manager import NetfreeProcessor
 from crm.serializer import ActionsSerializer, NetfreeTrafficSerializer
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -9,27 +8,26 @@ from crm.serializer import (
     EmailTemplateSchema
 )
 from utils.helper import (
-    get_netfree_traffic_data, generate_unique_string,
-    gmail_checker,capture_error
+    generate_unique_string,
+    gmail_checker,NetfreeAPI
 )
+from crm.category_sync import get_job_status, set_job_status
+from utils.netfree_cache import category_cache
+from utils.netfree_metrics import metrics
+from utils.netfree_resilience import NetfreeUnavailable
 from django.conf import settings
 from datetime import datetime,timedelta
 from django.utils import timezone
+from django.http import HttpResponse
 import requests
 from rest_framework import status
 from .models import NetfreeCategoriesProfile
 from .serializer import NetfreeCategoriesProfileSerializer
 from crm.models import Emailrequest,NetfreeTraffic,Categories,Actions,EmailTemplate,SMTPEmail
-import imaplib
-import email
-import traceback
-import re
 import uuid
 import json
 import logging
-import sys
-from django.core.cache import cache
-from django.db import transaction
+from crm.mail_ingest import MailIngestCoordinator
 cronjob_log = logging.getLogger('cronjob-log')
 cronjob_error_log = logging.getLogger('cronjob-error')
 
@@ -213,6 +211,17 @@ class CategoriesView(APIView):
 
     def get(self, request):
         params = self.request.query_params
+        if params.get("job"):
+            job = get_job_status(params.get("job"))
+            if job is None:
+                return Response({
+                    "success": False,
+                    "message": "Unknown job id"
+                }, status=404)
+            return Response({
+                "success": True,
+                "data": job
+            })
         lang = params.get("lang")
         profile = params.get("profile")
         if profile is None:
@@ -227,7 +236,13 @@ class CategoriesView(APIView):
                 "message": "profile id invalid"
             }, status=400)
         if params.get("search", None):
-            response = self.search_category(params.get("search"))
+            try:
+                response = self.search_category(params.get("search"))
+            except NetfreeUnavailable:
+                return Response({
+                    "success": False,
+                    "message": "Netfree is unavailable, Please try again later"
+                }, status=503)
             if response.status_code == 200:
                 try:
                     keys = response.json()["tagValue"]["tags"].keys()
@@ -249,17 +264,16 @@ class CategoriesView(APIView):
         )
 
     def post(self, request):
-        try:
-            self.fetch_categories()
-            return Response({
-                "success": True,
-                "message": "Updated successfully"
-            }, status=200)
-        except Exception:
-            return Response({
-                "success": False,
-                "message": "Something went wrong, Please try again later"
-            }, status=400)
+        from crm.tasks import sync_netfree_categories
+        force = str(request.data.get("force", "")).lower() in ("1", "true")
+        job_id = uuid.uuid4().hex
+        set_job_status(job_id, "queued")
+        sync_netfree_categories.apply_async(kwargs={"force": force}, task_id=job_id)
+        return Response({
+            "success": True,
+            "message": "Category sync started",
+            "data": {"job_id": job_id}
+        }, status=202)
 
     def put(self, request):
         param = request.data
@@ -381,150 +395,41 @@ class CategoriesView(APIView):
                 "message": str(e)
             }, status=400)
 
-    def fetch_categories(self):
-        response = self.api_request()
-
-        if response.status_code == 200:
-            categories = response.json().get("list")
-            # Process the categories and save them to your database
-            for category in categories:
-                category_id = category['id']
-                category_description = category['description']
-                Categories.objects.update_or_create(
-                    categories_id=category_id,
-                    defaults={
-                        "description": category_description
-                    }
-                )
-
-            # Return or process the categories as needed
-            return True
-        return False
-
-    def api_request(self):
-        login_url = 'https://netfree.link/api/user/login-by-password'
-        tags_url = 'https://netfree.link/api/tags/list'
-        headers = {
-            'authority': 'netfree.link',
-            'accept': 'application/json, text/plain, */*',
-            'accept-language': 'en-US,en;q=0.9',
-            'content-type': 'application/json',
-            'origin': 'https://netfree.link',
-            'referer': 'https://netfree.link/app/',
-            'sec-ch-ua': '"Chromium";v="112", "Google Chrome";v="112", "Not:A-Brand";v="99"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"macOS"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36'
-        }
-        login_data = {
-            'password': settings.USER_PASSWORD,
-            'phone': settings.USERNAME
-        }
-        # Static for testing only
-        tags_data = {
-            'inspector': True
-        }
-        session = requests.Session()
-        login_response = session.post(login_url, headers=headers, json=login_data)
-        cookie = login_response.cookies.get_dict()
-        headers['cookie'] = '; '.join([f"{name}={value}" for name, value in cookie.items()])
-        tags_response = session.post(tags_url, headers=headers, json=tags_data)
-
-        return tags_response
-
     def search_category(self, params):
-        url = "https://netfree.link/api/tags/value/edit/get"
-        login_url = 'https://netfree.link/api/user/login-by-password'
-
-        USER_PASSWORD = settings.USER_PASSWORD
-        USERNAME = settings.USERNAME
-
-        login_data = {
-            'password': USER_PASSWORD,
-            'phone': USERNAME
-        }
-
-        valid_domain = self.find_domain(params)
-        domain = valid_domain.json().get("foundHost","") if valid_domain.status_code == 200 else ""
-        payload = json.dumps({
-            "host": str(domain)
-        })
-        headers = {
-            'authority': 'netfree.link',
-            'accept': 'application/json, text/plain, */*',
-            'accept-language': 'en-GB,en-US;q=0.9,en;q=0.8',
-            'content-type': 'application/json',
-            'origin': 'https://netfree.link',
-            'referer': 'https://netfree.link/app/',
-            'save-data': 'on',
-            'sec-ch-ua': '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36'
-        }
-
-        session = requests.Session()
-        login_response = session.post(login_url, headers=headers, json=login_data)
-        cookie = login_response.cookies.get_dict()
-        headers['cookie'] = '; '.join([f"{name}={value}" for name, value in cookie.items()])
-        tags_response = session.post(url, headers=headers, data=payload)
-        return tags_response
+        return NetfreeAPI().search_category(params)
 
-    def find_domain(self, params):
-        url = "https://netfree.link/api/tags/search-url"
-        login_url = 'https://netfree.link/api/user/login-by-password'
-
-        USER_PASSWORD = settings.USER_PASSWORD
-        USERNAME = settings.USERNAME
-
-        login_data = {
-            'password': USER_PASSWORD,
-            'phone': USERNAME
-        }
-
-        payload = json.dumps({
-            "search": params
-        })
-        headers = {
-            'authority': 'netfree.link',
-            'accept': 'application/json, text/plain, */*',
-            'accept-language': 'en-GB,en-US;q=0.9,en;q=0.8',
-            'content-type': 'application/json',
-            'origin': 'https://netfree.link',
-            'referer': 'https://netfree.link/app/',
-            'save-data': 'on',
-            'sec-ch-ua': '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36'
-        }
-
-        session = requests.Session()
-        login_response = session.post(login_url, headers=headers, json=login_data)
-        cookie = login_response.cookies.get_dict()
-        headers['cookie'] = '; '.join([f"{name}={value}" for name, value in cookie.items()])
-        response = session.post(url, headers=headers, data=payload)
-        return response
+    def delete(self, request):
+        host = self.request.query_params.get("host")
+        category_cache.invalidate(host)
+        return Response({
+            "success": True,
+            "message": "Category cache cleared"
+        }, status=200)
 
 class FetchUserSettingsView(APIView):
 
     def get(self, *args, **options):
         user_id = 7722 # Static for testing
-        url = f"https://netfree.link/api/user/get-filter-settings?id={user_id}"
-        response = requests.get(url)
+        url = f"{settings.NETFREE_BASE_URL}/api/user/get-filter-settings?id={user_id}"
+        response = metrics.request(requests, "GET", url, client="settings-view", timeout=settings.NETFREE_TIMEOUT)
         data = response.json()
         return Response(data)
 
 
+class NetfreeMetricsView(APIView):
+    # Scraped by Prometheus, so it takes a static token instead of a JWT.
+    # Without NETFREE_METRICS_TOKEN the endpoint stays closed.
+    authentication_classes = []
+
+    def get(self, request):
+        token = settings.NETFREE_METRICS_TOKEN
+        if not token:
+            return HttpResponse("metrics token not configured\n", status=403, content_type="text/plain")
+        if request.headers.get("Authorization") != f"Bearer {token}":
+            return HttpResponse("forbidden\n", status=403, content_type="text/plain")
+        return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 class EmailRequestView(APIView):
 
     def get(self, *args, **options):
@@ -984,234 +889,9 @@ class SMTPEmailView(APIView):
 
 
 class ReadEmail():
-    def _get_last_processed_timestamp(self, key):
-        last_processed = cache.get(key + '_last_processed_timestamp')
-        if last_processed is None:
-            return datetime.min.replace(tzinfo=timezone.utc)
-        return datetime.strptime(last_processed, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
-
-    def _update_last_processed_timestamp(self, key, timestamp):
-        cache.set(key + '_last_processed_timestamp', timestamp)
-
+    # The IMAP ingestion lives in crm.mail_ingest; this keeps the task entry point.
     def read_email_from_gmail(self):
-        print("working!!")
-        cronjob_log.info(f"Cronjob start at {datetime.now()}")
-
-        instance = SMTPEmail.objects.last()
-        FROM_EMAIL = ""
-        FROM_PWD = ""
-        if instance:
-            FROM_EMAIL = instance.email
-            FROM_PWD = instance.password
-
-        try:
-            imap_server = imaplib.IMAP4_SSL(settings.SMTP_SERVER)
-
-            login_result = imap_server.login(FROM_EMAIL, FROM_PWD)
-            
-            if login_result[0] == 'OK':
-                print("Logged in successfully!")
-            else:
-                cronjob_log.info(f"Cronjob Login failed. at {datetime.now()}")
-                return
-
-            # __, folder_list = imap_server.list()
-            # print("IGIUGUUI", folder_list)
-            status, mailbox_list = imap_server.list()
-            mail_box = '"[Gmail]/All Mail"'
-            if status=="OK":
-                for i in mailbox_list:
-                    if '"[Gmail]/&BdsF3A- &BdQF0wXVBdAF6A-"' in str(i):
-                        mail_box = '"[Gmail]/&BdsF3A- &BdQF0wXVBdAF6A-"'
-            mail_boxs = [mail_box]
-            for folder in mail_boxs:
-                imap_server.select(folder)
-
-                subject = "Request from user"
-                search_criteria = f'(SUBJECT "{subject}")'
-
-                one_day_ago = (datetime.now().strftime('%d-%b-%Y'))
-                search_criteria = f'(SINCE "{one_day_ago}")'
-                status, message_ids = imap_server.search(None,search_criteria)
-                
-                # Fetch and process the email messages
-                message_ids = message_ids[0].split()
-                key = folder+one_day_ago
-                key2 = folder+one_day_ago+"count"
-                if folder == '"[Gmail]/All Mail"':
-                    key = "all-mail"+one_day_ago
-                    key2 = "all-mail"+one_day_ago+"count"
-                old_ids = cache.get(key)
-                count = cache.get(key2)
-                cronjob_log.info(f"debug old ids key: {key} {str(old_ids)} : count key {key2}: {count}")
-                is_delete = False
-                if not old_ids:
-                    old_ids = []
-                if not count:
-                    cache.set(key2,len(old_ids), timeout=86400)
-                    count = len(old_ids)
-                new = []
-                if len(message_ids)>count:
-                    new = [item for item in message_ids if item not in old_ids]
-                    cronjob_log.info(f"{len(new)} mail recived")
-                elif len(message_ids)==count:
-                    cronjob_log.info("no new emails")
-                    break
-                elif len(message_ids)<count:
-                    diffrence = count - len(message_ids)
-                    is_delete = True
-                    new = message_ids[-diffrence:]
-                    cronjob_log.info(f"{len(new)} mail delete, sync again")
-                cronjob_log.info(f"old mesages ids {str(old_ids)}")
-                cronjob_log.info(f"fetched ids {str(message_ids)}")
-                cronjob_log.info(f"new messages ids {str(new)}")
-                for message_id in new:
-                    try:
-                        mail_read = True
-                        response, data = imap_server.fetch(message_id, '(FLAGS)')
-                        if response == 'OK':
-                            flags = data[0].split()[2]  # Flags are in the third element
-                            if b'\Seen' not in flags:
-                                mail_read =False
-                        try:
-                            _ , response = imap_server.fetch(message_id, '(UID)')
-                            uid = response[0].split()[2].decode().replace(")", "")
-                        except Exception:
-                            uid = uuid.uuid4()
-
-                        status, message_data = imap_server.fetch(message_id, '(RFC822)')
-                        raw_email = message_data[0][1]
-                        email_message = email.message_from_bytes(raw_email)
-
-                        subject = email_message.get('Subject')
-                        decoded_subject = email.header.decode_header(subject)
-
-                        # Combine the parts of the decoded subject into a single string
-                        subject = ""
-                        for part, encoding in decoded_subject:
-                            if isinstance(part, bytes):
-                                subject += part.decode(encoding or 'utf-8', errors='ignore')
-                            else:
-                                subject += part
-                        try:
-                            target_sub = subject.split("#")[0][::-1]
-                        except:
-                            target_sub = ""
-                        matching_str = "שמתשמ תאמ הינפ"
-                        if email_message.is_multipart():
-                            # If the email has multiple parts, iterate over them
-                            for part in email_message.walk():
-                                if part.get_content_type() == "text/plain":
-                                    body = part.get_payload(decode=True).decode()
-                                    break
-                        else:
-                            body = email_message.get_payload(decode=True).decode()
-                        pattern = r'(https?://\S+)'
-                        match = re.search(pattern, body)
-                        website_url = ""
-                        if match:
-                            website_url = match.group(1)
-                        if (len(target_sub) >0 and target_sub in " שמתשמ תאמ הינפ") or website_url.startswith("https://netfree.link/app/#/tools/traffic/view"):
-
-
-
-                            email_subject = subject
-                            customer_id = email_subject.split("#")[-1]
-                            username, sender_email = self.decode_header(email_message['From'])
-                            decoded_username = email.header.decode_header(username)
-                            # Combine the parts of the decoded subject into a single string
-                            subject = ""
-                            for username_part, username_encoding in decoded_username:
-                                if isinstance(username_part, bytes):
-                                    username =  username_part.decode(username_encoding or 'utf-8', errors='ignore')
-
-                                else:
-                                    username = username_part
-                            received_date = email_message['Date']
-                            received_datetime = datetime.strptime(received_date, "%a, %d %b %Y %H:%M:%S %z")
-                            formatted_received_date = received_datetime.strftime("%Y-%m-%d %H:%M:%S %z")
-                            created_at_datetime = timezone.datetime.strptime(received_date, "%a, %d %b %Y %H:%M:%S %z")
-                            if website_url.startswith("https://netfree.link/app/#/tools/traffic/view"):
-                                from clients.models import NetfreeUser
-                                data,custumer_id = get_netfree_traffic_data(website_url)
-                                client = NetfreeUser.objects.filter(user_id=custumer_id).first()
-                                if client:
-                                    netfree_traffic= NetfreeTraffic.objects.get(is_default=True,netfree_profile=client.netfree_profile)
-                                else:
-                                    default_netfree_categories, _ = NetfreeCategoriesProfile.objects.get_or_create(is_default=True)
-                                    netfree_traffic,created = NetfreeTraffic.objects.get_or_create(is_default=True,netfree_profile=default_netfree_categories)
-                                if netfree_traffic.is_active:
-                                    # obj = NetfreeProcessor(data,custumer_id)
-                                    # obj.process()
-                                    objects = Emailrequest.objects.filter(
-                                            email_id=uid,
-                                            created_at=created_at_datetime
-                                        )
-                                    for url in data:
-                                        for email_request in objects:
-                                            if str(email_request.requested_website)==str(url):
-                                                cronjob_log.debug(f"Cronjob  email request updated {email_request.id} at {datetime.now()}")
-                                                break
-                                        else:
-                                            new_obj = Emailrequest.objects.create(email_id=uid,requested_website=url,created_at=created_at_datetime,sender_email=sender_email,
-                                                                                username=username,customer_id=str(custumer_id),request_type="טיפול בהקלטות תעבורה",
-                                                                                text=body,ticket_id=15665)
-                                            cronjob_log.debug(f"Cronjob email request created {new_obj.id} at {datetime.now()}")
-                            else: 
-                                with transaction.atomic():
-                                    object,created = Emailrequest.objects.update_or_create(
-                                        email_id=uid,
-                                        created_at=created_at_datetime,
-                                        defaults={
-                                            "sender_email": sender_email,
-                                            "username": username,
-                                            "customer_id": customer_id,
-                                            "requested_website": website_url,
-                                            "text": body,
-                                            "created_at": created_at_datetime,
-                                            "ticket_id": 15665,
-                                        }
-                                    )
-                                    if created:
-                                        cronjob_log.debug(f"Cronjob email request created {object.id} at {datetime.now()}")
-                                    else:
-                                        cronjob_log.debug(f"Cronjob  email request updated {object.id} at {datetime.now()}")
-                        if not mail_read:
-                            imap_server.store(message_id, '-FLAGS', '\Seen')
-                    except Exception as e:
-                        print(e)
-                        cronjob_error_log.error(f"Cronjob error exception: {capture_error(sys.exc_info())}")
-
-                # Close the connection
-                if is_delete:
-                    cache.set(key, message_ids,timeout=86400)
-                    cache.set(key2,len(message_ids),timeout=86400)
-                else:
-                    combine = new+old_ids
-                    cache.set(key, combine,timeout=86400)
-                    cache.set(key2,len(combine),timeout=86400)
-            
-
-            imap_server.close()
-            imap_server.logout()
-            print("Done!!!")
-            cronjob_log.info(f"Cronjob done at {datetime.now()}")
-
-        except Exception as e:
-            traceback.print_exc()
-            print("Error!!!")
-            print(str(e))
-            cronjob_error_log.error(f"Cronjob error : {str(e)}")
-            cronjob_error_log.error(f"Cronjob error exception: {capture_error(sys.exc_info())}")
-
-    def decode_header(self, value):
-        try:
-            username = value.split("<")[0]
-            email = value.split("<")[-1].replace(">", "")
-        except Exception:
-            username = ""
-            email = value
-        return username, email
+        MailIngestCoordinator().run()
 
 
 # res = ReadEmail()
@@ -1,6 +1,9 @@
 import os
 
 from celery import Celery
+from celery.schedules import crontab
+from celery.signals import worker_ready
+from django.conf import settings
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'netfree.settings')
@@ -14,12 +17,34 @@ app = Celery('netfree', backend='redis')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.conf.broker_url = 'redis://localhost:6379/0'  # Use a specific Redis database
 app.conf.result_backend = 'redis://localhost:6379/1'
+# With NETFREE_SYNC_ROUTE_QUEUES=1, Netfree write tasks are sent to netfree-sync-<n>
+# queues (see crm.netfree_sync.customer_queue). Serve each with a single-process worker, e.g.:
+#   celery -A netfree worker -Q netfree-sync-0,netfree-sync-1 -c 1
+# Everything else stays on the default "celery" queue and can scale freely.
+app.conf.task_create_missing_queues = True
+# read_emails parses MIME in EMAIL_PARSE_PROCESSES processes, which prefork children
+# (daemonic) may not start, so there it parses inline. Set EMAIL_INGEST_QUEUE to send
+# it to its own queue and serve that with a solo worker to get the parse pool, e.g.:
+#   celery -A netfree worker -Q mail-ingest -P solo
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
     'my-celery-task': {
         'task': 'crm.tasks.read_emails',  # Path to your Celery task
-        'schedule': 5.0,  # Run every 15 seconds
+        'schedule': settings.EMAIL_POLL_INTERVAL,  # Mostly skipped while imap_idle covers every folder
+        'options': {'queue': settings.EMAIL_INGEST_QUEUE} if settings.EMAIL_INGEST_QUEUE else {},
     },
-}
\ No newline at end of file
+    'netfree-sweep-filter-settings': {
+        'task': 'crm.tasks.sweep_filter_settings',
+        'schedule': crontab(hour=3, minute=0),  # Resumes where the previous night stopped
+    },
+}
+
+
+@worker_ready.connect
+def warm_up_netfree_sessions(**kwargs):
+    # Log every Netfree admin account in before the first task needs it.
+    from utils.helper import NetfreeAPI
+    netfree_api = NetfreeAPI()
+    netfree_api.pool.warm_up(netfree_api.session, netfree_api.headers)
@@ -195,7 +195,6 @@ MEDIA_URL = '/media/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-TAG_URL = 'https://netfree.link/api/tags/list'
 
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -205,9 +204,104 @@ EMAIL_PORT = 587
 EMAIL_HOST_USER = os.environ.get("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = os.environ.get("EMAIL_HOST_PASSWORD")
 SMTP_SERVER = "imap.gmail.com"
-
-USER_PASSWORD = "88069067"
-USERNAME = "+972583230207"
+# Seconds between read_emails polls. While `python manage.py imap_idle` is connected on
+# every folder of every account, read_emails only runs every EMAIL_IDLE_SAFETY_INTERVAL.
+EMAIL_POLL_INTERVAL = float(os.environ.get("EMAIL_POLL_INTERVAL", 5))
+EMAIL_IDLE_SAFETY_INTERVAL = 300
+EMAIL_IDLE_TIMEOUT = 9 * 60
+EMAIL_IDLE_BACKOFF_MAX = 300
+# Seconds between NOOPs on servers without IDLE
+EMAIL_IDLE_POLL_INTERVAL = 5
+# UIDs per header FETCH; keeps each IMAP command line short
+EMAIL_FETCH_BATCH_SIZE = 200
+# Every SMTPEmail account is read; folders come from EMAIL_INGEST_FOLDERS
+# ("folder1,folder2", IMAP-quoted names) or are detected per account when empty.
+EMAIL_INGEST_FOLDERS = [folder for folder in os.environ.get("EMAIL_INGEST_FOLDERS", "").split(",") if folder]
+# IMAP connections open at once during a read_emails run
+EMAIL_INGEST_WORKERS = int(os.environ.get("EMAIL_INGEST_WORKERS", 4))
+# Fetched messages waiting for the parse stage before the IMAP readers block
+EMAIL_INGEST_QUEUE_SIZE = 500
+# Processes decoding MIME for a read_emails run; 0 parses in the writer thread, as does
+# a run inside a daemon process such as a prefork worker child
+EMAIL_PARSE_PROCESSES = int(os.environ.get("EMAIL_PARSE_PROCESSES", 2))
+# Queue for read_emails, served by a non-daemon (-P solo) worker so the parse processes
+# can start; empty keeps it on the default queue (see netfree/celery.py)
+EMAIL_INGEST_QUEUE = os.environ.get("EMAIL_INGEST_QUEUE", "")
+EMAIL_PARSE_IN_FLIGHT = 64
+# Emailrequest rows per INSERT ... ON CONFLICT statement
+EMAIL_INSERT_BATCH_SIZE = 500
+# One ingestion at a time: the lease expires this many seconds after its holder stops renewing it
+EMAIL_INGEST_LEASE_TIMEOUT = 60
+# Seconds the IMAP IDLE listener waits for a running read_emails to finish before syncing
+EMAIL_INGEST_LEASE_WAIT = 60
+
+USER_PASSWORD = os.environ.get("NETFREE_PASSWORD", "88069067")
+USERNAME = os.environ.get("NETFREE_USERNAME", "+972583230207")
+# Admin accounts NetfreeAPI spreads its calls over, "phone:password,phone:password".
+# Defaults to the single account above. NETFREE_LIMITER_MAX_RATE still caps the pool as a whole.
+NETFREE_CREDENTIALS = [
+    tuple(item.strip().split(":", 1))
+    for item in os.environ.get("NETFREE_CREDENTIALS", "").split(",") if ":" in item
+] or [(USERNAME, USER_PASSWORD)]
+# Seconds an account is skipped after a 429 without Retry-After or a failed login
+NETFREE_CREDENTIAL_COOLDOWN = 30
+# Set to the fake server (python manage.py fake_netfree) for offline runs and benchmarks
+NETFREE_BASE_URL = os.environ.get("NETFREE_BASE_URL", "https://netfree.link").rstrip("/")
+TAG_URL = NETFREE_BASE_URL + '/api/tags/list'
+# "record" captures NetfreeAPI traffic (credentials scrubbed) to one <name>.<pid>.gz per process
+# next to the path, "replay" serves back the path or, if it is missing, all of those files
+NETFREE_CASSETTE_MODE = os.environ.get("NETFREE_CASSETTE_MODE") or None
+NETFREE_CASSETTE_PATH = os.environ.get("NETFREE_CASSETTE_PATH", str(BASE_DIR / "logs" / "netfree.cassette.gz"))
+# Seconds a netfree.link login cookie is reused before logging in again
+NETFREE_SESSION_TTL = 60 * 60
+# Max netfree.link requests in flight per AsyncNetfreeAPI client
+NETFREE_ASYNC_CONCURRENCY = int(os.environ.get("NETFREE_ASYNC_CONCURRENCY", 10))
+# Host -> category lookups: shared Redis TTL, TTL for hosts without tags, per-worker LRU
+NETFREE_CATEGORY_CACHE_TTL = int(os.environ.get("NETFREE_CATEGORY_CACHE_TTL", 60 * 60 * 24))
+NETFREE_CATEGORY_NEGATIVE_TTL = int(os.environ.get("NETFREE_CATEGORY_NEGATIVE_TTL", 60 * 60))
+NETFREE_CATEGORY_LOCAL_SIZE = 4096
+NETFREE_CATEGORY_LOCAL_TTL = 60
+# Seconds a worker keeps using the cache version before re-reading it; a full
+# invalidation reaches other workers within this time
+NETFREE_CATEGORY_VERSION_TTL = 5
+# Customer full_name/email from users/search-user, also mirrored into NetfreeUser
+NETFREE_CUSTOMER_CACHE_TTL = int(os.environ.get("NETFREE_CUSTOMER_CACHE_TTL", 60 * 60 * 24))
+# (connect, read) timeout in seconds for every netfree.link call
+NETFREE_TIMEOUT = (5, 30)
+# Retries for idempotent calls, with full-jitter exponential backoff
+NETFREE_RETRIES = 3
+NETFREE_BACKOFF_BASE = 0.5
+NETFREE_BACKOFF_MAX = 10
+# Circuit breaker: open for RESET seconds once a WINDOW-second window holds at least
+# THRESHOLD failures and they are at least FAILURE_RATE of that window's calls
+NETFREE_BREAKER_THRESHOLD = 5
+NETFREE_BREAKER_WINDOW = 60
+NETFREE_BREAKER_FAILURE_RATE = 0.5
+NETFREE_BREAKER_RESET = 60
+NETFREE_TASK_MAX_RETRIES = 10
+# Seconds filter-settings writes for one customer are buffered before one combined GET + POST
+NETFREE_SYNC_WINDOW = 10
+# With NETFREE_SYNC_ROUTE_QUEUES, customer writes are routed to netfree-sync-<n>
+# queues by customer id; run one single-process worker per queue before turning
+# it on. The Redis lock below guards the writes with or without routing.
+NETFREE_SYNC_ROUTE_QUEUES = os.environ.get("NETFREE_SYNC_ROUTE_QUEUES", "") == "1"
+NETFREE_SYNC_PARTITIONS = int(os.environ.get("NETFREE_SYNC_PARTITIONS", 8))
+NETFREE_SYNC_LOCK_TIMEOUT = 120
+NETFREE_SYNC_LOCK_WAIT = 30
+# /api/crm/netfree-metrics/ requires "Authorization: Bearer <token>"; it is closed while this is empty.
+NETFREE_METRICS_TOKEN = os.environ.get("NETFREE_METRICS_TOKEN", "")
+# Syncs trust the local FilterSettingsShadow copy for this long before re-reading Netfree.
+NETFREE_SHADOW_TTL = int(os.environ.get("NETFREE_SHADOW_TTL", 300))
+# Nightly sweep that prunes expired/duplicate rules from every customer's url list.
+NETFREE_SWEEP_BATCH_SIZE = int(os.environ.get("NETFREE_SWEEP_BATCH_SIZE", 200))
+NETFREE_SWEEP_CONCURRENCY = int(os.environ.get("NETFREE_SWEEP_CONCURRENCY", 8))
+NETFREE_SWEEP_MAX_SECONDS = int(os.environ.get("NETFREE_SWEEP_MAX_SECONDS", 3000))
+# Adaptive (AIMD) limiter shared by every process talking to netfree.link
+NETFREE_LIMITER_MIN_RATE = 0.5
+NETFREE_LIMITER_MAX_RATE = float(os.environ.get("NETFREE_LIMITER_MAX_RATE", 20))
+NETFREE_LIMITER_MAX_CONCURRENCY = 10
+NETFREE_LIMITER_LATENCY_TARGET = 2.0
+NETFREE_LIMITER_MAX_WAIT = 30
 EMAIL_HOST_ADMIN_USER = os.environ.get("EMAIL_HOST_ADMIN_USER")
 
 BROKER_URL = 'redis://localhost:6379/0'
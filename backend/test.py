@@ -1,11 +1,15 @@
+import os
+
 import requests
 import json
 
-url = "https://netfree.link/api/tags/value/edit/get"
-login_url = 'https://netfree.link/api/user/login-by-password'
+# Defaults to the local fake server: python manage.py fake_netfree
+BASE_URL = os.environ.get("NETFREE_BASE_URL", "http://127.0.0.1:8765")
+url = BASE_URL + "/api/tags/value/edit/get"
+login_url = BASE_URL + '/api/user/login-by-password'
 
-USER_PASSWORD = "88069067"
-USERNAME = "+972583230207"
+USER_PASSWORD = os.environ.get("NETFREE_PASSWORD", "")
+USERNAME = os.environ.get("NETFREE_USERNAME", "")
 
 login_data = {
     'password': USER_PASSWORD,
@@ -1,16 +1,28 @@
 import imaplib
 import json
+import logging
 import os
 import random
 import re
 import string
 import time
+from urllib.parse import urlsplit, urlunsplit
 
 import requests
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives, send_mail
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
+from utils.netfree_cache import category_cache
+from utils.netfree_cassette import active_cassette
+from utils.netfree_limiter import limiter
+from utils.netfree_metrics import metrics
+from utils.netfree_resilience import (RETRYABLE_STATUS, NetfreeUnavailable,
+                                      backoff_delay, breaker)
+from utils.netfree_session import get_session_pool
+from utils.netfree_traffic import parse_traffic_record
+
+general_log = logging.getLogger('general')
 
 
 def send_email_with_template(subject, to_email, template_name, context):
@@ -59,215 +71,225 @@ def replace_placeholders(template, replacements):
     return formatted_template
 
 
-def get_user_deatils(user_id):
-    url = f"https://netfree.link/api/user/get-filter-settings?id={str(user_id)}"
-    login_url = "https://netfree.link/api/user/login-by-password"
-
-    USER_PASSWORD = settings.USER_PASSWORD
-    USERNAME = settings.USERNAME
-
-    login_data = {"password": USER_PASSWORD, "phone": USERNAME}
-    headers = {
-        "authority": "netfree.link",
-        "accept": "application/json, text/plain, */*",
-        "accept-language": "en-GB,en-US;q=0.9,en;q=0.8",
-        "content-type": "application/json",
-        "origin": "https://netfree.link",
-        "referer": "https://netfree.link/app/",
-        "save-data": "on",
-        "sec-ch-ua": '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
-        "sec-ch-ua-mobile": "?0",
-        "sec-ch-ua-platform": '"Windows"',
-        "sec-fetch-dest": "empty",
-        "sec-fetch-mode": "cors",
-        "sec-fetch-site": "same-origin",
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
-    }
-
-    session = requests.Session()
-    login_response = session.post(login_url, headers=headers, json=login_data)
-    cookie = login_response.cookies.get_dict()
-    headers["cookie"] = "; ".join([f"{name}={value}" for name, value in cookie.items()])
-    tags_response = session.get(url, headers=headers)
-    return tags_response
-
-
-def post_user_data(user_id,tags,urls,data):
-    url = "https://netfree.link/user/ajax/set-filter-settings"
-    login_url = "https://netfree.link/api/user/login-by-password"
-
-    USER_PASSWORD = settings.USER_PASSWORD
-    USERNAME = settings.USERNAME
-
-    login_data = {"password": USER_PASSWORD, "phone": USERNAME}
-    headers = {
-        "authority": "netfree.link",
-        "accept": "application/json, text/plain, */*",
-        "accept-language": "en-GB,en-US;q=0.9,en;q=0.8",
-        "content-type": "application/json",
-        "origin": "https://netfree.link",
-        "referer": "https://netfree.link/app/",
-        "save-data": "on",
-        "sec-ch-ua": '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
-        "sec-ch-ua-mobile": "?0",
-        "sec-ch-ua-platform": '"Windows"',
-        "sec-fetch-dest": "empty",
-        "sec-fetch-mode": "cors",
-        "sec-fetch-site": "same-origin",
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
-    }
-    inspectorSettings = data.get("inspectorSettings")
-    inspectorSettings.update({'tagsList': tags, 'urls': urls })
-    payload = {
-        "id":int(user_id),
-        "filterSettings": data.get("filterSettings"),
-        "inspectorSettings": inspectorSettings
-    }
-    session = requests.Session()
-    login_response = session.post(login_url, headers=headers, json=login_data)
-    cookie = login_response.cookies.get_dict()
-    headers["cookie"] = "; ".join([f"{name}={value}" for name, value in cookie.items()])
-    tags_response = session.post(url, headers=headers,json=payload)
-    return tags_response
-
-def remove_duplicate_combinations(data):
-    seen_combinations = set()
+def normalize_rule_url(url):
+    """Comparison key for a filter-settings url: trimmed, lower-case scheme/host, no trailing slash."""
+    value = str(url).strip()
+    parts = urlsplit(value)
+    if parts.scheme and parts.netloc:
+        value = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, parts.fragment))
+    return value.rstrip("/")
+
+
+def remove_duplicate_combinations(data, now_ms=None):
+    """Drop expired temporary rules and merge duplicates of the same url + rule.
+
+    ``exp`` is a millisecond timestamp; an entry without one is permanent. Of
+    several entries for the same normalized url and rule the first one is
+    kept, with the longest expiry of the group (permanent wins).
+    """
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    kept = {}
     final_list = []
 
     for entry in data:
-        url = entry['url']
-        rule = entry['rule']
         exp = entry.get('exp')
-        combination = (url, rule)
-        if exp:
-            combination = (url, rule,exp)
-
-        if combination not in seen_combinations:
-            seen_combinations.add(combination)
-            final_list.append(entry)
+        if exp and exp < now_ms:
+            continue
+        combination = (normalize_rule_url(entry.get('url', '')), entry.get('rule'))
+        first = kept.get(combination)
+        if first is None:
+            kept[combination] = dict(entry)
+            final_list.append(kept[combination])
+        elif first.get('exp') and (not exp or exp > first['exp']):
+            if exp:
+                first['exp'] = exp
+            else:
+                del first['exp']
 
     return final_list
 
+
+def compact_filter_urls(user_id, urls):
+    """Run remove_duplicate_combinations on a payload about to be posted and log the bytes it saved."""
+    before = len(json.dumps(urls, separators=(",", ":")))
+    urls = remove_duplicate_combinations(urls)
+    saved = before - len(json.dumps(urls, separators=(",", ":")))
+    if saved:
+        general_log.info(f"customer id : {user_id}. filter urls compacted, {saved} bytes saved ({before} before)")
+    return urls
+
+NETFREE_HEADERS = {
+    "authority": "netfree.link",
+    "accept": "application/json, text/plain, */*",
+    "accept-language": "en-GB,en-US;q=0.9,en;q=0.8",
+    "content-type": "application/json",
+    "origin": "https://netfree.link",
+    "referer": "https://netfree.link/app/",
+    "save-data": "on",
+    "sec-ch-ua": '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
+    "sec-ch-ua-mobile": "?0",
+    "sec-ch-ua-platform": '"Windows"',
+    "sec-fetch-dest": "empty",
+    "sec-fetch-mode": "cors",
+    "sec-fetch-site": "same-origin",
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
+}
+
+
+def retry_after_seconds(headers):
+    try:
+        return int(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def has_category_tags(response):
+    try:
+        return bool(response.json()["tagValue"]["tags"])
+    except Exception:
+        return False
+
+
+class NetfreeResponse:
+    """Minimal stand-in for requests.Response so callers can stay unchanged."""
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
 class NetfreeAPI:
     def __init__(self):
-        self.headers = {
-            "authority": "netfree.link",
-            "accept": "application/json, text/plain, */*",
-            "accept-language": "en-GB,en-US;q=0.9,en;q=0.8",
-            "content-type": "application/json",
-            "origin": "https://netfree.link",
-            "referer": "https://netfree.link/app/",
-            "save-data": "on",
-            "sec-ch-ua": '"Not.A/Brand";v="8", "Chromium";v="114", "Google Chrome";v="114"',
-            "sec-ch-ua-mobile": "?0",
-            "sec-ch-ua-platform": '"Windows"',
-            "sec-fetch-dest": "empty",
-            "sec-fetch-mode": "cors",
-            "sec-fetch-site": "same-origin",
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
-        }
+        self.headers = dict(NETFREE_HEADERS)
         self.session = requests.Session()
+        self.pool = get_session_pool()
+
+    def request(self, method, path, idempotent=True, customer_id=None, **kwargs):
+        """Send one call to netfree.link with timeouts, retries and the circuit breaker.
+
+        Idempotent calls are retried with jittered backoff on timeouts and 429/5xx
+        answers. Raises NetfreeUnavailable when the breaker is open or retries run out.
+        ``customer_id`` pins the call to that customer's account in the session pool.
+        """
+        url = settings.NETFREE_BASE_URL + path
+        kwargs.setdefault("timeout", settings.NETFREE_TIMEOUT)
+        attempts = settings.NETFREE_RETRIES + 1 if idempotent else 1
+        relogged = False
+        check_breaker = True
+        attempt = 0
+        while True:
+            # The relogin retry belongs to the same call and must not ask for a
+            # second probe slot while the breaker is half-open.
+            if check_breaker:
+                breaker.check()
+            check_breaker = True
+            http = active_cassette() or self.session
+            auth = self.pool.pick(customer_id)
+            try:
+                cookie = auth.get_cookie(http, self.headers)
+                if not cookie:
+                    self.pool.login_failed(auth)
+                headers = dict(self.headers, cookie=cookie)
+                started = limiter.acquire()
+                throttled = True
+                try:
+                    response = metrics.request(http, method, url, headers=headers, **kwargs)
+                    throttled = response.status_code == 429
+                finally:
+                    limiter.release(started, throttled)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                breaker.record_failure()
+                error = e
+            else:
+                if response.status_code == 401 and not relogged:
+                    # Discarded answers go back to the pool, also with stream=True.
+                    response.close()
+                    auth.invalidate(cookie)
+                    relogged = True
+                    check_breaker = False
+                    continue
+                if response.status_code == 429:
+                    self.pool.throttled(auth, retry_after_seconds(response.headers))
+                if response.status_code not in RETRYABLE_STATUS:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                error = f"status {response.status_code}"
+                response.close()
+            attempt += 1
+            if attempt >= attempts:
+                raise NetfreeUnavailable(f"{method} {path} failed after {attempt} attempts: {error}", breaker.retry_after())
+            time.sleep(backoff_delay(attempt - 1))
 
-    def login(self):
-        login_url = "https://netfree.link/api/user/login-by-password"
-        USER_PASSWORD = settings.USER_PASSWORD
-        USERNAME = settings.USERNAME
-        login_data = {"password": USER_PASSWORD, "phone": USERNAME}
-        login_response = self.session.post(login_url, headers=self.headers, json=login_data)
-        cookie = login_response.cookies.get_dict()
-        self.headers["cookie"] = "; ".join(
-            [f"{name}={value}" for name, value in cookie.items()]
-        )
-        return True
     def search_category(self, params):
-        url = "https://netfree.link/api/tags/value/edit/get"
-        valid_domain = self.find_domain(params)
-        domain = (
-            valid_domain.json().get("foundHost","") if valid_domain.status_code == 200 else ""
-        )
+        domain = category_cache.get_host(params)
+        if domain is None:
+            valid_domain = self.find_domain(params)
+            domain = ""
+            if valid_domain.status_code == 200:
+                domain = valid_domain.json().get("foundHost","")
+                category_cache.set_host(params, domain)
+        cached = category_cache.get_tags(str(domain))
+        if cached is not None:
+            return NetfreeResponse(200, cached)
         payload = json.dumps({"host": str(domain)})
-        self.login()
-        tags_response = self.session.post(url, headers=self.headers, data=payload)
+        tags_response = self.request("POST", "/api/tags/value/edit/get", data=payload)
+        if tags_response.status_code == 200:
+            category_cache.set_tags(str(domain), tags_response.content, has_category_tags(tags_response))
         return tags_response
 
-    def send_req(self,key):
+    def send_req(self,key,stream=False):
         payload = json.dumps({"key": key})
-        self.login()
-        response = self.session.post("https://netfree.link/api/user/get-traffic-record", headers=self.headers, data=payload)
+        response = self.request("POST", "/api/user/get-traffic-record", data=payload, stream=stream)
         return response
     def find_domain(self, params):
-        url = "https://netfree.link/api/tags/search-url"
         payload = json.dumps({"search": params})
-        self.login()
-        response = self.session.post(url, headers=self.headers, data=payload)
+        response = self.request("POST", "/api/tags/search-url", data=payload)
         return response
+    def get_tags_list(self):
+        payload = json.dumps({"inspector": True})
+        return self.request("POST", "/api/tags/list", data=payload)
     def get_user(self, user_id):
         user_id = int(''.join(filter(str.isdigit, user_id)))
-        url = "https://netfree.link/api/users/search-user"
         payload = json.dumps({"search": user_id,"lastSurfing":False})
-        self.login()
-        response = self.session.post(url, headers=self.headers, data=payload)
+        response = self.request("POST", "/api/users/search-user", data=payload, customer_id=user_id)
         return response
     def get_user_deatils(self,user_id):
-        url = f"https://netfree.link/api/user/get-filter-settings?id={str(user_id).strip()}"
-        self.login()
-        tags_response = self.session.get(url, headers=self.headers)
+        tags_response = self.request("GET", f"/api/user/get-filter-settings?id={str(user_id).strip()}", customer_id=user_id)
         return tags_response
     
     def post_user_data(self,user_id,urls,data):
         clean_user_id = ''.join(filter(str.isdigit, user_id))
-        url = "https://netfree.link/user/ajax/set-filter-settings"
         inspectorSettings = data.get("inspectorSettings")
-        inspectorSettings.update({'urls': urls })
+        inspectorSettings.update({'urls': compact_filter_urls(clean_user_id, urls) })
         payload = {
             "id":int(clean_user_id),
             "filterSettings": data.get("filterSettings"),
             "inspectorSettings": inspectorSettings
         }
-        self.login()
-        tags_response = self.session.post(url, headers=self.headers,json=payload)
+        tags_response = self.request("POST", "/user/ajax/set-filter-settings", idempotent=False, json=payload, customer_id=clean_user_id)
         return tags_response
     
 
 def get_netfree_traffic_data(url):
+    """Blocked urls and customer id of a traffic recording, or False if it can't be fetched."""
     netfree = NetfreeAPI()
     key = url.split('/')[-1]
-    res = netfree.send_req(key)
-    if res.status_code == 200:
-        data = res.json()
-        results = data.get('traffic',[])
-        urls = []
-        netfree_urls = []
-        custumer_id = None
-        for i in results:
-            url = None
-            sector_block = None
-            netfree_block = None
-            for item in i:
-                if item.get('block','') == "sector":
-                    sector_block = True
-                if item.get('block','') == "deny":
-                    netfree_block = True
-
-                if item.get('url'):
-                    if item.get('url').startswith("https://") or item.get('url').startswith("http://"):
-                        url = item.get('url')
-                if item.get('action'):
-                    input_string = item.get('action')
-                    match = re.search(r'user::(\d+)::', input_string)
-
-                    if match:
-                        custumer_id = match.group(1)
-            if sector_block:
-                urls.append(url)
-            if netfree_block:
-                netfree_urls.append(url)
-            if urls:
-                urls = list(set(urls))
-            if netfree_urls:
-                netfree_urls = list(set(netfree_urls))
-        
-        data = {"netfree_url":netfree_urls,"sector_block":urls}
-        return data,custumer_id
-    return False
+    res = netfree.send_req(key, stream=True)
+    try:
+        if res.status_code == 200:
+            data, custumer_id = parse_traffic_record(res.iter_content(chunk_size=65536))
+            general_log.info(f"traffic record {key} : {data['counts']}")
+            return data, custumer_id
+        return False
+    finally:
+        res.close()
 
@@ -0,0 +1,140 @@
+"""Helpers for reading imaplib FETCH responses without downloading whole messages.
+
+imaplib hands back FETCH data as a flat list where every literal is a
+``(prefix, literal)`` tuple followed by the rest of that message's line.
+``parse_fetch_response`` regroups it per UID; ``text_part_section`` walks a
+BODYSTRUCTURE to find the part that holds the request text.
+"""
+import base64
+import binascii
+import quopri
+import re
+
+UID_PATTERN = re.compile(rb'\bUID (\d+)')
+FLAGS_PATTERN = re.compile(rb'\bFLAGS \(([^)]*)\)')
+BODYSTRUCTURE_PATTERN = re.compile(rb'\bBODYSTRUCTURE ')
+LITERAL_NAME_PATTERN = re.compile(rb'BODY(?:\.PEEK)?\[([^\]]*)\](?:<\d+>)? \{\d+\}$')
+TOKEN_PATTERN = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}|[^\s()"]+')
+
+
+def uid_set(uids):
+    return ",".join(str(uid) for uid in uids)
+
+
+def parse_fetch_response(data):
+    """Group a UID FETCH response into ``{uid: {"flags", "bodystructure", "header", "sections"}}``.
+
+    ``header`` holds a fetched BODY[HEADER...] literal and ``sections`` maps
+    body section numbers ("1", "1.2", ...) to their fetched bytes.
+    """
+    messages = []
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            name = LITERAL_NAME_PATTERN.search(prefix)
+            if not messages or prefix[:1].isdigit():
+                messages.append({"meta": b"", "literals": {}})
+            messages[-1]["meta"] += prefix + b" "
+            if name:
+                messages[-1]["literals"][name.group(1).decode()] = literal
+        elif isinstance(item, bytes):
+            if item[:1].isdigit():
+                messages.append({"meta": b"", "literals": {}})
+            if messages:
+                messages[-1]["meta"] += item + b" "
+
+    result = {}
+    for message in messages:
+        uid = UID_PATTERN.search(message["meta"])
+        if not uid:
+            continue
+        flags = FLAGS_PATTERN.search(message["meta"])
+        parsed = {
+            "flags": flags.group(1).decode().split() if flags else [],
+            "bodystructure": None,
+            "header": None,
+            "sections": {},
+        }
+        structure = BODYSTRUCTURE_PATTERN.search(message["meta"])
+        if structure:
+            parsed["bodystructure"] = parse_list(message["meta"][structure.end():])
+        for section, literal in message["literals"].items():
+            if section.upper().startswith("HEADER"):
+                parsed["header"] = literal
+            else:
+                parsed["sections"][section] = literal
+        result[int(uid.group(1))] = parsed
+    return result
+
+
+def parse_list(raw):
+    """Parse the first parenthesized IMAP list in ``raw`` into nested Python lists."""
+    stack = []
+    for token in TOKEN_PATTERN.findall(raw):
+        if token == b"(":
+            stack.append([])
+        elif token == b")":
+            if not stack:
+                break
+            done = stack.pop()
+            if not stack:
+                return done
+            stack[-1].append(done)
+        elif stack:
+            if token.startswith(b'"'):
+                value = token[1:-1].replace(b'\\"', b'"').replace(b'\\\\', b'\\').decode(errors="replace")
+            elif token.upper() == b"NIL":
+                value = None
+            else:
+                value = token.decode(errors="replace")
+            stack[-1].append(value)
+    return None
+
+
+def _part_info(section, part):
+    params = part[2] if len(part) > 2 and isinstance(part[2], list) else []
+    params = dict(zip([str(key).lower() for key in params[::2]], params[1::2]))
+    return {
+        "section": section,
+        "type": f"{part[0]}/{part[1]}".lower(),
+        "charset": params.get("charset"),
+        "encoding": (part[5] or "7bit").lower() if len(part) > 5 else "7bit",
+    }
+
+
+def text_part_section(structure):
+    """The part a request body is read from: the first text/plain part of a
+    multipart message, or the whole body of a single-part one."""
+    if not structure:
+        return None
+    if not isinstance(structure[0], list):
+        return _part_info("1", structure)
+
+    def walk(parts, prefix):
+        for index, part in enumerate(parts, start=1):
+            if not isinstance(part, list):
+                break
+            section = f"{prefix}{index}"
+            if isinstance(part[0], list):
+                found = walk(part, f"{section}.")
+                if found:
+                    return found
+            elif f"{part[0]}/{part[1]}".lower() == "text/plain":
+                return _part_info(section, part)
+        return None
+
+    return walk(structure, "")
+
+
+def decode_part(raw, encoding, charset=None):
+    if encoding == "base64":
+        try:
+            raw = base64.b64decode(raw)
+        except binascii.Error:
+            pass
+    elif encoding == "quoted-printable":
+        raw = quopri.decodestring(raw)
+    try:
+        return raw.decode(charset or "utf-8", errors="ignore")
+    except LookupError:
+        return raw.decode("utf-8", errors="ignore")
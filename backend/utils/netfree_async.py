@@ -0,0 +1,179 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from utils.helper import (NETFREE_HEADERS, NetfreeResponse, compact_filter_urls,
+                          has_category_tags, retry_after_seconds)
+from utils.netfree_cache import category_cache
+from utils.netfree_cassette import active_cassette
+from utils.netfree_limiter import limiter
+from utils.netfree_metrics import metrics, payload_bytes
+from utils.netfree_resilience import (RETRYABLE_STATUS, NetfreeUnavailable,
+                                      backoff_delay, breaker)
+from utils.netfree_session import get_session_pool
+
+
+class AsyncNetfreeAPI:
+    """Asyncio counterpart of NetfreeAPI with a bounded number of requests in flight.
+
+    All calls share one keep-alive connection pool and the same cached login
+    cookie as the sync client. Use it as an async context manager.
+    """
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or settings.NETFREE_ASYNC_CONCURRENCY
+        self.headers = dict(NETFREE_HEADERS)
+        self.pool = get_session_pool()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=30)
+        connect_timeout, read_timeout = settings.NETFREE_TIMEOUT
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def get_cookie(self, auth):
+        # Logging in is rare and goes through the shared sync session manager.
+        cookie = await sync_to_async(auth.get_cookie, thread_sensitive=False)(
+            active_cassette() or requests.Session(), self.headers
+        )
+        if not cookie:
+            await sync_to_async(self.pool.login_failed, thread_sensitive=False)(auth)
+        return cookie
+
+    async def request(self, method, path, idempotent=True, customer_id=None, **kwargs):
+        url = settings.NETFREE_BASE_URL + path
+        attempts = settings.NETFREE_RETRIES + 1 if idempotent else 1
+        relogged = False
+        check_breaker = True
+        attempt = 0
+        async with self.semaphore:
+            while True:
+                if check_breaker:
+                    await sync_to_async(breaker.check, thread_sensitive=False)()
+                check_breaker = True
+                auth = await sync_to_async(self.pool.pick, thread_sensitive=False)(customer_id)
+                try:
+                    cookie = await self.get_cookie(auth)
+                    headers = dict(self.headers, cookie=cookie)
+                    started = await sync_to_async(limiter.acquire, thread_sensitive=False)()
+                    throttled = True
+                    call_started = time.perf_counter()
+                    status = "error"
+                    response = None
+                    try:
+                        cassette = active_cassette()
+                        if cassette:
+                            res = await sync_to_async(cassette.request, thread_sensitive=False)(
+                                method, url, headers=headers, timeout=settings.NETFREE_TIMEOUT, **kwargs
+                            )
+                            response = NetfreeResponse(res.status_code, res.content, res.headers)
+                        else:
+                            async with self.session.request(method, url, headers=headers, **kwargs) as res:
+                                response = NetfreeResponse(res.status, await res.read(), res.headers)
+                        throttled = response.status_code == 429
+                        status = response.status_code
+                    except asyncio.TimeoutError:
+                        status = "timeout"
+                        raise
+                    finally:
+                        await sync_to_async(limiter.release, thread_sensitive=False)(started, throttled)
+                        await sync_to_async(metrics.observe, thread_sensitive=False)(
+                            "async", method, url, status, time.perf_counter() - call_started,
+                            payload_bytes(kwargs), len(response.content) if response else 0,
+                        )
+                except (asyncio.TimeoutError, aiohttp.ClientError, requests.RequestException) as e:
+                    await sync_to_async(breaker.record_failure, thread_sensitive=False)()
+                    error = e
+                else:
+                    if response.status_code == 401 and not relogged:
+                        await sync_to_async(auth.invalidate, thread_sensitive=False)(cookie)
+                        relogged = True
+                        check_breaker = False
+                        continue
+                    if response.status_code == 429:
+                        await sync_to_async(self.pool.throttled, thread_sensitive=False)(
+                            auth, retry_after_seconds(response.headers)
+                        )
+                    if response.status_code not in RETRYABLE_STATUS:
+                        await sync_to_async(breaker.record_success, thread_sensitive=False)()
+                        return response
+                    await sync_to_async(breaker.record_failure, thread_sensitive=False)()
+                    error = f"status {response.status_code}"
+                attempt += 1
+                if attempt >= attempts:
+                    raise NetfreeUnavailable(f"{method} {path} failed after {attempt} attempts: {error}", breaker.retry_after())
+                await asyncio.sleep(backoff_delay(attempt - 1))
+
+    async def search_category(self, params):
+        domain = await sync_to_async(category_cache.get_host, thread_sensitive=False)(params)
+        if domain is None:
+            valid_domain = await self.find_domain(params)
+            domain = ""
+            if valid_domain.status_code == 200:
+                domain = valid_domain.json().get("foundHost", "")
+                await sync_to_async(category_cache.set_host, thread_sensitive=False)(params, domain)
+        cached = await sync_to_async(category_cache.get_tags, thread_sensitive=False)(str(domain))
+        if cached is not None:
+            return NetfreeResponse(200, cached)
+        payload = json.dumps({"host": str(domain)})
+        tags_response = await self.request("POST", "/api/tags/value/edit/get", data=payload)
+        if tags_response.status_code == 200:
+            await sync_to_async(category_cache.set_tags, thread_sensitive=False)(
+                str(domain), tags_response.content, has_category_tags(tags_response)
+            )
+        return tags_response
+
+    async def send_req(self, key):
+        payload = json.dumps({"key": key})
+        return await self.request("POST", "/api/user/get-traffic-record", data=payload)
+
+    async def find_domain(self, params):
+        payload = json.dumps({"search": params})
+        return await self.request("POST", "/api/tags/search-url", data=payload)
+
+    async def get_user(self, user_id):
+        user_id = int(''.join(filter(str.isdigit, user_id)))
+        payload = json.dumps({"search": user_id, "lastSurfing": False})
+        return await self.request("POST", "/api/users/search-user", data=payload, customer_id=user_id)
+
+    async def get_user_deatils(self, user_id):
+        return await self.request("GET", f"/api/user/get-filter-settings?id={str(user_id).strip()}", customer_id=user_id)
+
+    async def post_user_data(self, user_id, urls, data):
+        clean_user_id = ''.join(filter(str.isdigit, user_id))
+        inspectorSettings = data.get("inspectorSettings")
+        inspectorSettings.update({'urls': compact_filter_urls(clean_user_id, urls)})
+        payload = {
+            "id": int(clean_user_id),
+            "filterSettings": data.get("filterSettings"),
+            "inspectorSettings": inspectorSettings
+        }
+        return await self.request("POST", "/user/ajax/set-filter-settings", idempotent=False, json=payload, customer_id=clean_user_id)
+
+
+def netfree_fan_out(method, args_list, concurrency=None):
+    """Run one AsyncNetfreeAPI method for every argument from sync code.
+
+    Results come back in the order of ``args_list``; a failed call yields its
+    exception instead of a response so one bad URL does not sink the batch.
+    """
+    args_list = list(args_list)
+    if not args_list:
+        return []
+
+    async def run():
+        async with AsyncNetfreeAPI(concurrency) as api:
+            calls = [getattr(api, method)(args) for args in args_list]
+            return await asyncio.gather(*calls, return_exceptions=True)
+
+    return asyncio.run(run())
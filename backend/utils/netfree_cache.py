@@ -0,0 +1,208 @@
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+from utils.netfree_cassette import active_cassette
+
+
+class LocalLRU:
+    """Small per-process LRU with a per-entry expiry."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def shared_cache():
+    """Redis, or the active cassette's own cache so recordings and replays stay isolated."""
+    cassette = active_cassette()
+    return cassette.cache if cassette else cache
+
+
+def local_cache(lru):
+    """The per-process LRU; skipped under a cassette, whose cache is already local."""
+    return None if active_cassette() else lru
+
+
+def normalize_search(url_or_domain):
+    """Cache key for a tags/search-url lookup: scheme-less, lower-case host, no trailing slash."""
+    value = str(url_or_domain).strip()
+    parts = urlsplit(value if "://" in value else "http://" + value)
+    path = parts.path.rstrip("/")
+    query = f"?{parts.query}" if parts.query else ""
+    return f"{parts.netloc.lower()}{path}{query}"
+
+
+class CategoryCache:
+    """Two-tier cache of netfree.link tag lookups.
+
+    ``foundHost`` -> tags response and search string -> ``foundHost`` are kept
+    in a per-worker LRU in front of the shared Redis cache. Hosts without any
+    tags are cached as well, for a shorter time. A full invalidation bumps a
+    version stored in Redis so every worker drops its local copies. Workers
+    re-read that version at most every NETFREE_CATEGORY_VERSION_TTL seconds,
+    so a local hit costs no Redis round trip.
+    """
+
+    VERSION_KEY = "netfree-category-cache:version"
+
+    def __init__(self):
+        self.ttl = settings.NETFREE_CATEGORY_CACHE_TTL
+        self.negative_ttl = settings.NETFREE_CATEGORY_NEGATIVE_TTL
+        self.local = LocalLRU(settings.NETFREE_CATEGORY_LOCAL_SIZE, settings.NETFREE_CATEGORY_LOCAL_TTL)
+        self.stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+        self.version_ttl = settings.NETFREE_CATEGORY_VERSION_TTL
+        self._version = (None, 0.0)
+
+    def version(self):
+        shared = shared_cache()
+        if shared is cache:
+            version, expires_at = self._version
+            if version is not None and expires_at > time.monotonic():
+                return version
+        version = shared.get(self.VERSION_KEY)
+        if version is None:
+            shared.add(self.VERSION_KEY, 1, timeout=None)
+            version = shared.get(self.VERSION_KEY, 1)
+        if shared is cache:
+            self._version = (version, time.monotonic() + self.version_ttl)
+        return version
+
+    def _get(self, key):
+        key = f"netfree-category-cache:{self.version()}:{key}"
+        local = local_cache(self.local)
+        value = local.get(key) if local else None
+        if value is not None:
+            self.stats["local_hits"] += 1
+            return value
+        value = shared_cache().get(key)
+        if value is not None:
+            self.stats["shared_hits"] += 1
+            if local:
+                local.set(key, value)
+            return value
+        self.stats["misses"] += 1
+        return None
+
+    def _set(self, key, value, ttl):
+        key = f"netfree-category-cache:{self.version()}:{key}"
+        shared_cache().set(key, value, timeout=ttl)
+        local = local_cache(self.local)
+        if local:
+            local.set(key, value, ttl)
+
+    def get_host(self, url_or_domain):
+        return self._get(f"search:{normalize_search(url_or_domain)}")
+
+    def set_host(self, url_or_domain, found_host):
+        ttl = self.ttl if found_host else self.negative_ttl
+        self._set(f"search:{normalize_search(url_or_domain)}", found_host, ttl)
+
+    def get_tags(self, found_host):
+        return self._get(f"host:{found_host.lower()}")
+
+    def set_tags(self, found_host, content, has_tags):
+        ttl = self.ttl if has_tags else self.negative_ttl
+        self._set(f"host:{found_host.lower()}", content, ttl)
+
+    def invalidate(self, found_host=None):
+        """Forget one host, or everything when no host is given.
+
+        Other workers may keep serving a single invalidated host from their
+        local LRU for up to NETFREE_CATEGORY_LOCAL_TTL seconds.
+        """
+        shared = shared_cache()
+        if found_host:
+            key = f"netfree-category-cache:{self.version()}:host:{found_host.lower()}"
+            shared.delete(key)
+            self.local.delete(key)
+            return
+        try:
+            shared.incr(self.VERSION_KEY)
+        except ValueError:
+            shared.set(self.VERSION_KEY, 2, timeout=None)
+        self._version = (None, 0.0)
+        self.local.clear()
+
+    def hit_rate(self):
+        hits = self.stats["local_hits"] + self.stats["shared_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+
+category_cache = CategoryCache()
+
+
+class CustomerProfileCache:
+    """full_name/email of Netfree customers keyed by numeric customer id.
+
+    Unknown customers are cached as an empty dict so they are not looked up
+    again until the (shorter) negative TTL runs out.
+    """
+
+    def __init__(self):
+        self.ttl = settings.NETFREE_CUSTOMER_CACHE_TTL
+        self.negative_ttl = settings.NETFREE_CATEGORY_NEGATIVE_TTL
+        self.local = LocalLRU(settings.NETFREE_CATEGORY_LOCAL_SIZE, settings.NETFREE_CATEGORY_LOCAL_TTL)
+
+    def key(self, customer_id):
+        return f"netfree-customer:{customer_id}"
+
+    def get(self, customer_id):
+        key = self.key(customer_id)
+        local = local_cache(self.local)
+        profile = local.get(key) if local else None
+        if profile is None:
+            profile = shared_cache().get(key)
+            if profile is not None and local:
+                local.set(key, profile)
+        return profile
+
+    def set(self, customer_id, profile):
+        key = self.key(customer_id)
+        ttl = self.ttl if profile else self.negative_ttl
+        shared_cache().set(key, profile, timeout=ttl)
+        local = local_cache(self.local)
+        if local:
+            local.set(key, profile, ttl)
+
+    def invalidate(self, customer_id):
+        key = self.key(customer_id)
+        shared_cache().delete(key)
+        self.local.delete(key)
+
+
+customer_cache = CustomerProfileCache()
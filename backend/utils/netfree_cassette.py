@@ -0,0 +1,177 @@
+"""Record and replay NetfreeAPI traffic.
+
+A cassette is a gzip file with one compact JSON record per line::
+
+    {"m": "POST", "p": "/api/tags/search-url", "b": "{...}", "s": 200, "r": "{...}"}
+
+Passwords, phone numbers and cookies never reach the file. Every recording
+process writes its own ``<name>.<pid>.gz`` next to the configured path, so
+Celery workers never share a file; replay reads the configured file, or all
+of those per-process files when it does not exist. In replay mode requests
+are matched on method, path and canonical body, and repeated requests get
+their recorded answers in order (the last one repeats).
+
+While a cassette is active the category and customer caches use the
+cassette's own in-memory cache instead of Redis, so what reaches netfree.link
+(or the cassette) does not depend on what other processes cached.
+"""
+import glob
+import gzip
+import json
+import os
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+
+SCRUBBED_FIELDS = ("password", "phone")
+REPLAY_COOKIE = "cassette"
+
+
+class CassetteMiss(Exception):
+    """Replay mode got a request that was never recorded."""
+
+
+def canonical_body(kwargs):
+    body = kwargs.get("json")
+    if body is None and kwargs.get("data"):
+        data = kwargs["data"]
+        try:
+            body = json.loads(data)
+        except (TypeError, ValueError):
+            return data if isinstance(data, str) else data.decode("utf-8", errors="replace")
+    if body is None:
+        return ""
+    if isinstance(body, dict):
+        body = {key: value for key, value in body.items() if key not in SCRUBBED_FIELDS}
+    return json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def process_path(path, pid=None):
+    """The file one recording process writes: ``netfree.cassette.gz`` -> ``netfree.cassette.<pid>.gz``."""
+    stem, gz = (path[:-3], ".gz") if path.endswith(".gz") else (path, "")
+    return f"{stem}.{pid or os.getpid()}{gz}"
+
+
+def cassette_files(path):
+    if os.path.exists(path):
+        return [path]
+    stem = path[:-3] if path.endswith(".gz") else path
+    return sorted(glob.glob(f"{glob.escape(stem)}.*.gz"))
+
+
+def relative_path(url):
+    parts = urlsplit(url)
+    return parts.path + (f"?{parts.query}" if parts.query else "")
+
+
+class Cassette:
+    """Stands in for requests.Session inside NetfreeAPI while a cassette is active."""
+
+    def __init__(self, path, mode):
+        if mode not in ("record", "replay"):
+            raise ValueError("Cassette mode must be 'record' or 'replay'.")
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.session = requests.Session()
+        self.records = defaultdict(list)
+        self.positions = defaultdict(int)
+        self.file = None
+        self.pid = None
+        self.inherited = []
+        self.cache = LocMemCache(f"netfree-cassette-{id(self)}", {"TIMEOUT": None, "OPTIONS": {"MAX_ENTRIES": 100000}})
+        if mode == "replay":
+            files = cassette_files(path)
+            if not files:
+                raise FileNotFoundError(f"no cassette at {path}")
+            for name in files:
+                with gzip.open(name, "rt", encoding="utf-8") as fp:
+                    for line in fp:
+                        record = json.loads(line)
+                        self.records[(record["m"], record["p"], record["b"])].append(record)
+
+    def open_file(self):
+        # Called under self.lock; a forked child opens its own file. The parent's
+        # file object is kept referenced so it is never finalized (and its gzip
+        # trailer written) from the child.
+        if self.file is None or self.pid != os.getpid():
+            if self.file is not None:
+                self.inherited.append(self.file)
+            self.pid = os.getpid()
+            self.file = gzip.open(process_path(self.path, self.pid), "at", encoding="utf-8")
+        return self.file
+
+    def request(self, method, url, **kwargs):
+        key = (method.upper(), relative_path(url), canonical_body(kwargs))
+        with self.lock:
+            self.calls += 1
+        if self.mode == "replay":
+            return self.replay(key)
+        response = self.session.request(method, url, **kwargs)
+        record = {"m": key[0], "p": key[1], "b": key[2], "s": response.status_code, "r": response.text}
+        with self.lock:
+            fp = self.open_file()
+            fp.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            fp.flush()
+        return response
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def replay(self, key):
+        with self.lock:
+            records = self.records.get(key)
+            if not records:
+                raise CassetteMiss(f"no recorded response for {key[0]} {key[1]} {key[2][:200]}")
+            position = self.positions[key]
+            self.positions[key] = position + 1
+            record = records[min(position, len(records) - 1)]
+        response = requests.Response()
+        response.status_code = record["s"]
+        response._content = record["r"].encode("utf-8")
+        # Lets iter_content() serve the body for stream=True callers.
+        response._content_consumed = True
+        response.encoding = "utf-8"
+        response.headers["Content-Type"] = "application/json"
+        response.url = settings.NETFREE_BASE_URL + key[1]
+        if key[1].endswith("/login-by-password"):
+            response.cookies.set("connect.sid", REPLAY_COOKIE)
+        return response
+
+    def close(self):
+        if self.file and self.pid == os.getpid():
+            self.file.close()
+        self.file = None
+        self.cache.clear()
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def use_cassette(path, mode):
+    """Activate a cassette for every NetfreeAPI in this process; pass mode=None to stop."""
+    global _cassette
+    with _cassette_lock:
+        if _cassette:
+            _cassette.close()
+        _cassette = Cassette(path, mode) if mode else None
+        return _cassette
+
+
+def active_cassette():
+    global _cassette
+    mode = getattr(settings, "NETFREE_CASSETTE_MODE", None)
+    if _cassette is None and mode:
+        with _cassette_lock:
+            if _cassette is None:
+                _cassette = Cassette(settings.NETFREE_CASSETTE_PATH, mode)
+    return _cassette
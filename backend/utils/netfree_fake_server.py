@@ -0,0 +1,182 @@
+"""Local stand-in for the parts of netfree.link that NetfreeAPI talks to.
+
+Point ``NETFREE_BASE_URL`` at it (``python manage.py fake_netfree``) to run the
+processors, benchmarks and failure drills without touching the real service.
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+SEED_HOSTS = [
+    "youtube.com", "google.com", "wikipedia.org", "github.com", "stackoverflow.com",
+    "ynet.co.il", "walla.co.il", "gov.il", "amazon.com", "ebay.com",
+    "linkedin.com", "zoom.us", "office.com", "dropbox.com", "nytimes.com",
+]
+
+
+class FakeNetfreeState:
+    """Seeded, deterministic data plus the knobs for latency, errors and throttling."""
+
+    def __init__(self, seed=1, customers=200, tags=300, latency=0.0, jitter=0.0,
+                 error_rate=0.0, rate_limit=0, traffic_size=40):
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.traffic_size = traffic_size
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.calls = Counter()
+        self.window_start = time.monotonic()
+        self.window_count = 0
+
+        self.tags = [{"id": i, "description": f"Category {i}"} for i in range(1, tags + 1)]
+        self.host_tags = {}
+        for host in SEED_HOSTS:
+            picked = self.random.sample(self.tags, self.random.randint(0, 3))
+            self.host_tags[host] = {str(tag["id"]): {"value": 1} for tag in picked}
+
+        now_ms = int(time.time() * 1000)
+        self.customers = {}
+        for customer_id in range(1000, 1000 + customers):
+            urls = []
+            for _ in range(self.random.randint(0, 30)):
+                host = self.random.choice(SEED_HOSTS)
+                entry = {"url": f"http://{host}/{self.random.randint(1, 999)}", "rule": "open"}
+                if self.random.random() < 0.5:
+                    # Mix of expired and still valid temporary rules.
+                    entry["exp"] = now_ms + self.random.randint(-30, 30) * 86400000
+                urls.append(entry)
+            self.customers[customer_id] = {
+                "user": {"id": customer_id, "full_name": f"Customer {customer_id}",
+                         "email": f"customer{customer_id}@example.com"},
+                "filterSettings": {"mode": "default"},
+                "inspectorSettings": {"tagsList": [], "urls": urls},
+            }
+
+    def throttled(self):
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            return self.window_count > self.rate_limit
+
+    def found_host(self, search):
+        value = str(search)
+        netloc = urlsplit(value if "://" in value else "http://" + value).netloc.lower()
+        return netloc[4:] if netloc.startswith("www.") else netloc
+
+    def traffic_record(self, key):
+        rnd = random.Random(key)
+        customer_id = rnd.choice(list(self.customers))
+        traffic = []
+        for _ in range(self.traffic_size):
+            host = rnd.choice(SEED_HOSTS)
+            block = rnd.choice(["sector", "deny", ""])
+            traffic.append([
+                {"url": f"https://{host}/{rnd.randint(1, 999)}"},
+                {"block": block},
+                {"action": f"user::{customer_id}::view"},
+            ])
+        return {"traffic": traffic}
+
+
+class FakeNetfreeHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def authenticated(self):
+        cookie = self.headers.get("Cookie", "")
+        return any(part.strip().split("=", 1)[-1] in self.state.sessions for part in cookie.split(";"))
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        state = self.state
+        parts = urlsplit(self.path)
+        state.calls[parts.path] += 1
+        if parts.path == "/__stats":
+            return self.send_json(200, dict(state.calls))
+        if state.latency or state.jitter:
+            time.sleep(max(0.0, state.latency + random.uniform(-state.jitter, state.jitter)))
+        if state.throttled():
+            return self.send_json(429, {"error": "too many requests"}, {"Retry-After": "1"})
+        if state.error_rate and random.random() < state.error_rate:
+            return self.send_json(500, {"error": "injected failure"})
+
+        payload = self.read_json() if method == "POST" else {}
+        if parts.path == "/api/user/login-by-password":
+            sid = uuid.uuid4().hex
+            state.sessions.add(sid)
+            return self.send_json(200, {"ok": True}, {"Set-Cookie": f"connect.sid={sid}; Path=/"})
+        if not self.authenticated():
+            return self.send_json(401, {"error": "not logged in"})
+
+        if parts.path == "/api/tags/search-url":
+            return self.send_json(200, {"foundHost": state.found_host(payload.get("search", ""))})
+        if parts.path == "/api/tags/value/edit/get":
+            tags = state.host_tags.get(payload.get("host", ""), {})
+            return self.send_json(200, {"tagValue": {"host": payload.get("host", ""), "tags": tags}})
+        if parts.path == "/api/tags/list":
+            return self.send_json(200, {"list": state.tags})
+        if parts.path == "/api/users/search-user":
+            customer = state.customers.get(int(payload.get("search") or 0))
+            return self.send_json(200, {"users": [customer["user"]] if customer else []})
+        if parts.path == "/api/user/get-filter-settings":
+            customer_id = parse_qs(parts.query).get("id", ["0"])[0]
+            customer = state.customers.get(int(customer_id) if customer_id.isdigit() else 0)
+            if not customer:
+                return self.send_json(404, {"error": "user not found"})
+            return self.send_json(200, {"filterSettings": customer["filterSettings"],
+                                        "inspectorSettings": customer["inspectorSettings"]})
+        if parts.path == "/user/ajax/set-filter-settings":
+            customer = state.customers.get(int(payload.get("id") or 0))
+            if not customer:
+                return self.send_json(404, {"error": "user not found"})
+            with state.lock:
+                customer["filterSettings"] = payload.get("filterSettings")
+                customer["inspectorSettings"] = payload.get("inspectorSettings")
+            return self.send_json(200, {"ok": True})
+        if parts.path == "/api/user/get-traffic-record":
+            return self.send_json(200, state.traffic_record(payload.get("key", "")))
+        return self.send_json(404, {"error": "unknown endpoint"})
+
+
+def make_server(host="127.0.0.1", port=8765, **options):
+    handler = type("Handler", (FakeNetfreeHandler,), {"state": FakeNetfreeState(**options)})
+    return ThreadingHTTPServer((host, port), handler)
@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from redis.exceptions import RedisError
+from utils.netfree_resilience import NetfreeUnavailable
+
+try:
+    from django_redis import get_redis_connection
+except ImportError:
+    get_redis_connection = None
+
+general_log = logging.getLogger('general')
+
+# Atomic token bucket. KEYS: bucket hash, shared rate. ARGV: default rate, capacity.
+# Returns the seconds to wait before a token is available (0 when one was taken).
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(redis.call('GET', KEYS[2]) or ARGV[1])
+local capacity = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 60)
+return tostring(wait)
+"""
+
+
+class AdaptiveLimiter:
+    """AIMD limiter for outbound netfree.link traffic.
+
+    Two layers share the same feedback signal (latency and 429s):
+
+    * a per-process cap on requests in flight, and
+    * a cluster-wide token bucket in Redis whose refill rate is shared by
+      every worker and API process.
+
+    Both are cut in half when Netfree throttles or slows down and grow back
+    additively while it stays healthy. If Redis fails the limiter fails open
+    to the per-process cap alone and tries Redis again after REDIS_RETRY seconds.
+    """
+
+    BUCKET_KEY = "netfree-limiter:bucket"
+    RATE_KEY = "netfree-limiter:rate"
+    DECREASE_KEY = "netfree-limiter:decreased"
+    REDIS_RETRY = 5
+
+    def __init__(self):
+        self.min_rate = settings.NETFREE_LIMITER_MIN_RATE
+        self.max_rate = settings.NETFREE_LIMITER_MAX_RATE
+        self.latency_target = settings.NETFREE_LIMITER_LATENCY_TARGET
+        self.max_wait = settings.NETFREE_LIMITER_MAX_WAIT
+        self.max_concurrency = settings.NETFREE_LIMITER_MAX_CONCURRENCY
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._redis = None
+        self._script = None
+        self._redis_down_until = 0.0
+
+    def redis(self):
+        if self._redis is None and get_redis_connection is not None:
+            try:
+                self._redis = get_redis_connection("default")
+                self._script = self._redis.register_script(TOKEN_BUCKET_LUA)
+            except Exception as e:
+                general_log.error(f"netfree limiter running without redis: {e}")
+                self._redis = False
+        if time.monotonic() < self._redis_down_until:
+            return None
+        return self._redis or None
+
+    def _redis_failed(self, error):
+        if time.monotonic() >= self._redis_down_until:
+            general_log.error(f"netfree limiter skipping redis for {self.REDIS_RETRY}s: {error}")
+        self._redis_down_until = time.monotonic() + self.REDIS_RETRY
+
+    def acquire(self):
+        """Wait for a local slot and a cluster token. Returns the start time for release()."""
+        deadline = time.monotonic() + self.max_wait
+        with self._condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise NetfreeUnavailable("netfree limiter: no free slot", self.max_wait)
+                self._condition.wait(remaining)
+            self.in_flight += 1
+        try:
+            self._take_token(deadline)
+        except Exception:
+            self._free_slot()
+            raise
+        return time.monotonic()
+
+    def release(self, started, throttled=False):
+        latency = time.monotonic() - started
+        congested = throttled or latency > self.latency_target
+        with self._condition:
+            if congested:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+        self._free_slot()
+        self._adjust_rate(congested)
+
+    def _free_slot(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def _take_token(self, deadline):
+        redis = self.redis()
+        if redis is None:
+            return
+        while True:
+            try:
+                wait = float(self._script(keys=[self.BUCKET_KEY, self.RATE_KEY], args=[self.max_rate, self.max_rate]))
+            except RedisError as e:
+                self._redis_failed(e)
+                return
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise NetfreeUnavailable("netfree limiter: rate limited", int(wait) + 1)
+            time.sleep(wait)
+
+    def _adjust_rate(self, congested):
+        redis = self.redis()
+        if redis is None:
+            return
+        try:
+            rate = float(redis.get(self.RATE_KEY) or self.max_rate)
+            if congested:
+                # Only halve once per second so one burst of 429s does not floor the rate.
+                if redis.set(self.DECREASE_KEY, 1, nx=True, ex=1):
+                    new_rate = max(self.min_rate, rate / 2)
+                    redis.set(self.RATE_KEY, new_rate)
+                    general_log.info(f"netfree limiter rate decreased to {new_rate:.2f}/s")
+            elif rate < self.max_rate:
+                if float(redis.incrbyfloat(self.RATE_KEY, 1 / rate)) > self.max_rate:
+                    redis.set(self.RATE_KEY, self.max_rate)
+        except RedisError as e:
+            # release() runs after the call went through; never fail it over bookkeeping.
+            self._redis_failed(e)
+
+
+limiter = AdaptiveLimiter()
@@ -0,0 +1,228 @@
+"""Per-endpoint counters and latency histograms for outbound netfree.link calls.
+
+Everything lives in one Redis hash so API and Celery processes add up to a
+single view; ``render()`` turns it into the Prometheus text format. Recording
+never raises: a metrics failure must not fail the Netfree call it measures.
+"""
+import json
+import logging
+import re
+import time
+from urllib.parse import urlsplit
+
+import requests
+from django.core.cache import cache
+
+try:
+    from django_redis import get_redis_connection
+except ImportError:
+    get_redis_connection = None
+
+general_log = logging.getLogger('general')
+
+METRICS_KEY = "netfree-metrics"
+MAIL_METRICS_KEY = "mail-ingest-metrics"
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LE_LABEL = re.compile(r',?le="([^"]+)"')
+
+
+def bucket_order(line):
+    """Sort key keeping each series' buckets together and in ascending ``le`` order."""
+    field = line.rsplit(" ", 1)[0]
+    match = LE_LABEL.search(field)
+    return (LE_LABEL.sub("", field), float(match.group(1)) if match else 0.0)
+
+
+def endpoint_label(url):
+    return urlsplit(url).path or "/"
+
+
+def mask_username(username):
+    return f"***{str(username)[-4:]}"
+
+
+def payload_bytes(kwargs):
+    if kwargs.get("json") is not None:
+        return len(json.dumps(kwargs["json"]).encode())
+    data = kwargs.get("data")
+    if isinstance(data, str):
+        return len(data.encode())
+    if isinstance(data, bytes):
+        return len(data)
+    return 0
+
+
+class NetfreeMetrics:
+    def __init__(self):
+        self._redis = None
+
+    def redis(self):
+        if self._redis is None and get_redis_connection is not None:
+            try:
+                self._redis = get_redis_connection("default")
+            except Exception as e:
+                general_log.error(f"netfree metrics disabled, no redis: {e}")
+                self._redis = False
+        return self._redis or None
+
+    def observe(self, client, method, url, status, seconds, sent=0, received=0):
+        """Record one call; ``status`` is the HTTP code or "timeout"/"error"."""
+        redis = self.redis()
+        if redis is None:
+            return
+        labels = f'client="{client}",method="{method.upper()}",endpoint="{endpoint_label(url)}"'
+        try:
+            pipe = redis.pipeline(transaction=False)
+            pipe.hincrby(METRICS_KEY, f'netfree_requests_total{{{labels},status="{status}"}}', 1)
+            for le in BUCKETS:
+                if seconds <= le:
+                    pipe.hincrby(METRICS_KEY, f'netfree_request_duration_seconds_bucket{{{labels},le="{le}"}}', 1)
+            pipe.hincrby(METRICS_KEY, f'netfree_request_duration_seconds_bucket{{{labels},le="+Inf"}}', 1)
+            pipe.hincrbyfloat(METRICS_KEY, f'netfree_request_duration_seconds_sum{{{labels}}}', seconds)
+            pipe.hincrby(METRICS_KEY, f'netfree_request_duration_seconds_count{{{labels}}}', 1)
+            pipe.hincrby(METRICS_KEY, f'netfree_request_bytes_total{{{labels}}}', sent)
+            pipe.hincrby(METRICS_KEY, f'netfree_response_bytes_total{{{labels}}}', received)
+            pipe.execute()
+        except Exception as e:
+            general_log.error(f"netfree metrics write failed: {e}")
+
+    def request(self, http, method, url, client="api", **kwargs):
+        """``http.request(method, url, **kwargs)``, timed and recorded."""
+        started = time.perf_counter()
+        try:
+            response = http.request(method, url, **kwargs)
+        except requests.Timeout:
+            self.observe(client, method, url, "timeout", time.perf_counter() - started, payload_bytes(kwargs))
+            raise
+        except Exception:
+            self.observe(client, method, url, "error", time.perf_counter() - started, payload_bytes(kwargs))
+            raise
+        if kwargs.get("stream"):
+            # Reading .content would load the body the caller wants to stream.
+            received = int(response.headers.get("Content-Length") or 0)
+        else:
+            received = len(response.content or b"")
+        self.observe(
+            client, method, url, response.status_code, time.perf_counter() - started,
+            payload_bytes(kwargs), received,
+        )
+        return response
+
+    def observe_mailbox(self, account, folder, pending, lag_seconds):
+        """Gauges for one ingested mailbox folder, set after every fetched batch."""
+        redis = self.redis()
+        if redis is None:
+            return
+        folder = folder.strip('"')
+        labels = f'account="{account}",folder="{folder}"'
+        try:
+            redis.hset(MAIL_METRICS_KEY, mapping={
+                f'mail_ingest_pending_messages{{{labels}}}': pending,
+                f'mail_ingest_lag_seconds{{{labels}}}': round(lag_seconds, 3),
+                f'mail_ingest_last_sync_timestamp{{{labels}}}': int(time.time()),
+            })
+        except Exception as e:
+            general_log.error(f"mail ingest metrics write failed: {e}")
+
+    def observe_ingest_stage(self, stage, messages, seconds, size=0):
+        """Add one mail ingest run's work in ``stage`` (fetch, parse or persist)."""
+        redis = self.redis()
+        if redis is None:
+            return
+        labels = f'stage="{stage}"'
+        try:
+            pipe = redis.pipeline(transaction=False)
+            pipe.hincrby(MAIL_METRICS_KEY, f'mail_ingest_stage_messages_total{{{labels}}}', messages)
+            pipe.hincrbyfloat(MAIL_METRICS_KEY, f'mail_ingest_stage_seconds_total{{{labels}}}', round(seconds, 6))
+            pipe.hincrby(MAIL_METRICS_KEY, f'mail_ingest_stage_bytes_total{{{labels}}}', size)
+            pipe.execute()
+        except Exception as e:
+            general_log.error(f"mail ingest metrics write failed: {e}")
+
+    def observe_ingest_run(self, result, seconds=None):
+        """Count a read_emails run by ``result``: completed, skipped or lease_lost."""
+        redis = self.redis()
+        if redis is None:
+            return
+        try:
+            pipe = redis.pipeline(transaction=False)
+            pipe.hincrby(MAIL_METRICS_KEY, f'mail_ingest_runs_total{{result="{result}"}}', 1)
+            if seconds is not None:
+                pipe.hset(MAIL_METRICS_KEY, 'mail_ingest_last_run_seconds', round(seconds, 3))
+            pipe.execute()
+        except Exception as e:
+            general_log.error(f"mail ingest metrics write failed: {e}")
+
+    def reset(self):
+        redis = self.redis()
+        if redis is not None:
+            redis.delete(METRICS_KEY, MAIL_METRICS_KEY)
+
+    def render(self):
+        """All recorded series plus breaker/limiter gauges in Prometheus text format."""
+        from utils.netfree_limiter import limiter
+        from utils.netfree_resilience import breaker
+        from utils.netfree_session import get_session_pool
+
+        redis = self.redis()
+        raw = redis.hgetall(METRICS_KEY) if redis is not None else {}
+        if redis is not None:
+            raw.update(redis.hgetall(MAIL_METRICS_KEY))
+        series = {}
+        for field, value in raw.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            value = value.decode() if isinstance(value, bytes) else value
+            series.setdefault(field.split("{", 1)[0], []).append(f"{field} {value}")
+
+        families = (
+            ("netfree_requests_total", "counter", "Outbound netfree.link calls by endpoint and status."),
+            ("netfree_request_duration_seconds", "histogram", "Latency of outbound netfree.link calls."),
+            ("netfree_request_bytes_total", "counter", "Request payload bytes sent to netfree.link."),
+            ("netfree_response_bytes_total", "counter", "Response bytes received from netfree.link."),
+            ("mail_ingest_pending_messages", "gauge", "New messages of a mailbox folder not ingested yet."),
+            ("mail_ingest_lag_seconds", "gauge", "Longest time from a message's Date to its ingestion in the last batch."),
+            ("mail_ingest_last_sync_timestamp", "gauge", "Unix time a mailbox folder last finished a batch."),
+            ("mail_ingest_runs_total", "counter", "read_emails runs: completed, skipped while another held the lease, or lease_lost (possible overlap)."),
+            ("mail_ingest_last_run_seconds", "gauge", "Duration of the last completed read_emails run."),
+            ("mail_ingest_stage_messages_total", "counter", "Messages through each mail ingest stage."),
+            ("mail_ingest_stage_seconds_total", "counter", "Busy time of each mail ingest stage."),
+            ("mail_ingest_stage_bytes_total", "counter", "Raw message bytes through each mail ingest stage."),
+        )
+        lines = []
+        for name, kind, help_text in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                lines.extend(sorted(series.get(name + "_bucket", []), key=bucket_order))
+                for suffix in ("_sum", "_count"):
+                    lines.extend(sorted(series.get(name + suffix, [])))
+            else:
+                lines.extend(sorted(series.get(name, [])))
+
+        lines += [
+            "# HELP netfree_credential_healthy 0 while a Netfree admin account is cooling down.",
+            "# TYPE netfree_credential_healthy gauge",
+        ]
+        accounts = get_session_pool().status()
+        for account in accounts:
+            lines.append(f'netfree_credential_healthy{{account="{mask_username(account["username"])}"}} {int(account["healthy"])}')
+        lines += [
+            "# HELP netfree_credential_throttled_total 429 answers per Netfree admin account.",
+            "# TYPE netfree_credential_throttled_total counter",
+        ]
+        for account in accounts:
+            lines.append(f'netfree_credential_throttled_total{{account="{mask_username(account["username"])}"}} {account["throttled"]}')
+
+        rate = redis.get(limiter.RATE_KEY) if redis is not None else None
+        lines += [
+            "# HELP netfree_breaker_open 1 while the netfree.link circuit breaker is open.",
+            "# TYPE netfree_breaker_open gauge",
+            f"netfree_breaker_open {1 if cache.get(breaker.open_key) else 0}",
+            "# HELP netfree_limiter_rate Cluster-wide netfree.link request rate allowed per second.",
+            "# TYPE netfree_limiter_rate gauge",
+            f"netfree_limiter_rate {float(rate) if rate else limiter.max_rate}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+metrics = NetfreeMetrics()
@@ -0,0 +1,103 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+general_log = logging.getLogger('general')
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+
+class NetfreeUnavailable(Exception):
+    """netfree.link is failing or the circuit breaker is open; try again later."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after or settings.NETFREE_BREAKER_RESET
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff for the given 0-based retry attempt."""
+    ceiling = min(settings.NETFREE_BACKOFF_MAX, settings.NETFREE_BACKOFF_BASE * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """Cluster-wide breaker kept in the shared cache.
+
+    Successes and failures are counted per ``window`` seconds. Once a window
+    holds ``threshold`` failures that make up at least ``failure_rate`` of its
+    calls, the breaker opens and every call fails fast for ``reset`` seconds.
+    Then a single probe call is let through: success closes the breaker,
+    failure opens it again.
+    """
+
+    def __init__(self, name="netfree"):
+        self.failures_key = f"{name}-breaker:failures"
+        self.successes_key = f"{name}-breaker:successes"
+        self.open_key = f"{name}-breaker:open"
+        self.tripped_key = f"{name}-breaker:tripped"
+        self.probe_key = f"{name}-breaker:probe"
+        self.threshold = settings.NETFREE_BREAKER_THRESHOLD
+        self.window = settings.NETFREE_BREAKER_WINDOW
+        self.failure_rate = settings.NETFREE_BREAKER_FAILURE_RATE
+        self.reset = settings.NETFREE_BREAKER_RESET
+
+    def retry_after(self):
+        opened_until = cache.get(self.open_key)
+        if opened_until:
+            return max(1, int(opened_until - time.time()))
+        return self.reset
+
+    def is_open(self):
+        """Whether calls currently fail fast; unlike allow() it never takes the probe slot."""
+        return bool(cache.get(self.open_key))
+
+    def allow(self):
+        if self.is_open():
+            return False
+        if cache.get(self.tripped_key):
+            # Half-open: only one caller probes netfree.link at a time.
+            return cache.add(self.probe_key, 1, timeout=60)
+        return True
+
+    def check(self):
+        if not self.allow():
+            raise NetfreeUnavailable("netfree.link circuit breaker is open", self.retry_after())
+
+    def record_success(self):
+        if cache.get(self.tripped_key):
+            general_log.info("netfree circuit breaker closed")
+            cache.delete_many([self.tripped_key, self.probe_key])
+        self._count(self.successes_key)
+
+    def record_failure(self):
+        if cache.get(self.tripped_key):
+            self.open()
+            return
+        failures = self._count(self.failures_key)
+        if failures < self.threshold:
+            return
+        successes = cache.get(self.successes_key, 0)
+        if failures >= (failures + successes) * self.failure_rate:
+            self.open()
+
+    def _count(self, key):
+        cache.add(key, 0, timeout=self.window)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # The window expired between add() and incr().
+            cache.set(key, 1, timeout=self.window)
+            return 1
+
+    def open(self):
+        general_log.error(f"netfree circuit breaker opened for {self.reset}s")
+        cache.set(self.open_key, time.time() + self.reset, timeout=self.reset)
+        cache.set(self.tripped_key, 1, timeout=None)
+        cache.delete_many([self.failures_key, self.successes_key, self.probe_key])
+
+
+breaker = CircuitBreaker()
@@ -0,0 +1,211 @@
+import itertools
+import logging
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from utils.netfree_metrics import metrics
+
+general_log = logging.getLogger('general')
+
+LOGIN_PATH = "/api/user/login-by-password"
+
+
+class NetfreeSession:
+    """Keep one authenticated netfree.link cookie per account.
+
+    The cookie is stored in the shared cache so every Celery worker process
+    reuses the same login instead of authenticating before each call. Each
+    process also keeps it in memory until the shared copy would expire.
+    """
+
+    def __init__(self, username=None, password=None):
+        self.username = username or settings.USERNAME
+        self.password = password or settings.USER_PASSWORD
+        self.cache_key = f"netfree-session:{self.username}"
+        self.lock_key = f"{self.cache_key}:lock"
+        self.ttl = getattr(settings, "NETFREE_SESSION_TTL", 60 * 60)
+        self._cookie = (None, 0.0)
+        self._lock = threading.Lock()
+
+    def _local_cookie(self):
+        with self._lock:
+            cookie, expires_at = self._cookie
+        return cookie if cookie and expires_at > time.monotonic() else None
+
+    def _remember(self, cookie, ttl):
+        with self._lock:
+            self._cookie = (cookie, time.monotonic() + ttl)
+
+    def _cached_ttl(self):
+        """Seconds the shared cookie has left, as far as the cache backend can tell."""
+        remaining = cache.ttl(self.cache_key) if hasattr(cache, "ttl") else None
+        return min(self.ttl, remaining) if remaining else self.ttl
+
+    def get_cookie(self, http, headers):
+        cookie = self._local_cookie()
+        if cookie:
+            return cookie
+        cookie = cache.get(self.cache_key)
+        if cookie:
+            self._remember(cookie, self._cached_ttl())
+            return cookie
+        return self.login(http, headers)
+
+    def invalidate(self, cookie):
+        """Drop a cookie that netfree.link rejected, unless it was already replaced."""
+        with self._lock:
+            if self._cookie[0] == cookie:
+                self._cookie = (None, 0.0)
+        if cache.get(self.cache_key) == cookie:
+            cache.delete(self.cache_key)
+
+    def login(self, http, headers, force=False):
+        with self._lock:
+            stale = self._cookie[0]
+            self._cookie = (None, 0.0)
+        # The cache lock alone serializes logins, for this process's threads
+        # too; holding self._lock while waiting would block every reader.
+        acquired = self._acquire_login_lock()
+        try:
+            # Another worker may have logged in while we were waiting.
+            cookie = cache.get(self.cache_key)
+            if cookie and not force and cookie != stale:
+                self._remember(cookie, self._cached_ttl())
+                return cookie
+            cookie, ttl = self._login(http, headers)
+            if cookie:
+                cache.set(self.cache_key, cookie, timeout=ttl)
+                self._remember(cookie, ttl)
+            return cookie
+        finally:
+            if acquired:
+                cache.delete(self.lock_key)
+
+    def _login(self, http, headers):
+        login_url = settings.NETFREE_BASE_URL + LOGIN_PATH
+        login_data = {"password": self.password, "phone": self.username}
+        login_response = metrics.request(http, "POST", login_url, client="session", headers=headers, json=login_data, timeout=settings.NETFREE_TIMEOUT)
+        jar = login_response.cookies
+        cookie = "; ".join([f"{name}={value}" for name, value in jar.get_dict().items()])
+        if not cookie:
+            general_log.error(f"netfree login failed for {self.username}: {login_response.status_code}")
+            return "", 0
+        ttl = self.ttl
+        expires = [c.expires for c in jar if c.expires]
+        if expires:
+            # Refresh a minute before netfree.link expires the cookie itself.
+            ttl = max(1, min(ttl, int(min(expires) - time.time()) - 60))
+        general_log.info(f"netfree login for {self.username}, cookie cached for {ttl}s")
+        return cookie, ttl
+
+    def _acquire_login_lock(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if cache.add(self.lock_key, 1, timeout=timeout):
+                return True
+            if cache.get(self.cache_key):
+                return False
+            time.sleep(0.1)
+        return False
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_netfree_session(username=None, password=None):
+    """Return the process-wide session for an account, creating it on first use."""
+    username = username or settings.USERNAME
+    with _sessions_lock:
+        session = _sessions.get(username)
+        if session is None:
+            session = _sessions[username] = NetfreeSession(username, password)
+        return session
+
+
+class NetfreeSessionPool:
+    """Spread netfree.link calls over every admin account in NETFREE_CREDENTIALS.
+
+    Calls without a customer rotate over the healthy accounts. Calls for a
+    customer go to the account picked by hashing the customer id, so one
+    account issues that customer's reads and writes in order; they only move
+    to the next account in the ring while it cools down. An account cools down
+    after a 429 (for its Retry-After) or a failed login.
+    """
+
+    def __init__(self, credentials=None):
+        credentials = credentials or settings.NETFREE_CREDENTIALS
+        self.sessions = [get_netfree_session(username, password) for username, password in credentials]
+        self.cooldown = settings.NETFREE_CREDENTIAL_COOLDOWN
+        self._turn = itertools.count()
+
+    def cooldown_key(self, session):
+        return f"netfree-credential:{session.username}:cooldown"
+
+    def throttled_key(self, session):
+        return f"netfree-credential:{session.username}:throttled"
+
+    def healthy(self, session):
+        return not cache.get(self.cooldown_key(session))
+
+    def pick(self, customer_id=None):
+        count = len(self.sessions)
+        if count == 1:
+            return self.sessions[0]
+        customer_id = ''.join(filter(str.isdigit, str(customer_id or "")))
+        if customer_id:
+            start = zlib.crc32(customer_id.encode()) % count
+        else:
+            start = next(self._turn) % count
+        for offset in range(count):
+            session = self.sessions[(start + offset) % count]
+            if self.healthy(session):
+                return session
+        # Everything is cooling down; the limiter and breaker take it from here.
+        return self.sessions[start]
+
+    def throttled(self, session, retry_after=None):
+        seconds = max(1, int(retry_after or self.cooldown))
+        cache.set(self.cooldown_key(session), 1, timeout=seconds)
+        if not cache.add(self.throttled_key(session), 1, timeout=None):
+            cache.incr(self.throttled_key(session))
+        general_log.warning(f"netfree account {session.username} throttled, cooling down for {seconds}s")
+
+    def login_failed(self, session):
+        cache.set(self.cooldown_key(session), 1, timeout=self.cooldown)
+        general_log.error(f"netfree account {session.username} could not log in, cooling down for {self.cooldown}s")
+
+    def warm_up(self, http, headers):
+        """Log every account in ahead of traffic so the first calls don't pay for it."""
+        for session in self.sessions:
+            try:
+                if not session.get_cookie(http, dict(headers)):
+                    self.login_failed(session)
+            except Exception as e:
+                general_log.error(f"netfree account {session.username} warm up failed: {e}")
+
+    def status(self):
+        return [
+            {
+                "username": session.username,
+                "healthy": self.healthy(session),
+                "throttled": cache.get(self.throttled_key(session), 0),
+            }
+            for session in self.sessions
+        ]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_session_pool():
+    """Return the process-wide NetfreeSessionPool built from NETFREE_CREDENTIALS."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = NetfreeSessionPool()
+        return _pool
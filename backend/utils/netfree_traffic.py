@@ -0,0 +1,116 @@
+"""Incremental parser for netfree.link traffic recordings.
+
+A recording is ``{"traffic": [[{"url": ...}, {"block": ...}, {"action": ...}], ...]}``
+and can hold tens of thousands of entries, so entries are decoded one at a
+time from the response chunks instead of loading the whole document. ijson is
+used when it is installed; otherwise a chunked ``raw_decode`` loop does the
+same with the standard library.
+"""
+import codecs
+import json
+import re
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+CUSTOMER_ID_PATTERN = re.compile(r'user::(\d+)::')
+TRAFFIC_ARRAY_PATTERN = re.compile(r'"traffic"\s*:\s*\[')
+NEXT_VALUE_PATTERN = re.compile(r'[^\s,]')
+
+
+def _iter_entries_ijson(chunks):
+    events = ijson.sendable_list()
+    coro = ijson.items_coro(events, "traffic.item")
+    for chunk in chunks:
+        coro.send(chunk)
+        yield from events
+        del events[:]
+    coro.close()
+    yield from events
+
+
+def _iter_entries_raw_decode(chunks):
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buffer = ""
+    in_array = False
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+        if not in_array:
+            match = TRAFFIC_ARRAY_PATTERN.search(buffer)
+            if not match:
+                # Keep a tail long enough to hold a split '"traffic": [' marker.
+                buffer = buffer[-64:]
+                continue
+            buffer = buffer[match.end():]
+            in_array = True
+        pos = 0
+        while True:
+            match = NEXT_VALUE_PATTERN.search(buffer, pos)
+            if not match:
+                pos = len(buffer)
+                break
+            pos = match.start()
+            if buffer[pos] == "]":
+                return
+            try:
+                entry, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # The entry continues in the next chunk.
+                break
+            yield entry
+        buffer = buffer[pos:]
+
+
+def iter_traffic_entries(chunks):
+    """Yield the entries of the ``traffic`` array from an iterable of byte chunks."""
+    if ijson is not None:
+        return _iter_entries_ijson(chunks)
+    return _iter_entries_raw_decode(chunks)
+
+
+def parse_traffic_record(chunks):
+    """Collect sector-blocked and netfree-blocked urls and the recording's customer id.
+
+    Returns ``({"netfree_url": [...], "sector_block": [...], "counts": {...}}, customer_id)``.
+    Urls keep the order they were first seen in; the customer id is the last
+    ``user::<id>::`` found in an action, as before.
+    """
+    sector_urls = {}
+    netfree_urls = {}
+    customer_id = None
+    entries = 0
+    for entry in iter_traffic_entries(chunks):
+        entries += 1
+        url = None
+        sector_block = False
+        netfree_block = False
+        for item in entry:
+            block = item.get('block')
+            if block == "sector":
+                sector_block = True
+            elif block == "deny":
+                netfree_block = True
+            item_url = item.get('url')
+            if item_url and item_url.startswith(("https://", "http://")):
+                url = item_url
+            action = item.get('action')
+            if action and "user::" in action:
+                match = CUSTOMER_ID_PATTERN.search(action)
+                if match:
+                    customer_id = match.group(1)
+        if url is None:
+            continue
+        if sector_block:
+            sector_urls[url] = None
+        if netfree_block:
+            netfree_urls[url] = None
+
+    data = {
+        "netfree_url": list(netfree_urls),
+        "sector_block": list(sector_urls),
+        "counts": {"entries": entries, "netfree_url": len(netfree_urls), "sector_block": len(sector_urls)},
+    }
+    return data, customer_id